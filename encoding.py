@@ -1,6 +1,57 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.autograd import Function
+from torch.cuda.amp import custom_bwd, custom_fwd 
+
+class _freq_encode_torch(Function):
+    @staticmethod
+    @custom_fwd(cast_inputs=torch.float32)
+    def forward(ctx, inputs, freq_bands, include_input):
+        # inputs: [B, D], float
+        # freq_bands: [N], float
+        # RETURN: [B, D + N * 2 * D] if include_input else [B, N * 2 * D], in the order of [x, sin(f0 x), cos(f0 x), sin(f1 x), ...]
+
+        B, D = inputs.shape
+        N = freq_bands.shape[0]
+
+        x = inputs[:, None, :] * freq_bands[None, :, None] # [B, N, D]
+        outputs = torch.stack([torch.sin(x), torch.cos(x)], dim=2).view(B, N * 2 * D) # [B, N, 2, D] --> [B, N * 2 * D]
+
+        if include_input:
+            outputs = torch.cat([inputs, outputs], dim=-1)
+
+        # only the outputs are needed for backward, as d sin(fx) = f cos(fx), d cos(fx) = - f sin(fx).
+        ctx.save_for_backward(outputs, freq_bands)
+        ctx.dims = [B, D, N]
+        ctx.include_input = include_input
+
+        return outputs
+
+    @staticmethod
+    @custom_bwd
+    def backward(ctx, grad):
+        # grad: [B, F]
+
+        outputs, freq_bands = ctx.saved_tensors
+        B, D, N = ctx.dims
+
+        if ctx.include_input:
+            grad_inputs = grad[:, :D]
+            grad, outputs = grad[:, D:], outputs[:, D:]
+        else:
+            grad_inputs = 0
+
+        grad = grad.reshape(B, N, 2, D)
+        outputs = outputs.reshape(B, N, 2, D)
+
+        grad_inputs = grad_inputs + (freq_bands[None, :, None] * (grad[:, :, 0] * outputs[:, :, 1] - grad[:, :, 1] * outputs[:, :, 0])).sum(dim=1) # [B, D]
+
+        return grad_inputs, None, None
+
+
+freq_encode_torch = _freq_encode_torch.apply
+
 
 class FreqEncoder_torch(nn.Module):
     def __init__(self, input_dim, max_freq_log2, N_freqs,
@@ -24,10 +75,17 @@ class FreqEncoder_torch(nn.Module):
         else:
             self.freq_bands = torch.linspace(2 ** 0, 2 ** max_freq_log2, N_freqs)
 
+        self.register_buffer('freq_bands_tensor', self.freq_bands.float(), persistent=False)
         self.freq_bands = self.freq_bands.numpy().tolist()
 
     def forward(self, input, **kwargs):
 
+        # vectorized sin & cos of all frequencies
+        if tuple(self.periodic_fns) == (torch.sin, torch.cos):
+            prefix_shape = list(input.shape[:-1])
+            out = freq_encode_torch(input.reshape(-1, self.input_dim), self.freq_bands_tensor, self.include_input)
+            return out.view(prefix_shape + [self.output_dim])
+
         out = []
         if self.include_input:
             out.append(input)
@@ -44,7 +102,8 @@ class FreqEncoder_torch(nn.Module):
 def get_encoder(encoding, input_dim=3, 
                 multires=6, 
                 degree=4,
-                num_levels=16, level_dim=2, base_resolution=16, log2_hashmap_size=19, desired_resolution=2048, align_corners=False,
+                num_levels=16, level_dim=2, base_resolution=16, log2_hashmap_size=19, desired_resolution=2048, align_corners=False, sparse_grad=False,
+                num_scenes=1,
                 **kwargs):
 
     if encoding == 'None':
@@ -62,12 +121,20 @@ def get_encoder(encoding, input_dim=3,
         encoder = SHEncoder(input_dim=input_dim, degree=degree)
 
     elif encoding == 'hashgrid':
-        from gridencoder import GridEncoder
-        encoder = GridEncoder(input_dim=input_dim, num_levels=num_levels, level_dim=level_dim, base_resolution=base_resolution, log2_hashmap_size=log2_hashmap_size, desired_resolution=desired_resolution, gridtype='hash', align_corners=align_corners)
+        from gridencoder import GridEncoder, MultiGridEncoder
+        if num_scenes > 1:
+            # the grids of all scenes in one allocation
+            encoder = MultiGridEncoder(num_scenes, input_dim=input_dim, num_levels=num_levels, level_dim=level_dim, base_resolution=base_resolution, log2_hashmap_size=log2_hashmap_size, desired_resolution=desired_resolution, gridtype='hash', align_corners=align_corners)
+        else:
+            encoder = GridEncoder(input_dim=input_dim, num_levels=num_levels, level_dim=level_dim, base_resolution=base_resolution, log2_hashmap_size=log2_hashmap_size, desired_resolution=desired_resolution, gridtype='hash', align_corners=align_corners, sparse_grad=sparse_grad)
     
     elif encoding == 'tiledgrid':
-        from gridencoder import GridEncoder
-        encoder = GridEncoder(input_dim=input_dim, num_levels=num_levels, level_dim=level_dim, base_resolution=base_resolution, log2_hashmap_size=log2_hashmap_size, desired_resolution=desired_resolution, gridtype='tiled', align_corners=align_corners)
+        from gridencoder import GridEncoder, MultiGridEncoder
+        if num_scenes > 1:
+            # the grids of all scenes in one allocation
+            encoder = MultiGridEncoder(num_scenes, input_dim=input_dim, num_levels=num_levels, level_dim=level_dim, base_resolution=base_resolution, log2_hashmap_size=log2_hashmap_size, desired_resolution=desired_resolution, gridtype='tiled', align_corners=align_corners)
+        else:
+            encoder = GridEncoder(input_dim=input_dim, num_levels=num_levels, level_dim=level_dim, base_resolution=base_resolution, log2_hashmap_size=log2_hashmap_size, desired_resolution=desired_resolution, gridtype='tiled', align_corners=align_corners, sparse_grad=sparse_grad)
 
     else:
         raise NotImplementedError('Unknown encoding mode, choose from [None, frequency, sphere_harmonics, hashgrid, tiledgrid]')
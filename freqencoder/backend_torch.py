@@ -0,0 +1,30 @@
+import math
+import torch
+
+# Pure pytorch (vectorized) implementation of the `_freqencoder` extension.
+# Both functions mirror the bindings in `src/bindings.cpp` (same arguments, outputs written in-place).
+# layout of the outputs: [x, sin(x), cos(x), sin(2x), cos(2x), ..., sin(2^(deg-1)x), cos(2^(deg-1)x)], each of D channels.
+
+# ----------------------------------------
+# bindings
+# ----------------------------------------
+
+def freq_encode_forward(inputs, B, D, deg, C, outputs):
+    # inputs: [B, D], outputs: [B, C], C = D + D * deg * 2
+    freqs = 2 ** torch.arange(deg, dtype=inputs.dtype, device=inputs.device) # [deg]
+    phase_shift = torch.tensor([0, math.pi / 2], dtype=inputs.dtype, device=inputs.device) # [2], cos(x) = sin(x + pi/2)
+
+    outputs[:, :D] = inputs
+    outputs[:, D:] = torch.sin(inputs[:, None, None, :] * freqs[None, :, None, None] + phase_shift[None, None, :, None]).view(B, deg * 2 * D)
+
+
+def freq_encode_backward(grad, outputs, B, D, deg, C, grad_inputs):
+    # grad: [B, C], outputs: [B, C], grad_inputs: [B, D]
+    freqs = 2 ** torch.arange(deg, dtype=grad.dtype, device=grad.device) # [deg]
+
+    grad_freq = grad[:, D:].view(B, deg, 2, D)
+    outputs_freq = outputs[:, D:].view(B, deg, 2, D)
+
+    # d sin(fx) = f cos(fx), d cos(fx) = - f sin(fx)
+    result = grad_freq[:, :, 0] * outputs_freq[:, :, 1] - grad_freq[:, :, 1] * outputs_freq[:, :, 0] # [B, deg, D]
+    grad_inputs.copy_(grad[:, :D] + (freqs[None, :, None] * result).sum(dim=1))
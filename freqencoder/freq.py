@@ -1,3 +1,4 @@
+import os
 import numpy as np
 
 import torch
@@ -6,10 +7,32 @@ from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 from torch.cuda.amp import custom_bwd, custom_fwd 
 
-try:
-    import _freqencoder as _backend
-except ImportError:
-    from .backend import _backend
+# lazy building: the extension is only built at the first call.
+# if CUDA is not available (or `FREQENCODER_BACKEND=cpu` is set), the pure pytorch backend is used instead.
+
+BACKEND = None
+
+def get_backend():
+    global BACKEND
+
+    if BACKEND is None:
+        choice = os.environ.get('FREQENCODER_BACKEND', '').lower()
+
+        if choice in ['cpu', 'torch'] or (choice != 'cuda' and not torch.cuda.is_available()):
+            from . import backend_torch as _backend
+        else:
+            try:
+                import _freqencoder as _backend
+            except ImportError:
+                from .backend import _backend
+
+        BACKEND = _backend
+    
+    return BACKEND
+
+def is_cuda_backend():
+    from . import backend_torch
+    return get_backend() is not backend_torch
 
 
 class _freq_encoder(Function):
@@ -19,14 +42,14 @@ class _freq_encoder(Function):
         # inputs: [B, input_dim], float 
         # RETURN: [B, F], float
 
-        if not inputs.is_cuda: inputs = inputs.cuda()
+        if not inputs.is_cuda and is_cuda_backend(): inputs = inputs.cuda()
         inputs = inputs.contiguous()
 
         B, input_dim = inputs.shape # batch size, coord dim
         
         outputs = torch.empty(B, output_dim, dtype=inputs.dtype, device=inputs.device)
 
-        _backend.freq_encode_forward(inputs, B, input_dim, degree, output_dim, outputs)
+        get_backend().freq_encode_forward(inputs, B, input_dim, degree, output_dim, outputs)
 
         ctx.save_for_backward(inputs, outputs)
         ctx.dims = [B, input_dim, degree, output_dim]
@@ -44,7 +67,7 @@ class _freq_encoder(Function):
         B, input_dim, degree, output_dim = ctx.dims
 
         grad_inputs = torch.zeros_like(inputs)
-        _backend.freq_encode_backward(grad, outputs, B, input_dim, degree, output_dim, grad_inputs)
+        get_backend().freq_encode_backward(grad, outputs, B, input_dim, degree, output_dim, grad_inputs)
 
         return grad_inputs, None, None
     
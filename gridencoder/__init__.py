@@ -1 +1 @@
-from .grid import GridEncoder
\ No newline at end of file
+from .grid import GridEncoder, MultiGridEncoder
\ No newline at end of file
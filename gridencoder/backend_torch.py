@@ -0,0 +1,174 @@
+import torch
+
+# Pure pytorch (vectorized) implementation of the `_gridencoder` extension.
+# Both functions mirror the bindings in `src/bindings.cpp` (same arguments, outputs written in-place),
+# and compute the same grid indices as `src/gridencoder.cu` (including the uint32 hashing),
+# so embeddings trained with either backend are interchangeable.
+
+PRIMES = [1, 2654435761, 805459861, 3674653429, 2097192037, 1434869437, 2165219737]
+
+# ----------------------------------------
+# helpers
+# ----------------------------------------
+
+def _fast_hash(pos_grid):
+    # pos_grid: int64 [..., D], D <= 7
+    result = torch.zeros_like(pos_grid[..., 0])
+    for d in range(pos_grid.shape[-1]):
+        result = result ^ ((pos_grid[..., d] * PRIMES[d]) & 0xFFFFFFFF)
+    return result
+
+
+def _grid_index(gridtype, align_corners, hashmap_size, resolution, pos_grid):
+    # pos_grid: int64 [..., D]
+    # return: int64 [...], in [0, hashmap_size)
+    stride = 1
+    index = torch.zeros_like(pos_grid[..., 0])
+    for d in range(pos_grid.shape[-1]):
+        if stride > hashmap_size:
+            break
+        index = index + pos_grid[..., d] * stride
+        stride *= resolution if align_corners else (resolution + 1)
+
+    # gridtype: 0 == hash, 1 == tiled
+    if gridtype == 0 and stride > hashmap_size:
+        index = _fast_hash(pos_grid)
+
+    return (index & 0xFFFFFFFF) % hashmap_size
+
+
+def _level_scale(level, S, H):
+    # same float32 arithmetic as the kernel: exp2f(level * S) * H - 1.0f
+    scale = torch.exp2(torch.tensor(level, dtype=torch.float32) * torch.tensor(S, dtype=torch.float32)) * H - 1.0
+    scale = scale.item()
+    resolution = int(torch.ceil(torch.tensor(scale, dtype=torch.float32)).item()) + 1
+    return scale, resolution
+
+
+def _corners(D, device):
+    # [2^D, D], bit d of corner idx selects pos_grid[d] + 1
+    idx = torch.arange(2 ** D, device=device)
+    return torch.stack([(idx >> d) & 1 for d in range(D)], dim=-1)
+
+
+def _interp_level(inputs, offsets, level, S, H, gridtype, align_corners):
+    # inputs: float [B, D], in [0, 1]
+    # return: indices [B, 2^D] (into the embeddings of all levels), per-dim weights [B, 2^D, D], corners [2^D, D], scale
+    B, D = inputs.shape
+    hashmap_size = int(offsets[level + 1] - offsets[level])
+    scale, resolution = _level_scale(level, S, H)
+
+    pos = inputs.float() * scale + (0.0 if align_corners else 0.5)
+    pos_grid = torch.floor(pos)
+    pos = pos - pos_grid
+    pos_grid = pos_grid.long()
+
+    corners = _corners(D, inputs.device) # [2^D, D]
+    pos_grid_local = pos_grid[:, None, :] + corners[None, :, :] # [B, 2^D, D]
+    weights = torch.where(corners[None, :, :] == 1, pos[:, None, :], 1 - pos[:, None, :]) # [B, 2^D, D]
+
+    indices = _grid_index(gridtype, align_corners, hashmap_size, resolution, pos_grid_local) + int(offsets[level]) # [B, 2^D]
+
+    return indices, weights, corners, scale
+
+
+def _in_bound(inputs):
+    # inputs outside [0, 1] have zero outputs and gradients.
+    return ((inputs >= 0) & (inputs <= 1)).all(dim=-1) # [B]
+
+# ----------------------------------------
+# bindings
+# ----------------------------------------
+
+def grid_encode_forward(inputs, embeddings, offsets, outputs, B, D, C, L, S, H, dy_dx, gridtype, align_corners):
+    # inputs: [B, D], embeddings: [sO, C], offsets: [L + 1]
+    # outputs: [L, B, C], dy_dx: [B, L * D * C] or None
+    mask = _in_bound(inputs)
+    emb = embeddings.float()
+
+    if dy_dx is not None:
+        dy_dx_view = dy_dx.view(B, L, D, C)
+
+    for level in range(L):
+        indices, weights, corners, scale = _interp_level(inputs, offsets, level, S, H, gridtype, align_corners)
+        values = emb[indices] # [B, 2^D, C]
+
+        w = weights.prod(dim=-1) # [B, 2^D]
+        results = (w[..., None] * values).sum(dim=1) # [B, C]
+        outputs[level] = torch.where(mask[:, None], results, torch.zeros_like(results)).to(outputs.dtype)
+
+        if dy_dx is not None:
+            for gd in range(D):
+                # weights of the other dims, signed by the side of dim gd
+                w = scale * (corners[:, gd] * 2 - 1).float()[None, :] # [1, 2^D]
+                for d in range(D):
+                    if d != gd:
+                        w = w * weights[..., d]
+                results_grad = (w[..., None] * values).sum(dim=1) # [B, C]
+                dy_dx_view[:, level, gd] = torch.where(mask[:, None], results_grad, torch.zeros_like(results_grad)).to(dy_dx.dtype)
+
+
+def grid_encode_backward(grad, inputs, embeddings, offsets, grad_embeddings, B, D, C, L, S, H, dy_dx, grad_inputs, gridtype, align_corners):
+    # grad: [L, B, C], inputs: [B, D]
+    # grad_embeddings: [sO, C], zero initialized, grad_inputs: [B, D] or None
+    mask = _in_bound(inputs)
+    grad = grad.float() * mask[None, :, None] # [L, B, C]
+
+    grad_grid = torch.zeros(grad_embeddings.shape, dtype=torch.float32, device=grad_embeddings.device)
+
+    for level in range(L):
+        indices, weights, _, _ = _interp_level(inputs, offsets, level, S, H, gridtype, align_corners)
+        w = weights.prod(dim=-1) # [B, 2^D]
+        grad_grid.index_add_(0, indices.reshape(-1), (w[..., None] * grad[level][:, None, :]).reshape(-1, C))
+
+    grad_embeddings.copy_(grad_grid.to(grad_embeddings.dtype))
+
+    if dy_dx is not None and grad_inputs is not None:
+        # [L, B, C] x [B, L, D, C] --> [B, D]
+        grad_inputs.copy_(torch.einsum('lbc,bldc->bd', grad, dy_dx.view(B, L, D, C).float()).to(grad_inputs.dtype))
+
+
+def grid_encode_backward_sparse(grad, inputs, embeddings, offsets, B, D, C, L, S, H, dy_dx, grad_inputs, gridtype, align_corners):
+    # same as grid_encode_backward, but only accumulates the touched rows of the embeddings.
+    # return: rows [K] (unique, sorted), grad of these rows [K, C] (float)
+    mask = _in_bound(inputs)
+    grad = grad.float() * mask[None, :, None] # [L, B, C]
+
+    all_rows = []
+    all_values = []
+
+    # levels occupy disjoint ranges of the embeddings, so the per-level unique rows are also unique overall.
+    for level in range(L):
+        indices, weights, _, _ = _interp_level(inputs, offsets, level, S, H, gridtype, align_corners)
+        w = weights.prod(dim=-1) # [B, 2^D]
+        rows, inverse = torch.unique(indices.reshape(-1), return_inverse=True) # [K], [B * 2^D]
+        values = torch.zeros(rows.shape[0], C, dtype=torch.float32, device=grad.device)
+        values.index_add_(0, inverse, (w[..., None] * grad[level][:, None, :]).reshape(-1, C))
+        all_rows.append(rows)
+        all_values.append(values)
+
+    if dy_dx is not None and grad_inputs is not None:
+        grad_inputs.copy_(torch.einsum('lbc,bldc->bd', grad, dy_dx.view(B, L, D, C).float()).to(grad_inputs.dtype))
+
+    return torch.cat(all_rows, dim=0), torch.cat(all_values, dim=0)
+
+
+def grid_encode_input_backward_embeddings(grad, grad_grad_inputs, inputs, offsets, grad_embeddings, B, D, C, L, S, H, gridtype, align_corners):
+    # gradient of grad_inputs = sum_{l, c} grad[l, b, c] * dy_dx[b, l, d, c] w.r.t. the embeddings, used in double backward on any device.
+    # grad: [L, B, C], grad_grad_inputs: [B, D], grad_embeddings: [sO, C], float, zero initialized
+    mask = _in_bound(inputs)
+    grad = grad.float() * mask[None, :, None] # [L, B, C]
+
+    for level in range(L):
+        indices, weights, corners, scale = _interp_level(inputs, offsets, level, S, H, gridtype, align_corners)
+
+        # sum_d grad_grad_inputs[b, d] * d(dy_dx[b, l, d])/d(embedding of corner)
+        coef = torch.zeros_like(weights[..., 0]) # [B, 2^D]
+        for gd in range(D):
+            w = scale * (corners[:, gd] * 2 - 1).float()[None, :] # [1, 2^D]
+            for d in range(D):
+                if d != gd:
+                    w = w * weights[..., d]
+            coef = coef + grad_grad_inputs[:, gd:gd+1] * w
+
+        grad_embeddings.index_add_(0, indices.reshape(-1), (coef[..., None] * grad[level][:, None, :]).reshape(-1, C))
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 
 import torch
@@ -6,10 +7,30 @@ from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 from torch.cuda.amp import custom_bwd, custom_fwd 
 
-try:
-    import _gridencoder as _backend
-except ImportError:
-    from .backend import _backend
+# lazy building: the extension is only built at the first call.
+# if CUDA is not available (or `GRIDENCODER_BACKEND=cpu` is set), the pure pytorch backend is used instead.
+
+BACKEND = None
+
+def get_backend():
+    global BACKEND
+
+    if BACKEND is None:
+        choice = os.environ.get('GRIDENCODER_BACKEND', '').lower()
+
+        if choice in ['cpu', 'torch'] or (choice != 'cuda' and not torch.cuda.is_available()):
+            from . import backend_torch as _backend
+        else:
+            try:
+                import _gridencoder as _backend
+            except ImportError:
+                from .backend import _backend
+
+        BACKEND = _backend
+    
+    return BACKEND
+
+from .backend_torch import grid_encode_input_backward_embeddings
 
 _gridtype_to_id = {
     'hash': 0,
@@ -19,7 +40,7 @@ _gridtype_to_id = {
 class _grid_encode(Function):
     @staticmethod
     @custom_fwd
-    def forward(ctx, inputs, embeddings, offsets, per_level_scale, base_resolution, calc_grad_inputs=False, gridtype=0, align_corners=False):
+    def forward(ctx, inputs, embeddings, offsets, per_level_scale, base_resolution, calc_grad_inputs=False, gridtype=0, align_corners=False, sparse_grad=False):
         # inputs: [B, D], float in [0, 1]
         # embeddings: [sO, C], float
         # offsets: [L + 1], int
@@ -33,6 +54,9 @@ class _grid_encode(Function):
         S = np.log2(per_level_scale) # resolution multiplier at each level, apply log2 for later CUDA exp2f
         H = base_resolution # base resolution
 
+        embeddings_dtype = embeddings.dtype
+        embeddings_param = embeddings
+
         # manually handle autocast (only use half precision embeddings, inputs must be float for enough precision)
         # if C % 2 != 0, force float, since half for atomicAdd is very slow.
         if torch.is_autocast_enabled() and C % 2 == 0:
@@ -46,14 +70,17 @@ class _grid_encode(Function):
         else:
             dy_dx = None
 
-        _backend.grid_encode_forward(inputs, embeddings, offsets, outputs, B, D, C, L, S, H, dy_dx, gridtype, align_corners)
+        get_backend().grid_encode_forward(inputs, embeddings, offsets, outputs, B, D, C, L, S, H, dy_dx, gridtype, align_corners)
 
         # permute back to [B, L * C]
         outputs = outputs.permute(1, 0, 2).reshape(B, L * C)
 
-        ctx.save_for_backward(inputs, embeddings, offsets, dy_dx)
+        # the (float) embeddings are also kept for the differentiable input gradient, see backward.
+        ctx.save_for_backward(inputs, embeddings, offsets, dy_dx, embeddings_param if calc_grad_inputs else None)
         ctx.dims = [B, D, C, L, S, H, gridtype]
         ctx.align_corners = align_corners
+        ctx.sparse_grad = sparse_grad
+        ctx.embeddings_dtype = embeddings_dtype
 
         return outputs
     
@@ -62,34 +89,102 @@ class _grid_encode(Function):
     @custom_bwd
     def backward(ctx, grad):
 
-        inputs, embeddings, offsets, dy_dx = ctx.saved_tensors
+        inputs, embeddings, offsets, dy_dx, embeddings_param = ctx.saved_tensors
         B, D, C, L, S, H, gridtype = ctx.dims
         align_corners = ctx.align_corners
 
         # grad: [B, L * C] --> [L, B, C]
         grad = grad.view(B, L, C).permute(1, 0, 2).contiguous()
 
-        grad_embeddings = torch.zeros_like(embeddings)
+        # double backward (create_graph=True, e.g. analytic normals used in losses): the input gradient must stay differentiable w.r.t. grad and embeddings.
+        if dy_dx is not None and torch.is_grad_enabled():
+            grad_inputs = grid_encode_input_backward(grad, inputs, embeddings_param, offsets, dy_dx, ctx.dims, align_corners)
+            dy_dx = None # skip the non-differentiable input gradient below
 
-        if dy_dx is not None:
+        elif dy_dx is not None:
             grad_inputs = torch.zeros_like(inputs, dtype=embeddings.dtype)
         else:
             grad_inputs = None
 
-        _backend.grid_encode_backward(grad, inputs, embeddings, offsets, grad_embeddings, B, D, C, L, S, H, dy_dx, grad_inputs, gridtype, align_corners)
+        # only the input gradient is needed (the embeddings were detached, see GridEncoder.input_grad_only):
+        # skip the dense gradient of the whole table, the input gradient is the same reduction as the kernel's.
+        if not ctx.needs_input_grad[1]:
+            if dy_dx is not None:
+                # [L, B, C] x [B, L, D, C] --> [B, D]
+                grad_inputs = torch.einsum('lbc,bldc->bd', grad.float(), dy_dx.view(B, L, D, C).float())
+            if grad_inputs is not None:
+                grad_inputs = grad_inputs.to(inputs.dtype)
+            return grad_inputs, None, None, None, None, None, None, None, None
+
+        # sparse gradient, only the touched rows of the embeddings.
+        if ctx.sparse_grad and hasattr(get_backend(), 'grid_encode_backward_sparse'):
+            rows, values = get_backend().grid_encode_backward_sparse(grad, inputs, embeddings, offsets, B, D, C, L, S, H, dy_dx, grad_inputs, gridtype, align_corners)
+        else:
+            grad_embeddings = torch.zeros_like(embeddings)
+            get_backend().grid_encode_backward(grad, inputs, embeddings, offsets, grad_embeddings, B, D, C, L, S, H, dy_dx, grad_inputs, gridtype, align_corners)
+            if ctx.sparse_grad:
+                # the CUDA kernel accumulates into a dense buffer, keep the non-zero rows.
+                rows = torch.nonzero(grad_embeddings.any(dim=-1)).squeeze(-1)
+                values = grad_embeddings[rows]
+
+        if ctx.sparse_grad:
+            grad_embeddings = torch.sparse_coo_tensor(rows[None], values.to(ctx.embeddings_dtype), embeddings.shape)
 
-        if dy_dx is not None:
+        if grad_inputs is not None:
             grad_inputs = grad_inputs.to(inputs.dtype)
 
-        return grad_inputs, grad_embeddings, None, None, None, None, None, None
+        return grad_inputs, grad_embeddings, None, None, None, None, None, None, None
         
 
 
 grid_encode = _grid_encode.apply
 
 
+class _grid_encode_input_backward(Function):
+    @staticmethod
+    def forward(ctx, grad, inputs, embeddings, offsets, dy_dx, dims, align_corners):
+        # grad: [L, B, C], gradient of the outputs
+        # embeddings: [sO, C], float
+        # dy_dx: [B, L * D * C]
+        # RETURN: [B, D], gradient of the inputs
+
+        B, D, C, L, S, H, gridtype = dims
+
+        grad_inputs = torch.einsum('lbc,bldc->bd', grad.float(), dy_dx.view(B, L, D, C).float())
+
+        ctx.save_for_backward(grad, inputs, offsets, dy_dx)
+        ctx.dims = dims
+        ctx.align_corners = align_corners
+        ctx.embeddings_shape = embeddings.shape
+        ctx.embeddings_dtype = embeddings.dtype
+
+        return grad_inputs
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_grad_inputs):
+        # grad_grad_inputs: [B, D]
+
+        grad, inputs, offsets, dy_dx = ctx.saved_tensors
+        B, D, C, L, S, H, gridtype = ctx.dims
+
+        grad_grad_inputs = grad_grad_inputs.float()
+
+        # grad_inputs is linear in grad
+        grad_grad = torch.einsum('bd,bldc->lbc', grad_grad_inputs, dy_dx.view(B, L, D, C).float()).to(grad.dtype)
+
+        # ... and dy_dx is linear in embeddings
+        grad_embeddings = torch.zeros(ctx.embeddings_shape, dtype=torch.float32, device=grad.device)
+        grid_encode_input_backward_embeddings(grad, grad_grad_inputs, inputs, offsets, grad_embeddings, B, D, C, L, S, H, gridtype, ctx.align_corners)
+
+        return grad_grad, None, grad_embeddings.to(ctx.embeddings_dtype), None, None, None, None
+
+
+grid_encode_input_backward = _grid_encode_input_backward.apply
+
+
 class GridEncoder(nn.Module):
-    def __init__(self, input_dim=3, num_levels=16, level_dim=2, per_level_scale=2, base_resolution=16, log2_hashmap_size=19, desired_resolution=None, gridtype='hash', align_corners=False):
+    def __init__(self, input_dim=3, num_levels=16, level_dim=2, per_level_scale=2, base_resolution=16, log2_hashmap_size=19, desired_resolution=None, gridtype='hash', align_corners=False, sparse_grad=False):
         super().__init__()
 
         # the finest resolution desired at the last level, if provided, overridee per_level_scale
@@ -106,6 +201,8 @@ class GridEncoder(nn.Module):
         self.gridtype = gridtype
         self.gridtype_id = _gridtype_to_id[gridtype] # "tiled" or "hash"
         self.align_corners = align_corners
+        self.sparse_grad = sparse_grad # return sparse gradients of the embeddings, requires an optimizer supporting them (e.g. optimizer.LazyAdam)
+        self.input_grad_only = False # detach the embeddings, the backward then only computes the input gradient (e.g. normals at inference)
 
         # allocate parameters
         offsets = []
@@ -133,7 +230,7 @@ class GridEncoder(nn.Module):
         self.embeddings.data.uniform_(-std, std)
 
     def __repr__(self):
-        return f"GridEncoder: input_dim={self.input_dim} num_levels={self.num_levels} level_dim={self.level_dim} resolution={self.base_resolution} -> {int(round(self.base_resolution * self.per_level_scale ** (self.num_levels - 1)))} per_level_scale={self.per_level_scale:.4f} params={tuple(self.embeddings.shape)} gridtype={self.gridtype} align_corners={self.align_corners}"
+        return f"GridEncoder: input_dim={self.input_dim} num_levels={self.num_levels} level_dim={self.level_dim} resolution={self.base_resolution} -> {int(round(self.base_resolution * self.per_level_scale ** (self.num_levels - 1)))} per_level_scale={self.per_level_scale:.4f} params={tuple(self.embeddings.shape)} gridtype={self.gridtype} align_corners={self.align_corners} sparse_grad={self.sparse_grad}"
     
     def forward(self, inputs, bound=1):
         # inputs: [..., input_dim], normalized real world positions in [-bound, bound]
@@ -146,9 +243,62 @@ class GridEncoder(nn.Module):
         prefix_shape = list(inputs.shape[:-1])
         inputs = inputs.view(-1, self.input_dim)
 
-        outputs = grid_encode(inputs, self.embeddings, self.offsets, self.per_level_scale, self.base_resolution, inputs.requires_grad, self.gridtype_id, self.align_corners)
+        embeddings = self.embeddings.detach() if self.input_grad_only else self.embeddings
+
+        outputs = grid_encode(inputs, embeddings, self.offsets, self.per_level_scale, self.base_resolution, inputs.requires_grad, self.gridtype_id, self.align_corners, self.sparse_grad)
         outputs = outputs.view(prefix_shape + [self.output_dim])
 
         #print('outputs', outputs.shape, outputs.dtype, outputs.min().item(), outputs.max().item())
 
-        return outputs
\ No newline at end of file
+        return outputs
+
+class MultiGridEncoder(GridEncoder):
+    # the grids of `num_scenes` scenes (same config) in one allocation, scene k owns the rows [k * scene_size, (k + 1) * scene_size) of the embeddings.
+    # inputs are scene-major: N / num_scenes consecutive points of each scene, or only points of `self.scene` if it is set.
+    # the kernels encode one scene per call, on a view of its rows, so the backward accumulates a single gradient buffer for all scenes.
+    def __init__(self, num_scenes, **kwargs):
+        super().__init__(**kwargs)
+
+        assert not self.sparse_grad, 'MultiGridEncoder only supports dense gradients.'
+
+        self.num_scenes = num_scenes
+        self.scene_size = int(self.offsets[-1]) # rows per scene
+        self.scene = None # None: all scenes, or the index of the only encoded scene
+
+        self.n_params = self.n_params * num_scenes
+        self.embeddings = nn.Parameter(torch.empty(num_scenes * self.scene_size, self.level_dim))
+
+        self.reset_parameters()
+
+    def __repr__(self):
+        return f"MultiGridEncoder: num_scenes={self.num_scenes} " + super().__repr__()[len("GridEncoder: "):]
+
+    def forward(self, inputs, bound=1):
+        # inputs: [..., input_dim], normalized real world positions in [-bound, bound]
+        # return: [..., num_levels * level_dim]
+
+        inputs = (inputs + bound) / (2 * bound) # map to [0, 1]
+
+        prefix_shape = list(inputs.shape[:-1])
+        inputs = inputs.view(-1, self.input_dim)
+
+        embeddings = self.embeddings.detach() if self.input_grad_only else self.embeddings
+
+        # grid_encode casts the embeddings under autocast, do it once for all scenes.
+        if torch.is_autocast_enabled() and self.level_dim % 2 == 0:
+            embeddings = embeddings.to(torch.half)
+
+        tables = embeddings.split(self.scene_size) # views of each scene
+
+        if self.scene is None:
+            assert inputs.shape[0] % self.num_scenes == 0, f'{inputs.shape[0]} points cannot be split into {self.num_scenes} scenes.'
+            scenes = list(range(self.num_scenes))
+            inputs = inputs.chunk(self.num_scenes)
+        else:
+            scenes = [self.scene]
+            inputs = [inputs]
+
+        outputs = [grid_encode(x, tables[k], self.offsets, self.per_level_scale, self.base_resolution, x.requires_grad, self.gridtype_id, self.align_corners, False) for k, x in zip(scenes, inputs)]
+        outputs = torch.cat(outputs, dim=0).view(prefix_shape + [self.output_dim])
+
+        return outputs
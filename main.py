@@ -3,7 +3,7 @@ import argparse
 
 from nerf.provider import NeRFDataset
 from nerf.utils import *
-from optimizer import Shampoo
+from optimizer import Shampoo, LazyAdam
 
 from nerf.gui import NeRFGUI
 
@@ -17,13 +17,23 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--text', default=None, help="text prompt")
     parser.add_argument('--negative', default='', type=str, help="negative text prompt")
+    parser.add_argument('--scenes', type=str, nargs='*', default=[], help="multi-scene training: one text prompt per scene, all scenes are trained together in one process with stacked networks and batched guidance (grid backbone, pytorch raymarching)")
+    parser.add_argument('--text_cache', type=str, default=os.path.join(os.path.expanduser('~'), '.cache', 'stable-dreamfusion', 'text_embeds'), help="directory of the on-disk text embedding cache, empty string to disable")
     parser.add_argument('-O', action='store_true', help="equals --fp16 --cuda_ray --dir_text")
     parser.add_argument('-O2', action='store_true', help="equals --backbone vanilla --dir_text")
     parser.add_argument('--test', action='store_true', help="test mode")
     parser.add_argument('--save_mesh', action='store_true', help="export an obj mesh with texture")
+    parser.add_argument('--mesh_format', type=str, default='obj', choices=['obj', 'ply', 'glb'], help="exported mesh format, glb embeds the texture")
     parser.add_argument('--eval_interval', type=int, default=10, help="evaluate on the valid set every interval epochs")
     parser.add_argument('--workspace', type=str, default='workspace')
-    parser.add_argument('--guidance', type=str, default='stable-diffusion', help='choose from [stable-diffusion, clip]')
+    parser.add_argument('--guidance', type=str, default='stable-diffusion', help='choose from [stable-diffusion, clip, tiny, remote]')
+    parser.add_argument('--guidance_socket', type=str, default='/tmp/stable-dreamfusion-guidance.sock', help="--guidance remote: unix socket of a shared guidance server (python -m nerf.guidance_server)")
+    parser.add_argument('--tiny_channels', type=int, default=64, help="--guidance tiny: channels of the denoiser, the cost grows quadratically")
+    parser.add_argument('--tiny_layers', type=int, default=4, help="--guidance tiny: num of conv layers of the denoiser")
+    parser.add_argument('--tiny_resolution', type=int, default=512, help="--guidance tiny: image resolution fed into the vae")
+    parser.add_argument('--cfg_cache_every', type=int, default=0, help="sparse classifier-free guidance: recompute the unconditional noise prediction of a view direction every k steps, and reuse it in between (0 to disable)")
+    parser.add_argument('--cfg_cache_buckets', type=int, default=4, help="sparse classifier-free guidance: a cached unconditional prediction is only reused within its timestep bucket")
+    parser.add_argument('--sd_profile', type=str, default='default', choices=['default', 'fast', 'balanced', 'low-mem'], help="memory profile of stable diffusion: fp16 weights, channels-last, attention slicing, vae tiling and text encoder offloading, see nerf/sd.py")
     parser.add_argument('--seed', type=int, default=0)
 
     ### training options
@@ -31,10 +41,18 @@ if __name__ == '__main__':
     parser.add_argument('--lr', type=float, default=1e-3, help="initial learning rate")
     parser.add_argument('--ckpt', type=str, default='latest')
     parser.add_argument('--cuda_ray', action='store_true', help="use CUDA raymarching instead of pytorch")
+    parser.add_argument('--occ_grid', action='store_true', help="skip samples in empty space with an occupancy grid (only valid when not using --cuda_ray)")
     parser.add_argument('--max_steps', type=int, default=512, help="max num steps sampled per ray (only valid when using --cuda_ray)")
     parser.add_argument('--num_steps', type=int, default=64, help="num steps sampled per ray (only valid when not using --cuda_ray)")
     parser.add_argument('--upsample_steps', type=int, default=32, help="num steps up-sampled per ray (only valid when not using --cuda_ray)")
-    parser.add_argument('--update_extra_interval', type=int, default=16, help="iter interval to update extra status (only valid when using --cuda_ray)")
+    parser.add_argument('--update_extra_interval', type=int, default=16, help="iter interval to update extra status (only valid when using --cuda_ray or --occ_grid)")
+    parser.add_argument('--adaptive_update_extra', action='store_true', help="adapt the extra status update interval to the occupancy change rate")
+    parser.add_argument('--update_extra_min_interval', type=int, default=8, help="min iter interval to update extra status (only valid when using --adaptive_update_extra)")
+    parser.add_argument('--update_extra_max_interval', type=int, default=256, help="max iter interval to update extra status (only valid when using --adaptive_update_extra)")
+    parser.add_argument('--update_extra_flip_low', type=float, default=0.01, help="double the interval when the ratio of flipped occupied cells is below this (only valid when using --adaptive_update_extra)")
+    parser.add_argument('--update_extra_flip_high', type=float, default=0.05, help="halve the interval when the ratio of flipped occupied cells is above this (only valid when using --adaptive_update_extra)")
+    parser.add_argument('--grid_budget', type=int, default=2**19, help="num of grid cells queried per cascade at each incremental grid update, half random and half occupied cells (<= 0 to always update the full grid)")
+    parser.add_argument('--grid_warmup', type=int, default=16, help="num of initial grid updates that query the full grid")
     parser.add_argument('--max_ray_batch', type=int, default=4096, help="batch size of rays at inference to avoid OOM (only valid when not using --cuda_ray)")
     parser.add_argument('--albedo', action='store_true', help="only use albedo shading to train, overrides --albedo_iters")
     parser.add_argument('--albedo_iters', type=int, default=1000, help="training iters that only use albedo shading")
@@ -45,9 +63,17 @@ if __name__ == '__main__':
     # network backbone
     parser.add_argument('--fp16', action='store_true', help="use amp mixed precision training")
     parser.add_argument('--backbone', type=str, default='grid', help="nerf backbone, choose from [grid, vanilla]")
+    parser.add_argument('--sparse_grid_grad', action='store_true', help="use sparse gradients for the grid encoder embeddings with a lazy adam (only valid for --backbone grid)")
+    parser.add_argument('--normal_mode', type=str, default='finite_difference', choices=['analytic', 'tetrahedral', 'finite_difference'], help="how the grid backbone computes normals: analytic (encoder input gradient), tetrahedral (4-tap) or finite_difference (6-tap)")
+    parser.add_argument('--deferred_shading', action='store_true', help="shade per pixel: composite albedo first, then query one normal per ray (lambertian & textureless only)")
+    parser.add_argument('--deferred_topk', type=int, default=0, help="deferred shading: blend the normals of the top-k weighted samples instead of the expected depth point (pytorch raymarching only), 0 to disable")
+    parser.add_argument('--latent', action='store_true', help="latent mode: render 4-channel stable diffusion latents at --h x --w (64 x 64) and feed them to the unet without the vae encoder, an rgb head is fine-tuned at the end of training")
+    parser.add_argument('--rgb_finetune_iters', type=int, default=1000, help="latent mode: iterations to fit the rgb head to the decoded latents after training (evaluations before that are not meaningful)")
     # rendering resolution in training, decrease this if CUDA OOM.
     parser.add_argument('--w', type=int, default=64, help="render width for NeRF in training")
     parser.add_argument('--h', type=int, default=64, help="render height for NeRF in training")
+    parser.add_argument('--batch_size', type=int, default=1, help="num of camera poses rendered & guided together in each training step")
+    parser.add_argument('--backward_chunk', type=int, default=0, help="if > 0, two-pass training: render without grad, then re-render & backward in chunks of this many rays, so memory does not grow with --h & --w")
     parser.add_argument('--jitter_pose', action='store_true', help="add jitters to the randomly sampled camera poses")
     
     ### dataset options
@@ -93,6 +119,23 @@ if __name__ == '__main__':
     if opt.albedo:
         opt.albedo_iters = opt.iters
 
+    if opt.latent:
+        assert opt.guidance != 'clip', '--latent requires a latent diffusion guidance (stable-diffusion or tiny)!'
+        # the gui trains without an end, the rgb head is only fitted at the end of Trainer.train
+        assert opt.test or not opt.gui or opt.rgb_finetune_iters <= 0, 'the training GUI does not run the rgb finetune stage of --latent, set --rgb_finetune_iters 0 or train without --gui!'
+
+    if len(opt.scenes) > 0:
+        # the samples of each scene must be evaluated in equally sized, scene-major groups.
+        assert opt.backbone == 'grid' and not opt.cuda_ray and not opt.occ_grid, 'multi-scene training requires --backbone grid without --cuda_ray and --occ_grid!'
+        assert not opt.sparse_grid_grad, 'multi-scene training does not support --sparse_grid_grad!'
+        assert opt.test or not opt.gui, 'the training GUI does not support multi-scene training!'
+        assert opt.cfg_cache_every <= 1, 'multi-scene training does not support --cfg_cache_every!'
+        opt.batch_size = len(opt.scenes) # one view per scene
+
+    if opt.cfg_cache_every > 1:
+        # the cache lives in the guidance model, the guidance server does not cache.
+        assert opt.guidance in ['stable-diffusion', 'tiny'], '--cfg_cache_every requires --guidance stable-diffusion or tiny!'
+
     if opt.backbone == 'vanilla':
         from nerf.network import NeRFNetwork
     elif opt.backbone == 'grid':
@@ -116,22 +159,36 @@ if __name__ == '__main__':
         trainer = Trainer('df', opt, model, guidance, device=device, workspace=opt.workspace, fp16=opt.fp16, use_checkpoint=opt.ckpt)
 
         if opt.gui:
+            if len(opt.scenes) > 0:
+                model.select_scene(0) # the gui shows the first scene
             gui = NeRFGUI(opt, trainer)
             gui.render()
         
+        elif len(opt.scenes) > 0:
+            test_loader = NeRFDataset(opt, device=device, type='test', H=opt.H, W=opt.W, size=100).dataloader()
+            for k in range(len(opt.scenes)):
+                model.select_scene(k)
+                trainer.test(test_loader, name=f'{trainer.name}_ep{trainer.epoch:04d}_scene{k}')
+
+                if opt.save_mesh:
+                    trainer.save_mesh(save_path=os.path.join(opt.workspace, 'mesh', f'scene{k}'), resolution=256, format=opt.mesh_format)
+
         else:
             test_loader = NeRFDataset(opt, device=device, type='test', H=opt.H, W=opt.W, size=100).dataloader()
             trainer.test(test_loader)
             
             if opt.save_mesh:
-                trainer.save_mesh(resolution=256)
+                trainer.save_mesh(resolution=256, format=opt.mesh_format)
             
     
     else:
         
         train_loader = NeRFDataset(opt, device=device, type='train', H=opt.h, W=opt.w, size=100).dataloader()
 
-        optimizer = lambda model: torch.optim.Adam(model.get_params(opt.lr), betas=(0.9, 0.99), eps=1e-15)
+        if opt.sparse_grid_grad:
+            optimizer = lambda model: LazyAdam(model.get_params(opt.lr), betas=(0.9, 0.99), eps=1e-15)
+        else:
+            optimizer = lambda model: torch.optim.Adam(model.get_params(opt.lr), betas=(0.9, 0.99), eps=1e-15)
         # optimizer = lambda model: Shampoo(model.get_params(opt.lr))
 
         scheduler = lambda optimizer: optim.lr_scheduler.LambdaLR(optimizer, lambda iter: 0.1 ** min(iter / opt.iters, 1))
@@ -139,10 +196,16 @@ if __name__ == '__main__':
 
         if opt.guidance == 'stable-diffusion':
             from nerf.sd import StableDiffusion
-            guidance = StableDiffusion(device)
+            guidance = StableDiffusion(device, cfg_cache_every=opt.cfg_cache_every, cfg_cache_buckets=opt.cfg_cache_buckets, memory_profile=opt.sd_profile)
         elif opt.guidance == 'clip':
             from nerf.clip import CLIP
             guidance = CLIP(device)
+        elif opt.guidance == 'tiny':
+            from nerf.tiny import TinyGuidance
+            guidance = TinyGuidance(device, channels=opt.tiny_channels, num_layers=opt.tiny_layers, resolution=opt.tiny_resolution, cfg_cache_every=opt.cfg_cache_every, cfg_cache_buckets=opt.cfg_cache_buckets)
+        elif opt.guidance == 'remote':
+            from nerf.guidance_server import RemoteGuidance
+            guidance = RemoteGuidance(device, opt.guidance_socket)
         else:
             raise NotImplementedError(f'--guidance {opt.guidance} is not implemented.')
 
@@ -153,7 +216,7 @@ if __name__ == '__main__':
         if not os.path.exists("visualizations/prompts"): os.makedirs("visualizations/prompts")
 
         # TODO: Fix prompt visualizations (wrong size, wrong RGB)
-        for i, text in enumerate(trainer.text):
+        for i, text in enumerate(trainer.text if len(opt.scenes) == 0 else []):
                 imgs = guidance.prompt_to_img(opt.text, opt.negative)
 
                 # Visualize image
@@ -0,0 +1,95 @@
+import torch
+
+# sparse classifier-free guidance: the unconditional noise prediction changes slowly during distillation,
+# so it is only recomputed every `every` steps (or when the timestep bucket changes), and otherwise reused per view (batch slot & direction).
+# a cached view only runs the conditional half of the unet batch.
+# each step draws new noise, and the sds gradient subtracts it: the residual (uncond pred - noise) is cached, and the current noise is added back.
+# (caching the prediction itself would add guidance_scale * (old noise - new noise) to the gradient.)
+
+def count_flops(fn, *args, **kwargs):
+    # measured flops of one call, None if the flop counter is not available (torch < 2.1)
+    try:
+        from torch.utils.flop_counter import FlopCounterMode
+    except ImportError:
+        return None
+    counter = FlopCounterMode(display=False)
+    with counter, torch.no_grad():
+        fn(*args, **kwargs)
+    return counter.get_total_flops()
+
+
+class CFGCache:
+    def __init__(self, every=0, num_buckets=4, num_train_timesteps=1000):
+        # every: recompute the unconditional prediction of a direction at least every k steps, <= 1 disables the cache.
+        # num_buckets: the timesteps are split into this many buckets, a cached prediction is only reused in its bucket.
+        self.every = every
+        self.num_buckets = num_buckets
+        self.num_train_timesteps = num_train_timesteps
+        self.entries = {} # (batch slot, direction) --> (iteration, bucket, unconditional noise pred - noise [1, 4, H, W])
+
+        self.flops_per_latent = None # of one unet forward on a single latent, measured at the first call if not set
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.flops_saved = 0
+
+    @property
+    def enabled(self):
+        return self.every > 1
+
+    def bucket(self, t):
+        return int(t) * self.num_buckets // self.num_train_timesteps
+
+    def lookup(self, key, t, iteration):
+        entry = self.entries.get(key, None)
+        if entry is None:
+            return None
+        last_iteration, bucket, residual = entry
+        if iteration - last_iteration >= self.every or bucket != self.bucket(t):
+            return None
+        return residual
+
+    def predict(self, unet, latents_noisy, noise, t, text_embeddings, keys, iteration):
+        # unet: callable (latents [M, 4, H, W], t [M], embeddings [M, 77, 768]) --> noise pred [M, 4, H, W]
+        # latents_noisy: [B, 4, H, W], noise: [B, 4, H, W] added to the latents, t: [B], text_embeddings: [2 * B, 77, 768] (uncond of all views, then cond of all views)
+        # keys: [B], hashable key of each view, e.g. (batch slot, direction), a key must not be shared by two views of a batch.
+        # return: noise_pred_uncond, noise_pred_text, [B, 4, H, W] each
+        B = latents_noisy.shape[0]
+
+        if not self.enabled:
+            noise_pred = unet(torch.cat([latents_noisy] * 2), torch.cat([t] * 2), text_embeddings)
+            return noise_pred.chunk(2)
+
+        # a key repeated in the batch is always missed, and only its first view writes the entry.
+        first = {}
+        for b in range(B):
+            first.setdefault(keys[b], b)
+        cached = [self.lookup(keys[b], t[b], iteration) if first[keys[b]] == b else None for b in range(B)]
+        miss = [b for b in range(B) if cached[b] is None]
+        cached = [None if c is None else c + noise[b:b+1] for b, c in enumerate(cached)] # residual --> prediction
+
+        if self.flops_per_latent is None:
+            self.flops_per_latent = count_flops(unet, latents_noisy[:1], t[:1], text_embeddings[B:B+1]) or 0
+
+        # unconditional half of the missed views only
+        inputs = torch.cat([latents_noisy[miss], latents_noisy])
+        noise_pred = unet(inputs, torch.cat([t[miss], t]), torch.cat([text_embeddings[:B][miss], text_embeddings[B:]]))
+        noise_pred_miss, noise_pred_text = noise_pred[:len(miss)], noise_pred[len(miss):]
+
+        for i, b in enumerate(miss):
+            cached[b] = noise_pred_miss[i:i+1]
+            if first[keys[b]] == b:
+                self.entries[keys[b]] = (iteration, self.bucket(t[b]), cached[b] - noise[b:b+1])
+
+        self.hits += B - len(miss)
+        self.misses += len(miss)
+        self.flops_saved += (B - len(miss)) * self.flops_per_latent
+
+        return torch.cat(cached, dim=0), noise_pred_text
+
+    def hit_ratio(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def report(self):
+        return f'[INFO] cfg cache: hit ratio = {self.hit_ratio():.3f} ({self.hits}/{self.hits + self.misses}), unet flops saved = {self.flops_saved / 1e12:.3f} TFLOPs'
@@ -12,6 +12,7 @@ class CLIP(nn.Module):
 
         self.device = device
 
+        self.text_encoder_id = "clip:ViT-B/16" # identifies the cached text embeddings
         self.clip_model, self.clip_preprocess = clip.load("ViT-B/16", device=self.device, jit=False)
         
          # image augmentation
@@ -23,6 +24,10 @@ class CLIP(nn.Module):
         # self.gaussian_blur = T.GaussianBlur(15, sigma=(0.1, 10))
 
     
+    @property
+    def text_encoder_dtype(self):
+        return self.clip_model.dtype
+
     def get_text_embeds(self, prompt, negative_prompt):
 
         # NOTE: negative_prompt is ignored for CLIP.
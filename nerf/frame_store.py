@@ -0,0 +1,130 @@
+import os
+import zlib
+import threading
+import numpy as np
+
+# append-only store of visualization frames, replaces one png file per (direction, kind, iteration).
+# each stream (direction, kind) is a folder with 3 files:
+#   frames.bin: zlib compressed uint8 [H, W, 3] frames, appended.
+#   thumbs.bin: the same frames, downsampled by `thumb_scale`.
+#   index.bin: one fixed-size record per frame (see INDEX_DTYPE), written after the data, so a reader never sees a partial frame.
+
+INDEX_DTYPE = np.dtype([
+    ('iteration', '<i8'),
+    ('offset', '<i8'), ('nbytes', '<i8'),
+    ('thumb_offset', '<i8'), ('thumb_nbytes', '<i8'),
+    ('height', '<i4'), ('width', '<i4'),
+    ('thumb_height', '<i4'), ('thumb_width', '<i4'),
+])
+
+
+def to_uint8(image):
+    # image: torch tensor [1, 3, H, W] or [3, H, W] in [0, 1] (same rounding as torchvision.utils.save_image), or uint8 numpy [H, W, 3]
+    if isinstance(image, np.ndarray):
+        return np.ascontiguousarray(image, dtype=np.uint8)
+    if image.dim() == 4:
+        image = image[0]
+    return image.detach().float().mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to('cpu').numpy().astype(np.uint8)
+
+
+def downsample(image, scale):
+    # image: uint8 [H, W, C], area downsample by an integer scale
+    if scale <= 1:
+        return image
+    H, W, C = image.shape
+    h, w = max(H // scale, 1), max(W // scale, 1)
+    image = image[:h * scale, :w * scale].reshape(h, scale, w, scale, C).mean(axis=(1, 3))
+    return (image + 0.5).astype(np.uint8)
+
+
+class FrameStore:
+    def __init__(self, root, thumb_scale=4, level=1):
+        # root: folder of the store, created if not exists.
+        # level: zlib compression level, low levels are much faster and still shrink the frames a lot.
+        self.root = root
+        self.thumb_scale = thumb_scale
+        self.level = level
+        self.writers = {} # (name, kind) --> [frames, thumbs, index] file handles
+        self.lock = threading.Lock()
+
+    def stream_path(self, name, kind):
+        return os.path.join(self.root, name, kind)
+
+    def append(self, name, kind, iteration, image):
+        # name: e.g. the view direction, kind: e.g. 'nerf', 'noisy', ...
+        image = to_uint8(image)
+        thumb = downsample(image, self.thumb_scale)
+
+        data = zlib.compress(image.tobytes(), self.level)
+        thumb_data = zlib.compress(thumb.tobytes(), self.level)
+
+        with self.lock:
+            if (name, kind) not in self.writers:
+                path = self.stream_path(name, kind)
+                os.makedirs(path, exist_ok=True)
+                self.writers[(name, kind)] = [open(os.path.join(path, f), 'ab') for f in ['frames.bin', 'thumbs.bin', 'index.bin']]
+            f_frames, f_thumbs, f_index = self.writers[(name, kind)]
+
+            record = np.zeros(1, dtype=INDEX_DTYPE)
+            record['iteration'] = iteration
+            record['offset'] = f_frames.tell()
+            record['nbytes'] = len(data)
+            record['thumb_offset'] = f_thumbs.tell()
+            record['thumb_nbytes'] = len(thumb_data)
+            record['height'], record['width'] = image.shape[:2]
+            record['thumb_height'], record['thumb_width'] = thumb.shape[:2]
+
+            f_frames.write(data)
+            f_thumbs.write(thumb_data)
+            f_frames.flush()
+            f_thumbs.flush()
+            f_index.write(record.tobytes())
+            f_index.flush()
+
+    def close(self):
+        with self.lock:
+            for files in self.writers.values():
+                for f in files:
+                    f.close()
+            self.writers = {}
+
+    ### reading
+
+    def streams(self):
+        # return: {name: [kind]}
+        results = {}
+        if not os.path.isdir(self.root):
+            return results
+        for name in sorted(os.listdir(self.root)):
+            if not os.path.isdir(os.path.join(self.root, name)):
+                continue
+            kinds = [kind for kind in sorted(os.listdir(os.path.join(self.root, name))) if os.path.exists(os.path.join(self.root, name, kind, 'index.bin'))]
+            if len(kinds) > 0:
+                results[name] = kinds
+        return results
+
+    def index(self, name, kind):
+        # return: structured array of INDEX_DTYPE, sorted by iteration
+        path = os.path.join(self.stream_path(name, kind), 'index.bin')
+        size = os.path.getsize(path) // INDEX_DTYPE.itemsize
+        index = np.fromfile(path, dtype=INDEX_DTYPE, count=size) # ignore a partially written record
+        return index[np.argsort(index['iteration'], kind='stable')]
+
+    def read(self, name, kind, stride=1, thumbnail=False, iterations=None):
+        # lazily read every `stride`-th frame (or the frames at the given iterations), only these frames are decompressed.
+        # return: list of N uint8 [H, W, 3] frames, iterations [N]
+        index = self.index(name, kind)
+        if iterations is not None:
+            index = index[np.isin(index['iteration'], iterations)]
+        else:
+            index = index[::stride]
+
+        prefix = 'thumb_' if thumbnail else ''
+        frames = []
+        with open(os.path.join(self.stream_path(name, kind), 'thumbs.bin' if thumbnail else 'frames.bin'), 'rb') as f:
+            for record in index:
+                f.seek(int(record[prefix + 'offset']))
+                data = zlib.decompress(f.read(int(record[prefix + 'nbytes'])))
+                frames.append(np.frombuffer(data, dtype=np.uint8).reshape(int(record[prefix + 'height']), int(record[prefix + 'width']), -1))
+
+        return frames, index['iteration']
@@ -251,7 +251,7 @@ class NeRFGUI:
                         dpg.add_text("Marching Cubes: ")
 
                         def callback_mesh(sender, app_data):
-                            self.trainer.save_mesh(resolution=256)
+                            self.trainer.save_mesh(resolution=256, format=self.opt.mesh_format)
                             dpg.set_value("_log_mesh", "saved " + f'{self.trainer.name}_{self.trainer.epoch}.ply')
                             self.trainer.epoch += 1 # use epoch to indicate different calls.
 
@@ -0,0 +1,358 @@
+import os
+import stat
+import time
+import queue
+import socket
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# a local guidance service: one process owns the guidance model (vae, text encoder & unet),
+# and serves the train steps of many trainers (`--guidance remote`) over a unix socket.
+# concurrent train steps are batched dynamically into one unet call, each view keeps its own timestep, embeddings & guidance scale.
+# the server backwards through the vae encoder, and returns the gradient w.r.t. the image (or the latents in latent mode).
+#
+#   python -m nerf.guidance_server --socket /tmp/stable-dreamfusion-guidance.sock --sd_profile fast
+#   python main.py --text "a hamburger" --workspace trial -O --guidance remote --guidance_socket /tmp/stable-dreamfusion-guidance.sock
+#
+# messages are (kind, payload) tuples of cpu tensors, replies are ('ok', payload) or ('error', message).
+# messages are pickled, so only clients with the per-run authkey are accepted: the server writes it to `<socket>.key` (mode 0600),
+# and the socket itself is only accessible by the owner.
+
+
+def authkey_path(socket_path):
+    return socket_path + '.key'
+
+
+def remove_stale_socket(socket_path):
+    # only a unix socket nobody is listening on (left by a crashed server) is removed, anything else is refused.
+    # without a live socket, the key file is stale too (a crash may leave it with or without the socket).
+    if os.path.lexists(socket_path):
+        if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            raise RuntimeError(f'{socket_path} exists and is not a unix socket, refusing to remove it.')
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(socket_path)
+            raise RuntimeError(f'a guidance server is already listening on {socket_path}')
+        except ConnectionRefusedError:
+            os.remove(socket_path)
+        finally:
+            s.close()
+
+    key_path = authkey_path(socket_path)
+    if os.path.isfile(key_path) and not os.path.islink(key_path):
+        os.remove(key_path)
+
+
+def batched_train_step(guidance, requests):
+    # requests: list of dicts:
+    #   pred: [B, 3, H, W] images in [0, 1], or [B, 4, h, w] latents
+    #   text_embeddings: [2, 77, 768] shared by all views, or [2 * B, 77, 768] (uncond of all views, then cond of all views)
+    #   guidance_scale: float
+    # return: gradients of the preds, same shapes (cpu)
+    device = guidance.device
+    resolution = getattr(guidance, 'resolution', 512)
+
+    preds = [r['pred'].to(device).float().requires_grad_(True) for r in requests]
+    sizes = [pred.shape[0] for pred in preds]
+
+    # encode the images of all requests in one vae call, requires grad!
+    with torch.enable_grad():
+        latents = [None] * len(preds)
+        rgb = [i for i, pred in enumerate(preds) if pred.shape[1] == 3]
+        if len(rgb) > 0:
+            imgs = torch.cat([F.interpolate(preds[i], (resolution, resolution), mode='bilinear', align_corners=False) for i in rgb], dim=0)
+            for i, l in zip(rgb, guidance.encode_imgs(imgs).split([sizes[i] for i in rgb], dim=0)):
+                latents[i] = l
+        for i, pred in enumerate(preds):
+            if latents[i] is None:
+                latents[i] = pred # latent mode
+        latents = torch.cat(latents, dim=0) # [N, 4, 64, 64]
+
+    N = latents.shape[0]
+    t = torch.randint(guidance.min_step, guidance.max_step + 1, [N], dtype=torch.long, device=device)
+
+    uncond, cond, scales = [], [], []
+    for r, B in zip(requests, sizes):
+        text_embeddings = r['text_embeddings'].to(device)
+        if text_embeddings.shape[0] != 2 * B:
+            text_embeddings = text_embeddings.repeat_interleave(B, dim=0)
+        uncond.append(text_embeddings[:B])
+        cond.append(text_embeddings[B:])
+        scales += [r['guidance_scale']] * B
+    text_embeddings = torch.cat(uncond + cond, dim=0) # [2 * N, 77, 768]
+    scales = torch.tensor(scales, dtype=torch.float32, device=device).view(N, 1, 1, 1)
+
+    with torch.no_grad():
+        noise = torch.randn_like(latents)
+        latents_noisy = guidance.add_noise(latents.detach(), noise, t)
+        noise_pred = guidance.unet_forward(torch.cat([latents_noisy] * 2), torch.cat([t] * 2), text_embeddings)
+
+    noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+    noise_pred = noise_pred_uncond + scales * (noise_pred_text - noise_pred_uncond)
+
+    # w(t), sigma_t^2
+    w = (1 - guidance.alphas[t]).view(N, 1, 1, 1)
+    grad = torch.nan_to_num(w * (noise_pred - noise))
+
+    latents.backward(gradient=grad)
+
+    return [pred.grad.cpu() for pred in preds]
+
+
+class GuidanceServer:
+    def __init__(self, guidance, socket_path, max_batch=8, max_wait=0.005):
+        # max_batch: max num of views in one unet call (x2 with guidance)
+        # max_wait: seconds to wait for more train steps once one arrived
+        self.guidance = guidance
+        self.socket_path = socket_path
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue() # (conn, kind, payload)
+
+        # statistics
+        self.num_batches = 0
+        self.num_views = 0
+        self.num_steps = 0
+
+    def serve(self):
+        remove_stale_socket(self.socket_path)
+
+        # per-run authkey, readable by the owner only (fails if the key file exists)
+        authkey = os.urandom(32)
+        key_path = authkey_path(self.socket_path)
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(authkey)
+
+        try:
+            listener = Listener(self.socket_path, family='AF_UNIX', authkey=authkey)
+            os.chmod(self.socket_path, 0o600)
+            print(f'[INFO] guidance server listening on {self.socket_path}')
+
+            threading.Thread(target=self.accept, args=(listener,), daemon=True).start()
+
+            try:
+                self.run()
+            finally:
+                listener.close()
+                if os.path.exists(self.socket_path):
+                    os.remove(self.socket_path)
+        finally:
+            os.remove(key_path)
+
+    def accept(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, EOFError, ConnectionError) as e:
+                print(f'[WARN] guidance server: rejected a connection ({type(e).__name__}: {e})')
+                continue
+            threading.Thread(target=self.read, args=(conn,), daemon=True).start()
+
+    def read(self, conn):
+        # one reader thread per client, all the work is done by `run`.
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                conn.close() # the client is gone
+                return
+            except Exception as e:
+                # the message was received whole but cannot be unpickled, the client waits for a reply.
+                self.reply(conn, ('error', f'{type(e).__name__}: {e}'))
+                continue
+            if not isinstance(message, tuple) or len(message) != 2:
+                self.reply(conn, ('error', 'ValueError: a message must be a (kind, payload) tuple'))
+                continue
+            kind, payload = message
+            self.requests.put((conn, kind, payload))
+
+    def reply(self, conn, result):
+        try:
+            conn.send(result)
+        except (EOFError, OSError):
+            pass # the client is gone
+        except Exception as e:
+            # the result cannot be pickled, the client still gets an answer
+            self.reply(conn, ('error', f'{type(e).__name__}: {e}'))
+
+    def run(self):
+        pending = []
+        _t = time.time()
+        while True:
+            conn, kind, payload = pending.pop(0) if len(pending) > 0 else self.requests.get()
+
+            if kind != 'train_step':
+                self.reply(conn, self.handle(kind, payload))
+                continue
+
+            error = self.validate(payload)
+            if error is not None:
+                self.reply(conn, ('error', error))
+                continue
+
+            # collect more train steps of the same shapes until the batch is full or max_wait is over.
+            batch = [(conn, payload)]
+            shape = self.batch_shape(payload)
+            num_views = payload['pred'].shape[0]
+            deadline = time.time() + self.max_wait
+            while num_views < self.max_batch:
+                try:
+                    item = self.requests.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item[1] == 'train_step':
+                    error = self.validate(item[2])
+                    if error is not None:
+                        self.reply(item[0], ('error', error))
+                        continue
+                if item[1] != 'train_step' or self.batch_shape(item[2]) != shape or num_views + item[2]['pred'].shape[0] > self.max_batch:
+                    pending.append(item)
+                    break
+                batch.append((item[0], item[2]))
+                num_views += item[2]['pred'].shape[0]
+
+            results = self.train_step([p for _, p in batch])
+
+            for (c, _), result in zip(batch, results):
+                self.reply(c, result)
+
+            self.num_batches += 1
+            self.num_views += num_views
+            self.num_steps += len(batch)
+            if time.time() - _t > 60:
+                print(f'[INFO] guidance server: {self.num_steps} steps in {self.num_batches} batches, {self.num_views / self.num_batches:.2f} views per batch')
+                _t = time.time()
+
+    def validate(self, payload):
+        # return: None if a train step request is well-formed, else the error message for its sender.
+        if not isinstance(payload, dict) or any(k not in payload for k in ['pred', 'text_embeddings', 'guidance_scale']):
+            return 'ValueError: a train step needs a dict of pred, text_embeddings & guidance_scale'
+        pred, text_embeddings = payload['pred'], payload['text_embeddings']
+        if not torch.is_tensor(pred) or pred.dim() != 4 or pred.shape[0] == 0 or pred.shape[1] not in [3, 4]:
+            return 'ValueError: pred must be [B, 3, H, W] images or [B, 4, h, w] latents'
+        if not torch.is_tensor(text_embeddings) or text_embeddings.dim() != 3 or text_embeddings.shape[0] not in [2, 2 * pred.shape[0]]:
+            return 'ValueError: text_embeddings must be [2, 77, C] or [2 * B, 77, C]'
+        if isinstance(payload['guidance_scale'], bool) or not isinstance(payload['guidance_scale'], (int, float)):
+            return 'ValueError: guidance_scale must be a number'
+        return None
+
+    def batch_shape(self, payload):
+        # only train steps with the same image (or latent) and embedding shapes are batched together
+        return payload['pred'].shape[1:], payload['text_embeddings'].shape[1:]
+
+    def train_step(self, payloads):
+        # return: one reply per request, a failed batch is retried per request so an error is only sent to its sender.
+        try:
+            return [('ok', g) for g in batched_train_step(self.guidance, payloads)]
+        except Exception as e:
+            if len(payloads) == 1:
+                return [('error', f'{type(e).__name__}: {e}')]
+            return [self.train_step([p])[0] for p in payloads]
+
+    def handle(self, kind, payload):
+        guidance = self.guidance
+        try:
+            with torch.no_grad():
+                if kind == 'info':
+                    result = {'text_encoder_id': guidance.text_encoder_id, 'text_encoder_dtype': str(guidance.text_encoder_dtype)}
+                elif kind == 'get_text_embeds':
+                    result = guidance.get_text_embeds(*payload).cpu()
+                elif kind == 'encode_imgs':
+                    result = guidance.encode_imgs(payload.to(guidance.device)).cpu()
+                elif kind == 'decode_latents':
+                    result = guidance.decode_latents(payload.to(guidance.device)).cpu()
+                elif kind == 'prompt_to_img':
+                    result = guidance.prompt_to_img(*payload)
+                else:
+                    raise NotImplementedError(f'unknown request {kind}')
+            return ('ok', result)
+        except Exception as e:
+            return ('error', f'{type(e).__name__}: {e}')
+
+
+class RemoteGuidance(nn.Module):
+    # client of a GuidanceServer, same interface as StableDiffusion.
+    def __init__(self, device, socket_path):
+        super().__init__()
+        self.device = device
+        self.socket_path = socket_path
+        with open(authkey_path(socket_path), 'rb') as f:
+            authkey = f.read()
+        self.conn = Client(socket_path, family='AF_UNIX', authkey=authkey)
+        info = self.call('info')
+        self.text_encoder_id = info['text_encoder_id']
+        self.text_encoder_dtype = info['text_encoder_dtype']
+        print(f'[INFO] connected to the guidance server at {socket_path}')
+
+    def call(self, kind, payload=None):
+        try:
+            self.conn.send((kind, payload))
+            status, result = self.conn.recv()
+        except (EOFError, OSError) as e:
+            raise RuntimeError(f'guidance server: connection lost ({type(e).__name__}: {e})') from e
+        if status != 'ok':
+            raise RuntimeError(f'guidance server: {result}')
+        return result
+
+    def get_text_embeds(self, prompt, negative_prompt):
+        return self.call('get_text_embeds', (prompt, negative_prompt)).to(self.device)
+
+    def train_step(self, text_embeddings, pred_rgb, iteration, d, guidance_scale=100):
+        # pred_rgb: [B, 3, H, W], or latents [B, 4, 64, 64] (latent mode)
+        grad = self.call('train_step', {
+            'pred': pred_rgb.detach().float().cpu(),
+            'text_embeddings': text_embeddings.detach().float().cpu(),
+            'guidance_scale': guidance_scale,
+        })
+
+        pred_rgb.backward(gradient=grad.to(pred_rgb.device, pred_rgb.dtype))
+
+        return 0 # dummy loss value
+
+    def encode_imgs(self, imgs):
+        # no grad, only used out of the sds loop
+        return self.call('encode_imgs', imgs.detach().float().cpu()).to(imgs.device)
+
+    def decode_latents(self, latents):
+        return self.call('decode_latents', latents.detach().float().cpu()).to(latents.device)
+
+    def prompt_to_img(self, prompts, negative_prompts='', height=512, width=512, num_inference_steps=50, guidance_scale=7.5, latents=None):
+        return self.call('prompt_to_img', (prompts, negative_prompts, height, width, num_inference_steps, guidance_scale, latents))
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', type=str, default='/tmp/stable-dreamfusion-guidance.sock', help="path of the unix socket")
+    parser.add_argument('--guidance', type=str, default='stable-diffusion', help='choose from [stable-diffusion, tiny]')
+    parser.add_argument('--sd_profile', type=str, default='default', choices=['default', 'fast', 'balanced', 'low-mem'], help="memory profile of stable diffusion, see nerf/sd.py")
+    parser.add_argument('--tiny_channels', type=int, default=64, help="--guidance tiny: channels of the denoiser")
+    parser.add_argument('--tiny_layers', type=int, default=4, help="--guidance tiny: conv layers of the denoiser")
+    parser.add_argument('--tiny_resolution', type=int, default=512, help="--guidance tiny: image resolution fed into the vae")
+    parser.add_argument('--max_batch', type=int, default=8, help="max num of views in one unet call")
+    parser.add_argument('--max_wait_ms', type=float, default=5, help="time to wait for more train steps to batch")
+    opt = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    if opt.guidance == 'stable-diffusion':
+        from nerf.sd import StableDiffusion
+        guidance = StableDiffusion(device, visualize=False, memory_profile=opt.sd_profile)
+    elif opt.guidance == 'tiny':
+        from nerf.tiny import TinyGuidance
+        guidance = TinyGuidance(device, channels=opt.tiny_channels, num_layers=opt.tiny_layers, resolution=opt.tiny_resolution)
+    else:
+        raise NotImplementedError(f'--guidance {opt.guidance} is not implemented.')
+
+    for p in guidance.parameters():
+        p.requires_grad = False
+
+    GuidanceServer(guidance, opt.socket, max_batch=opt.max_batch, max_wait=opt.max_wait_ms / 1000).serve()
@@ -0,0 +1,157 @@
+import os
+import json
+import struct
+import numpy as np
+
+# bulk mesh writers, all formatting is done on whole arrays instead of per-line writes.
+
+def format_rows(fmt, arr, chunk=1000000):
+    # fmt: per-row format string, e.g. 'v %.6f %.6f %.6f\n'
+    # arr: [N, C] array, C must match the number of fields in fmt.
+    # yield: formatted strings of (up to) chunk rows
+    arr = np.asarray(arr)
+    for head in range(0, arr.shape[0], chunk):
+        rows = arr[head:head + chunk]
+        yield (fmt * rows.shape[0]) % tuple(rows.ravel().tolist())
+
+
+def split_uv_seams(v, f, vt, ft):
+    # unify position and uv indices, so each vertex has exactly one uv (required by ply & glb).
+    # v: [N, 3], f: [M, 3], vt: [T, 2], ft: [M, 3]
+    # return: v [K, 3], vt [K, 2], f [M, 3]
+    pairs = np.stack([f.reshape(-1), ft.reshape(-1)], axis=-1) # [M * 3, 2]
+    pairs, inverse = np.unique(pairs, axis=0, return_inverse=True)
+    return v[pairs[:, 0]], vt[pairs[:, 1]], inverse.reshape(-1, 3)
+
+
+def write_obj(path, v, f, vt=None, ft=None, mtl_name=None, texture_name=None):
+    # v: [N, 3], f: [M, 3], vt: [T, 2], ft: [M, 3], 0-indexed
+    # mtl_name & texture_name: file names relative to the obj, the mtl file is written next to the obj.
+
+    with open(path, "w") as fp:
+        if mtl_name is not None:
+            fp.write(f'mtllib {mtl_name} \n')
+
+        for s in format_rows('v %.6f %.6f %.6f \n', v):
+            fp.write(s)
+
+        if vt is not None:
+            # obj uv origin is at the bottom-left corner
+            vt = np.stack([vt[:, 0], 1 - vt[:, 1]], axis=-1)
+            for s in format_rows('vt %.6f %.6f \n', vt):
+                fp.write(s)
+
+        if mtl_name is not None:
+            fp.write(f'usemtl mat0 \n')
+
+        if vt is not None:
+            faces = np.stack([f + 1, ft + 1], axis=-1).reshape(-1, 6) # [M, 6], interleaved v/vt
+            for s in format_rows('f %d/%d %d/%d %d/%d \n', faces):
+                fp.write(s)
+        else:
+            for s in format_rows('f %d %d %d \n', f + 1):
+                fp.write(s)
+
+    if mtl_name is not None:
+        with open(os.path.join(os.path.dirname(path), mtl_name), "w") as fp:
+            fp.write(f'newmtl mat0 \n')
+            fp.write(f'Ka 1.000000 1.000000 1.000000 \n')
+            fp.write(f'Kd 1.000000 1.000000 1.000000 \n')
+            fp.write(f'Ks 0.000000 0.000000 0.000000 \n')
+            fp.write(f'Tr 1.000000 \n')
+            fp.write(f'illum 1 \n')
+            fp.write(f'Ns 0.000000 \n')
+            if texture_name is not None:
+                fp.write(f'map_Kd {texture_name} \n')
+
+
+def write_ply(path, v, f, vt=None, texture_name=None):
+    # binary little endian ply, per-vertex uv stored as (s, t).
+    # v: [N, 3], f: [M, 3], vt: [N, 2] (see split_uv_seams)
+
+    vertex_dtype = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if vt is not None:
+        vertex_dtype += [('s', '<f4'), ('t', '<f4')]
+
+    vertices = np.empty(v.shape[0], dtype=vertex_dtype)
+    vertices['x'], vertices['y'], vertices['z'] = v[:, 0], v[:, 1], v[:, 2]
+    if vt is not None:
+        # same origin convention as obj
+        vertices['s'], vertices['t'] = vt[:, 0], 1 - vt[:, 1]
+
+    faces = np.empty(f.shape[0], dtype=[('n', 'u1'), ('indices', '<i4', (3,))])
+    faces['n'] = 3
+    faces['indices'] = f
+
+    header = ['ply', 'format binary_little_endian 1.0']
+    if texture_name is not None:
+        header.append(f'comment TextureFile {texture_name}')
+    header.append(f'element vertex {v.shape[0]}')
+    header += [f'property float {name}' for name, _ in vertex_dtype]
+    header.append(f'element face {f.shape[0]}')
+    header.append('property list uchar int vertex_indices')
+    header.append('end_header')
+
+    with open(path, 'wb') as fp:
+        fp.write(('\n'.join(header) + '\n').encode('ascii'))
+        fp.write(vertices.tobytes())
+        fp.write(faces.tobytes())
+
+
+def write_glb(path, v, f, vt=None, texture_png=None):
+    # binary glTF 2.0 with a single textured mesh.
+    # v: [N, 3], f: [M, 3], vt: [N, 2] (see split_uv_seams), texture_png: encoded png bytes, embedded in the file.
+
+    v = np.ascontiguousarray(v, dtype=np.float32)
+    f = np.ascontiguousarray(f, dtype=np.uint32)
+
+    blobs = [f.tobytes(), v.tobytes()]
+    if vt is not None:
+        # gltf uv origin is at the top-left corner, same as the rasterized texture.
+        blobs.append(np.ascontiguousarray(vt, dtype=np.float32).tobytes())
+        if texture_png is not None:
+            blobs.append(bytes(texture_png))
+
+    # pack buffer views, 4-byte aligned
+    buffer_views = []
+    binary = b''
+    for blob in blobs:
+        buffer_views.append({'buffer': 0, 'byteOffset': len(binary), 'byteLength': len(blob)})
+        binary += blob + b'\x00' * (-len(blob) % 4)
+    buffer_views[0]['target'] = 34963 # ELEMENT_ARRAY_BUFFER
+    for view in buffer_views[1:3]:
+        view['target'] = 34962 # ARRAY_BUFFER
+
+    accessors = [
+        {'bufferView': 0, 'componentType': 5125, 'count': int(f.size), 'type': 'SCALAR'}, # uint32
+        {'bufferView': 1, 'componentType': 5126, 'count': int(v.shape[0]), 'type': 'VEC3', 'min': v.min(axis=0).tolist(), 'max': v.max(axis=0).tolist()}, # float32
+    ]
+    attributes = {'POSITION': 1}
+    material = {'pbrMetallicRoughness': {'metallicFactor': 0.0, 'roughnessFactor': 1.0}, 'doubleSided': True}
+
+    gltf = {'asset': {'version': '2.0'}, 'scene': 0, 'scenes': [{'nodes': [0]}], 'nodes': [{'mesh': 0}]}
+
+    if vt is not None:
+        accessors.append({'bufferView': 2, 'componentType': 5126, 'count': int(vt.shape[0]), 'type': 'VEC2'})
+        attributes['TEXCOORD_0'] = 2
+        if texture_png is not None:
+            gltf['images'] = [{'bufferView': 3, 'mimeType': 'image/png'}]
+            gltf['samplers'] = [{'magFilter': 9729, 'minFilter': 9729, 'wrapS': 33071, 'wrapT': 33071}] # linear, clamp to edge
+            gltf['textures'] = [{'source': 0, 'sampler': 0}]
+            material['pbrMetallicRoughness']['baseColorTexture'] = {'index': 0}
+
+    gltf['meshes'] = [{'primitives': [{'attributes': attributes, 'indices': 0, 'material': 0}]}]
+    gltf['materials'] = [material]
+    gltf['accessors'] = accessors
+    gltf['bufferViews'] = buffer_views
+    gltf['buffers'] = [{'byteLength': len(binary)}]
+
+    content = json.dumps(gltf, separators=(',', ':')).encode('utf-8')
+    content += b' ' * (-len(content) % 4)
+
+    with open(path, 'wb') as fp:
+        fp.write(struct.pack('<III', 0x46546C67, 2, 12 + 8 + len(content) + 8 + len(binary))) # 'glTF', version, total length
+        fp.write(struct.pack('<II', len(content), 0x4E4F534A)) # 'JSON'
+        fp.write(content)
+        fp.write(struct.pack('<II', len(binary), 0x004E4942)) # 'BIN\0'
+        fp.write(binary)
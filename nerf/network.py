@@ -101,7 +101,11 @@ class NeRFNetwork(NeRFRenderer):
         self.num_layers = num_layers
         self.hidden_dim = hidden_dim
         self.encoder, self.in_dim = get_encoder(encoding, input_dim=3, multires=6)
-        self.sigma_net = MLP(self.in_dim, 4, hidden_dim, num_layers, bias=True, block=ResBlock)
+        self.sigma_net = MLP(self.in_dim, 1 + (self.latent_dim if self.latent else 3), hidden_dim, num_layers, bias=True, block=ResBlock)
+
+        # latent mode: rgb head, fine-tuned at the end of training
+        if self.latent:
+            self.rgb_net = MLP(self.in_dim, 3, hidden_dim, 2, bias=True)
 
         # background network
         if self.bg_radius > 0:
@@ -125,12 +129,12 @@ class NeRFNetwork(NeRFRenderer):
         # x: [N, 3], in [-bound, bound]
 
         # sigma
-        h = self.encoder(x, bound=self.bound)
+        enc = self.encoder(x, bound=self.bound)
 
-        h = self.sigma_net(h)
+        h = self.sigma_net(enc)
 
         sigma = trunc_exp(h[..., 0] + self.gaussian(x))
-        albedo = torch.sigmoid(h[..., 1:])
+        albedo = self.color_head(h[..., 1:], enc)
 
         return sigma, albedo
     
@@ -192,27 +196,34 @@ class NeRFNetwork(NeRFRenderer):
             # normal = torch.nan_to_num(normal)
             # normal = normal.detach()
 
-            # lambertian shading
-            lambertian = ratio + (1 - ratio) * (normal @ l).clamp(min=0) # [N,]
+            color = self.shade(albedo, normal, l, ratio=ratio, shading=shading)
 
-            if shading == 'textureless':
-                color = lambertian.unsqueeze(-1).repeat(1, 3)
-            elif shading == 'normal':
-                color = (normal + 1) / 2
-            else: # 'lambertian'
-                color = albedo * lambertian.unsqueeze(-1)
-            
         return sigma, color, normal
 
       
-    def density(self, x):
+    def density(self, x, calc_normal=False):
         # x: [N, 3], in [-bound, bound]
-        
-        sigma, albedo = self.common_forward(x)
-        
+        # calc_normal: also return the normal, computed from the same forward pass.
+
+        if not calc_normal:
+            sigma, albedo = self.common_forward(x)
+
+            return {
+                'sigma': sigma,
+                'albedo': albedo,
+            }
+
+        with torch.enable_grad():
+            x.requires_grad_(True)
+            sigma, albedo = self.common_forward(x)
+            # query gradient
+            normal = - torch.autograd.grad(torch.sum(sigma), x, create_graph=True)[0] # [N, 3]
+        normal = safe_normalize(normal)
+
         return {
             'sigma': sigma,
             'albedo': albedo,
+            'normal': normal,
         }
 
 
@@ -235,6 +246,9 @@ class NeRFNetwork(NeRFRenderer):
             {'params': self.sigma_net.parameters(), 'lr': lr},
         ]        
 
+        if self.latent:
+            params.append({'params': self.rgb_net.parameters(), 'lr': lr})
+
         if self.bg_radius > 0:
             # params.append({'params': self.encoder_bg.parameters(), 'lr': lr * 10})
             params.append({'params': self.bg_net.parameters(), 'lr': lr})
@@ -1,3 +1,4 @@
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -32,6 +33,55 @@ class MLP(nn.Module):
         return x
 
 
+class BatchedMLP(nn.Module):
+    # independent MLPs of `num_scenes` scenes (same layout as MLP), evaluated with one batched matmul per layer.
+    # inputs are scene-major: N / num_scenes consecutive rows of each scene, or only rows of `self.scene` if it is set.
+    def __init__(self, num_scenes, dim_in, dim_out, dim_hidden, num_layers, bias=True):
+        super().__init__()
+        self.num_scenes = num_scenes
+        self.dim_in = dim_in
+        self.dim_out = dim_out
+        self.dim_hidden = dim_hidden
+        self.num_layers = num_layers
+        self.scene = None # None: all scenes, or the index of the only evaluated scene
+
+        weights = []
+        biases = []
+        for l in range(num_layers):
+            fan_in = self.dim_in if l == 0 else self.dim_hidden
+            fan_out = self.dim_out if l == num_layers - 1 else self.dim_hidden
+            # same init as nn.Linear
+            bound = 1 / math.sqrt(fan_in)
+            weights.append(nn.Parameter(torch.empty(num_scenes, fan_in, fan_out).uniform_(-bound, bound)))
+            biases.append(nn.Parameter(torch.empty(num_scenes, 1, fan_out).uniform_(-bound, bound)) if bias else None)
+
+        self.weights = nn.ParameterList(weights)
+        self.biases = nn.ParameterList([b for b in biases if b is not None])
+        self.bias = bias
+
+    def forward(self, x):
+        # x: [..., dim_in], return: [..., dim_out]
+        prefix = x.shape[:-1]
+        if self.scene is None:
+            x = x.reshape(self.num_scenes, -1, self.dim_in) # [K, N / K, dim_in]
+            weights = self.weights
+            biases = self.biases
+        else:
+            x = x.reshape(1, -1, self.dim_in) # [1, N, dim_in]
+            weights = [w[self.scene:self.scene+1] for w in self.weights]
+            biases = [b[self.scene:self.scene+1] for b in self.biases]
+
+        for l in range(self.num_layers):
+            if self.bias:
+                x = torch.baddbmm(biases[l], x, weights[l])
+            else:
+                x = torch.bmm(x, weights[l])
+            if l != self.num_layers - 1:
+                x = F.relu(x, inplace=True)
+
+        return x.reshape(*prefix, self.dim_out)
+
+
 class NeRFNetwork(NeRFRenderer):
     def __init__(self, 
                  opt,
@@ -46,9 +96,16 @@ class NeRFNetwork(NeRFRenderer):
         self.num_layers = num_layers
         self.hidden_dim = hidden_dim
 
-        self.encoder, self.in_dim = get_encoder('tiledgrid', input_dim=3, log2_hashmap_size=16, desired_resolution=2048 * self.bound)
+        # multi-scene training: the networks of all scenes are stacked, see `select_scene`.
+        self.num_scenes = max(len(opt.scenes), 1)
 
-        self.sigma_net = MLP(self.in_dim, 4, hidden_dim, num_layers, bias=True)
+        self.encoder, self.in_dim = get_encoder('tiledgrid', input_dim=3, log2_hashmap_size=16, desired_resolution=2048 * self.bound, sparse_grad=opt.sparse_grid_grad, num_scenes=self.num_scenes)
+
+        self.sigma_net = self.make_mlp(self.in_dim, 1 + (self.latent_dim if self.latent else 3), hidden_dim, num_layers, bias=True)
+
+        # latent mode: rgb head, fine-tuned at the end of training
+        if self.latent:
+            self.rgb_net = self.make_mlp(self.in_dim, 3, hidden_dim, 2, bias=True)
 
         # background network
         if self.bg_radius > 0:
@@ -59,11 +116,25 @@ class NeRFNetwork(NeRFRenderer):
             # self.encoder_bg, self.in_dim_bg = get_encoder('tiledgrid', input_dim=2, num_levels=4, desired_resolution=2048)
             self.encoder_bg, self.in_dim_bg = get_encoder('frequency', input_dim=3, multires=4)
 
-            self.bg_net = MLP(self.in_dim_bg, 3, hidden_dim_bg, num_layers_bg, bias=True)
+            self.bg_net = self.make_mlp(self.in_dim_bg, 3, hidden_dim_bg, num_layers_bg, bias=True)
             
         else:
             self.bg_net = None
 
+    def select_scene(self, scene=None):
+        # multi-scene: None to evaluate all scenes on scene-major points (training, the rays of each scene are rendered together),
+        # or the index of the only scene to evaluate (evaluation, test & export).
+        assert self.num_scenes > 1, 'select_scene is only for multi-scene training.'
+        for module in [self.encoder, self.sigma_net, self.bg_net, getattr(self, 'rgb_net', None)]:
+            if module is not None:
+                module.scene = scene
+
+    def make_mlp(self, *args, **kwargs):
+        # one MLP, or stacked MLPs of all scenes
+        if self.num_scenes > 1:
+            return BatchedMLP(self.num_scenes, *args, **kwargs)
+        return MLP(*args, **kwargs)
+
     # add a density blob to the scene center
     def gaussian(self, x):
         # x: [B, N, 3]
@@ -77,15 +148,54 @@ class NeRFNetwork(NeRFRenderer):
         # x: [N, 3], in [-bound, bound]
 
         # sigma
-        h = self.encoder(x, bound=self.bound)
+        enc = self.encoder(x, bound=self.bound)
 
-        h = self.sigma_net(h)
+        h = self.sigma_net(enc)
 
         sigma = trunc_exp(h[..., 0] + self.gaussian(x))
-        albedo = torch.sigmoid(h[..., 1:])
+        albedo = self.color_head(h[..., 1:], enc)
 
         return sigma, albedo
     
+    # analytic normal, the input gradient of the grid encoder (dy_dx) is chained through the MLP in a single forward & backward.
+    # if grad is enabled, the normal stays differentiable (double backward through the encoder) so normal-dependent losses still train the grid.
+    def analytic_normal(self, x):
+        # x: [..., 3]
+        create_graph = torch.is_grad_enabled()
+
+        # without grad (e.g. inference) only the input gradient is needed, the encoder skips the dense gradient of its embeddings.
+        # in training the same encoder node also backs the sigma & albedo losses, so the embedding gradient is still computed there.
+        self.encoder.input_grad_only = not create_graph
+        try:
+            with torch.enable_grad():
+                x = x.detach().requires_grad_(True)
+                sigma, albedo = self.common_forward(x)
+                normal = - torch.autograd.grad(sigma.sum(), x, create_graph=create_graph)[0]
+        finally:
+            self.encoder.input_grad_only = False
+
+        if not create_graph:
+            sigma, albedo, normal = sigma.detach(), albedo.detach(), normal.detach()
+
+        return sigma, albedo, normal
+
+    # 4-tap tetrahedral differences, one batched forward of 4N points.
+    def tetrahedral_normal(self, x, epsilon=1e-2):
+        # x: [..., 3]
+        k = torch.tensor([[1, -1, -1], [-1, -1, 1], [-1, 1, -1], [1, 1, 1]], dtype=x.dtype, device=x.device) # [4, 3]
+
+        prefix = x.shape[:-1]
+        x = x.reshape(-1, 3) # [N, 3]
+        
+        # the 4 taps of each point are adjacent, so the points keep their order (scene-major in multi-scene training).
+        xs = (x[:, None, :] + epsilon * k[None, :, :]).clamp(-self.bound, self.bound) # [N, 4, 3]
+        sigmas, _ = self.common_forward(xs.view(-1, 3))
+        sigmas = sigmas.view(-1, 4) # [N, 4]
+
+        normal = (k[None, :, :] * sigmas[..., None]).sum(1) / (4 * epsilon)
+
+        return -normal.view(*prefix, 3)
+
     # ref: https://github.com/zhaofuq/Instant-NSR/blob/main/nerf/network_sdf.py#L192
     def finite_difference_normal(self, x, epsilon=1e-2):
         # x: [N, 3]
@@ -105,12 +215,29 @@ class NeRFNetwork(NeRFRenderer):
         return -normal
 
 
-    def normal(self, x):
+    def common_forward_with_normal(self, x):
+        # x: [N, 3]
+        # return: sigma, albedo and the normalized normal, the analytic mode shares one forward pass.
+
+        if self.opt.normal_mode == 'analytic':
+            sigma, albedo, normal = self.analytic_normal(x)
+        else:
+            sigma, albedo = self.common_forward(x)
+            if self.opt.normal_mode == 'tetrahedral':
+                normal = self.tetrahedral_normal(x)
+            else:
+                normal = self.finite_difference_normal(x)
 
-        normal = self.finite_difference_normal(x)
         normal = safe_normalize(normal)
         normal = torch.nan_to_num(normal)
 
+        return sigma, albedo, normal
+
+
+    def normal(self, x):
+
+        _, _, normal = self.common_forward_with_normal(x)
+
         return normal
 
     
@@ -128,32 +255,32 @@ class NeRFNetwork(NeRFRenderer):
         else:
             # query normal
 
-            sigma, albedo = self.common_forward(x)
-            normal = self.normal(x)
+            sigma, albedo, normal = self.common_forward_with_normal(x)
 
-            # lambertian shading
-            lambertian = ratio + (1 - ratio) * (normal @ l).clamp(min=0) # [N,]
+            color = self.shade(albedo, normal, l, ratio=ratio, shading=shading)
 
-            if shading == 'textureless':
-                color = lambertian.unsqueeze(-1).repeat(1, 3)
-            elif shading == 'normal':
-                color = (normal + 1) / 2
-            else: # 'lambertian'
-                color = albedo * lambertian.unsqueeze(-1)
-            
         return sigma, color, normal
 
       
-    def density(self, x):
+    def density(self, x, calc_normal=False):
         # x: [N, 3], in [-bound, bound]
+        # calc_normal: also return the normal.
         
-        sigma, albedo = self.common_forward(x)
-        
-        return {
+        if calc_normal:
+            sigma, albedo, normal = self.common_forward_with_normal(x)
+        else:
+            sigma, albedo = self.common_forward(x)
+
+        outputs = {
             'sigma': sigma,
             'albedo': albedo,
         }
 
+        if calc_normal:
+            outputs['normal'] = normal
+        
+        return outputs
+
 
     def background(self, d):
 
@@ -174,6 +301,9 @@ class NeRFNetwork(NeRFRenderer):
             {'params': self.sigma_net.parameters(), 'lr': lr},
         ]        
 
+        if self.latent:
+            params.append({'params': self.rgb_net.parameters(), 'lr': lr})
+
         if self.bg_radius > 0:
             params.append({'params': self.encoder_bg.parameters(), 'lr': lr * 10})
             params.append({'params': self.bg_net.parameters(), 'lr': lr})
@@ -201,7 +201,7 @@ class NeRFDataset:
 
     def collate(self, index):
 
-        B = len(index) # always 1
+        B = len(index) # --batch_size views in training, 1 otherwise
 
         if self.training:
             # random pose on the fly
@@ -237,5 +237,8 @@ class NeRFDataset:
 
 
     def dataloader(self):
-        loader = DataLoader(list(range(self.size)), batch_size=1, collate_fn=self.collate, shuffle=self.training, num_workers=0)
+        batch_size = self.opt.batch_size if self.training else 1
+        # multi-scene training renders exactly one view per scene
+        drop_last = self.training and len(self.opt.scenes) > 0
+        loader = DataLoader(list(range(self.size)), batch_size=batch_size, collate_fn=self.collate, shuffle=self.training, num_workers=0, drop_last=drop_last)
         return loader
\ No newline at end of file
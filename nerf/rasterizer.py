@@ -0,0 +1,79 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# a cpu replacement of nvdiffrast's rasterize & interpolate, only for rasterizing meshes in uv space (texture baking).
+
+def rasterize_uv(uv, faces, h, w, tile=256, num_workers=None):
+    # uv: [N, 2], in [0, 1], pixel (i, j) is sampled at uv = ((j + 0.5) / w, (i + 0.5) / h), same as nvdiffrast with uv * 2 - 1 as clip coords.
+    # faces: [M, 3]
+    # return: triangle id [h, w] (int64, -1 for empty pixels), barycentric coords [h, w, 3] (float32)
+
+    # to pixel space, pixel centers are at integer coords
+    uv = uv.astype(np.float64) * np.array([w, h], dtype=np.float64) - 0.5
+    tris = uv[faces] # [M, 3, 2]
+    A, B, C = tris[:, 0], tris[:, 1], tris[:, 2] # [M, 2]
+
+    denom = (B[:, 1] - C[:, 1]) * (A[:, 0] - C[:, 0]) + (C[:, 0] - B[:, 0]) * (A[:, 1] - C[:, 1]) # [M]
+
+    # pixel bounding box of each triangle, inclusive
+    x0 = np.ceil(tris[..., 0].min(1)).astype(np.int64)
+    x1 = np.floor(tris[..., 0].max(1)).astype(np.int64)
+    y0 = np.ceil(tris[..., 1].min(1)).astype(np.int64)
+    y1 = np.floor(tris[..., 1].max(1)).astype(np.int64)
+    valid = (denom != 0) & (x0 <= x1) & (y0 <= y1)
+
+    tri_ids = np.full((h, w), -1, dtype=np.int64)
+    barys = np.zeros((h, w, 3), dtype=np.float32)
+
+    def rasterize_tile(ty0, tx0):
+        ty1, tx1 = min(ty0 + tile, h) - 1, min(tx0 + tile, w) - 1
+
+        # triangles overlapping this tile, with bbox clipped to the tile
+        ids = np.nonzero(valid & (x0 <= tx1) & (x1 >= tx0) & (y0 <= ty1) & (y1 >= ty0))[0]
+        if len(ids) == 0:
+            return
+        bx0, bx1 = np.maximum(x0[ids], tx0), np.minimum(x1[ids], tx1)
+        by0, by1 = np.maximum(y0[ids], ty0), np.minimum(y1[ids], ty1)
+        bw = bx1 - bx0 + 1
+        counts = bw * (by1 - by0 + 1)
+
+        # expand each triangle to its candidate pixels
+        tid = np.repeat(ids, counts) # [P]
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        bw = np.repeat(bw, counts)
+        px = np.repeat(bx0, counts) + k % bw
+        py = np.repeat(by0, counts) + k // bw
+
+        # barycentric coords
+        dx = px - C[tid, 0]
+        dy = py - C[tid, 1]
+        l0 = ((B[tid, 1] - C[tid, 1]) * dx + (C[tid, 0] - B[tid, 0]) * dy) / denom[tid]
+        l1 = ((C[tid, 1] - A[tid, 1]) * dx + (A[tid, 0] - C[tid, 0]) * dy) / denom[tid]
+        l2 = 1 - l0 - l1
+
+        eps = 1e-8
+        inside = (l0 >= -eps) & (l1 >= -eps) & (l2 >= -eps)
+
+        py, px = py[inside], px[inside]
+        tri_ids[py, px] = tid[inside]
+        barys[py, px] = np.stack([l0[inside], l1[inside], l2[inside]], axis=-1)
+
+    # tiles write to disjoint pixels, numpy releases the GIL for most of the work.
+    with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count()) as executor:
+        futures = [executor.submit(rasterize_tile, ty0, tx0) for ty0 in range(0, h, tile) for tx0 in range(0, w, tile)]
+        for future in futures:
+            future.result()
+
+    return tri_ids, barys
+
+
+def interpolate_uv(attr, faces, tri_ids, barys):
+    # attr: [N, C], per-vertex attributes, faces: [M, 3]
+    # tri_ids: [h, w], barys: [h, w, 3] from rasterize_uv
+    # return: [h, w, C], zero for empty pixels
+    mask = tri_ids >= 0
+    out = np.zeros(tri_ids.shape + (attr.shape[-1],), dtype=np.float32)
+    corners = attr[faces[tri_ids[mask]]] # [P, 3, C]
+    out[mask] = (corners * barys[mask][..., None]).sum(1)
+    return out
@@ -11,6 +11,13 @@ import torch.nn.functional as F
 import mcubes
 import raymarching
 from .utils import custom_meshgrid, safe_normalize
+from .mesh_io import write_obj, write_ply, write_glb, split_uv_seams
+
+def count_bits(x):
+    # x: uint8 tensor (e.g. a density bitfield)
+    # return: number of set bits, int
+    table = torch.tensor([bin(i).count('1') for i in range(256)], dtype=torch.int64, device=x.device)
+    return table[x.long()].sum().item()
 
 def sample_pdf(bins, weights, n_samples, det=False):
     # This implementation is from NeRF
@@ -99,6 +106,17 @@ class NeRFRenderer(nn.Module):
         self.min_near = opt.min_near
         self.density_thresh = opt.density_thresh
         self.bg_radius = opt.bg_radius
+        # incremental grid update: number of cells queried per cascade at each update, and number of full sweeps at the beginning.
+        self.grid_budget = opt.grid_budget
+        self.grid_warmup = opt.grid_warmup
+        # deferred shading: composite albedo first, then query one normal per ray (at the expected depth, or the top-k weighted samples).
+        self.deferred_shading = opt.deferred_shading
+        self.deferred_topk = opt.deferred_topk
+        # latent mode: the density network outputs 4-channel stable diffusion latents instead of rgb (rendered at 1/8 resolution),
+        # an rgb head (`rgb_net`, defined by the backbone) is fine-tuned at the end for evaluation & export.
+        self.latent = opt.latent
+        self.latent_dim = 4
+        self.rgb_finetune = False
 
         # prepare aabb with a 6D tensor (xmin, ymin, zmin, xmax, ymax, zmax)
         # NOTE: aabb (can be rectangular) is only used to generate points, we still rely on bound (always cubic) to calculate density grid and hashing.
@@ -114,63 +132,349 @@ class NeRFRenderer(nn.Module):
             density_bitfield = torch.zeros(self.cascade * self.grid_size ** 3 // 8, dtype=torch.uint8) # [CAS * H * H * H // 8]
             self.register_buffer('density_grid', density_grid)
             self.register_buffer('density_bitfield', density_bitfield)
+            # number of updates since each cell was last queried, used to decay cells skipped by incremental updates
+            density_age = torch.zeros([self.cascade, self.grid_size ** 3], dtype=torch.int32) # [CAS, H * H * H]
+            self.register_buffer('density_age', density_age, persistent=False)
             self.mean_density = 0
             self.iter_density = 0
+            # occupancy statistics of the last update, ratio of occupied cells and ratio of flipped cells (relative to occupied cells)
+            self.occ_rate = 1
+            self.flip_rate = 1
             # step counter
             step_counter = torch.zeros(16, 2, dtype=torch.int32) # 16 is hardcoded for averaging...
             self.register_buffer('step_counter', step_counter)
             self.mean_count = 0
             self.local_step = 0
 
+        # extra state for occupancy grid accelerated sampling in pytorch raymarching
+        self.occ_grid = opt.occ_grid and not self.cuda_ray
+        if self.occ_grid:
+            # a dense grid covering [-bound, bound]^3, all cells are occupied before the first update.
+            occ_density = torch.zeros([self.grid_size] * 3) # [H, H, H]
+            occ_mask = torch.ones([self.grid_size] * 3, dtype=torch.bool) # [H, H, H]
+            self.register_buffer('occ_density', occ_density)
+            self.register_buffer('occ_mask', occ_mask)
+            occ_age = torch.zeros([self.grid_size] * 3, dtype=torch.int32) # [H, H, H]
+            self.register_buffer('occ_age', occ_age, persistent=False)
+            self.mean_density = 0
+            self.iter_density = 0
+            self.occ_rate = 1
+            self.flip_rate = 1
+            # mean number of samples per ray skipped in the last rendering
+            self.skipped_samples = 0
+
     
     def forward(self, x, d):
         raise NotImplementedError()
 
-    def density(self, x):
+    def density(self, x, calc_normal=False):
         raise NotImplementedError()
 
     def color(self, x, d, mask=None, **kwargs):
         raise NotImplementedError()
 
+    @property
+    def color_mode(self):
+        # 'rgb', 'latent', or 'both' (latent & rgb concatenated, used to fine-tune the rgb head)
+        if not self.latent:
+            return 'rgb'
+        if self.rgb_finetune:
+            return 'both'
+        return 'latent' if self.training else 'rgb'
+
+    @property
+    def color_dim(self):
+        return {'rgb': 3, 'latent': self.latent_dim, 'both': self.latent_dim + 3}[self.color_mode]
+
+    def color_head(self, h, features):
+        # h: [N, 3 or 4], raw color outputs of the density network
+        # features: [N, C], input of the rgb head (only used in latent mode)
+        # return: [N, color_dim]
+
+        if not self.latent:
+            return torch.sigmoid(h)
+
+        if self.color_mode == 'latent':
+            return h
+
+        rgb = torch.sigmoid(self.rgb_net(features))
+        if self.color_mode == 'rgb':
+            return rgb
+
+        return torch.cat([h, rgb], dim=-1)
+
+    def composite_rays_train(self, sigmas, rgbs, deltas, rays, T_thresh):
+        # the kernels composite 3 channels, other numbers of channels are composited in groups of 3.
+        C = rgbs.shape[-1]
+        if C == 3:
+            return raymarching.composite_rays_train(sigmas, rgbs, deltas, rays, T_thresh)
+
+        images = []
+        for c in range(0, C, 3):
+            group = F.pad(rgbs[:, c:c+3], (0, max(0, c + 3 - C))).contiguous()
+            weights_sum, depth, image = raymarching.composite_rays_train(sigmas, group, deltas, rays, T_thresh)
+            images.append(image)
+
+        return weights_sum, depth, torch.cat(images, dim=-1)[:, :C]
+
+    def shade(self, albedo, normal, l, ratio=1, shading='albedo'):
+        # albedo: [N, 3], in [0, 1]
+        # normal: [N, 3], normalized, may be None if shading == 'albedo'
+        # l: [3] or [N, 3] (per point), plane light direction, nomalized in [-1, 1]
+        # ratio: scalar, ambient ratio, 1 == no shading (albedo only), 0 == only shading (textureless)
+
+        if shading == 'albedo':
+            return albedo
+
+        # lambertian shading
+        lambertian = ratio + (1 - ratio) * (normal * l).sum(-1).clamp(min=0) # [N,]
+
+        if shading == 'textureless':
+            color = lambertian.unsqueeze(-1).repeat(1, 3)
+        elif shading == 'normal':
+            color = (normal + 1) / 2
+        else: # 'lambertian'
+            color = albedo * lambertian.unsqueeze(-1)
+
+        return color
+
+    def ray_light_d(self, rays_o, light_d=None):
+        # rays_o: [B, N, 3]
+        # light_d: [3] (shared), [B, 3] (per view), or None to sample one per view.
+        # return: [3] if shared by all rays, else [B * N, 3]
+
+        rays_o = rays_o.reshape(rays_o.shape[0] if rays_o.dim() == 3 else 1, -1, 3)
+        B, N = rays_o.shape[:2]
+
+        # random sample light_d if not provided
+        if light_d is None:
+            # gaussian noise around the ray origin of each view, so the light always face the view dir (avoid dark face)
+            light_d = (rays_o[:, 0] + torch.randn(B, 3, device=rays_o.device, dtype=torch.float))
+            light_d = safe_normalize(light_d)
+
+        light_d = light_d.reshape(-1, 3)
+        if light_d.shape[0] == 1:
+            return light_d[0]
+
+        return light_d[:, None, :].expand(B, N, 3).reshape(-1, 3)
+
+    def deferred_shade(self, xyzs, image, weights_sum, rays_d, light_d, ratio=1, shading='lambertian', surface_weights=None):
+        # per-pixel shading of the composited albedo, the normal is only evaluated at a few points per ray.
+        # xyzs: [N, K, 3], surface points of each ray (K == 1 for the expected depth point)
+        # image: [N, 3], composited albedo, weights_sum: [N]
+        # surface_weights: [N, K], blending weights of the K normals, may be None if K == 1
+        # return: shaded image [N, 3], regularizations (dict)
+
+        N, K = xyzs.shape[:2]
+        xyzs = xyzs.detach().reshape(-1, 3)
+
+        normals = self.normal(xyzs).view(N, K, 3)
+        if K > 1:
+            normal = safe_normalize((surface_weights.unsqueeze(-1) * normals).sum(1)) # [N, 3]
+        else:
+            normal = normals[:, 0]
+
+        # image is premultiplied by weights_sum
+        ws = weights_sum.unsqueeze(-1)
+        albedo = image / ws.clamp(min=1e-5)
+        image = ws * self.shade(albedo, normal, light_d, ratio=ratio, shading=shading)
+
+        results = {}
+
+        # same regularizations as per-sample shading, on the reduced set of normals.
+        if self.training:
+            ws = weights_sum.detach()
+            loss_orient = ws * (normal * rays_d).sum(-1).clamp(min=0) ** 2
+            results['loss_orient'] = loss_orient.mean()
+
+            normals_perturb = self.normal(xyzs + torch.randn_like(xyzs) * 1e-2).view(N, K, 3)
+            loss_smooth = ws.view(N, 1, 1) * (normals - normals_perturb).abs()
+            results['loss_smooth'] = loss_smooth.mean()
+
+        return image, results
+
+    def occupancy(self, x):
+        # x: [..., 3], in [-bound, bound]
+        # return: [...], bool, whether the point lies in an occupied cell of the pytorch occupancy grid.
+
+        coords = ((x + self.bound) / (2 * self.bound) * self.grid_size).long().clamp(0, self.grid_size - 1)
+
+        return self.occ_mask[coords[..., 0], coords[..., 1], coords[..., 2]]
+
+    def masked_density(self, x, mask=None, calc_normal=False):
+        # x: [M, 3], in [-bound, bound]
+        # mask: [M], bool, only query the network on the masked points, others are treated as empty space.
+
+        if mask is None:
+            return self.density(x, calc_normal=calc_normal)
+
+        M = x.shape[0]
+        inds = torch.nonzero(mask, as_tuple=False).squeeze(-1)
+
+        if inds.shape[0] == 0:
+            outputs = {
+                'sigma': x.new_zeros(M),
+                'albedo': x.new_zeros(M, self.color_dim),
+            }
+            if calc_normal:
+                outputs['normal'] = x.new_zeros(M, 3)
+            return outputs
+
+        outputs = self.density(x[inds], calc_normal=calc_normal)
+        for k, v in outputs.items():
+            outputs[k] = v.new_zeros((M,) + v.shape[1:]).index_put((inds,), v)
+
+        return outputs
+
     def reset_extra_state(self):
+        if self.occ_grid:
+            self.occ_density.zero_()
+            self.occ_mask.fill_(True)
+            self.occ_age.zero_()
+            self.mean_density = 0
+            self.iter_density = 0
+            self.occ_rate = 1
+            self.flip_rate = 1
+            return
+
         if not self.cuda_ray:
             return 
         # density grid
         self.density_grid.zero_()
+        self.density_age.zero_()
         self.mean_density = 0
         self.iter_density = 0
+        self.occ_rate = 1
+        self.flip_rate = 1
         # step counter
         self.step_counter.zero_()
         self.mean_count = 0
         self.local_step = 0
 
     @torch.no_grad()
-    def export_mesh(self, path, resolution=None, S=128):
+    def coarse_occupancy(self, resolution, density_thresh, S=128):
+        # return: [G, G, G] bool numpy array, cells (uniformly dividing [-1, 1]^3) that may contain the iso-surface.
+
+        # the density grid is free if it covers [-1, 1]^3 (cascade 0).
+        if self.cuda_ray and self.bound >= 1:
+            H = self.grid_size
+            X = torch.arange(H, dtype=torch.int32, device=self.aabb_train.device)
+            xx, yy, zz = custom_meshgrid(X, X, X)
+            coords = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [H^3, 3]
+            indices = raymarching.morton3D(coords).long() # [H^3]
+            occ = (self.density_grid[0, indices] > density_thresh).reshape(H, H, H)
+            return occ.cpu().numpy()
+
+        # else a coarse pre-pass, cells with a sign change between its 8 corners.
+        G = max(resolution // 4, 2)
+        sigmas = np.zeros([G, G, G], dtype=np.float32)
+
+        X = torch.linspace(-1, 1, G).split(S)
+        Y = torch.linspace(-1, 1, G).split(S)
+        Z = torch.linspace(-1, 1, G).split(S)
+
+        for xi, xs in enumerate(X):
+            for yi, ys in enumerate(Y):
+                for zi, zs in enumerate(Z):
+                    xx, yy, zz = custom_meshgrid(xs, ys, zs)
+                    pts = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [S, 3]
+                    val = self.density(pts.to(self.aabb_train.device))
+                    sigmas[xi * S: xi * S + len(xs), yi * S: yi * S + len(ys), zi * S: zi * S + len(zs)] = val['sigma'].reshape(len(xs), len(ys), len(zs)).detach().cpu().numpy()
+
+        above = sigmas > density_thresh
+        corners = [above[i:G-1+i, j:G-1+j, k:G-1+k] for i in (0, 1) for j in (0, 1) for k in (0, 1)]
+        occ = np.logical_or.reduce(corners) & ~np.logical_and.reduce(corners) # [G-1, G-1, G-1]
+
+        return occ
+
+
+    @torch.no_grad()
+    def sparse_marching_cubes(self, resolution, density_thresh, block_size=32, S=128):
+        # run marching cubes only inside the blocks of the [resolution]^3 lattice that may contain the iso-surface.
+        # return: vertices [N, 3] in lattice coordinates [0, resolution - 1], triangles [M, 3]
+
+        occ = self.coarse_occupancy(resolution, density_thresh, S=S)
+        G = occ.shape[0]
+
+        # blocks share their boundary lattice points, so each cell belongs to exactly one block.
+        lattice = torch.linspace(-1, 1, resolution)
+        ranges = [(i, min(i + block_size, resolution - 1)) for i in range(0, resolution - 1, block_size)]
+        # coarse cells covering each block, with one cell of margin
+        coarse_ranges = [(max(int(a / (resolution - 1) * G) - 1, 0), min(int(b / (resolution - 1) * G) + 2, G)) for a, b in ranges]
+
+        all_vertices = []
+        all_triangles = []
+        num_vertices = 0
+        num_blocks = 0
+
+        for (x0, x1), (cx0, cx1) in zip(ranges, coarse_ranges):
+            for (y0, y1), (cy0, cy1) in zip(ranges, coarse_ranges):
+                for (z0, z1), (cz0, cz1) in zip(ranges, coarse_ranges):
+
+                    if not occ[cx0:cx1, cy0:cy1, cz0:cz1].any():
+                        continue
+                    num_blocks += 1
+
+                    xs, ys, zs = lattice[x0:x1+1], lattice[y0:y1+1], lattice[z0:z1+1]
+                    xx, yy, zz = custom_meshgrid(xs, ys, zs)
+                    pts = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [B^3, 3]
+                    val = self.density(pts.to(self.aabb_train.device))
+                    sigmas = val['sigma'].reshape(len(xs), len(ys), len(zs)).detach().float().cpu().numpy()
+
+                    vertices, triangles = mcubes.marching_cubes(sigmas, density_thresh)
+                    if len(triangles) == 0:
+                        continue
+
+                    all_vertices.append(vertices + np.array([x0, y0, z0], dtype=vertices.dtype))
+                    all_triangles.append(triangles + num_vertices)
+                    num_vertices += len(vertices)
+
+        print(f'[INFO] sparse marching cubes: evaluated {num_blocks}/{len(ranges) ** 3} blocks')
+
+        if num_vertices == 0:
+            return np.zeros([0, 3], dtype=np.float32), np.zeros([0, 3], dtype=np.int32)
+
+        vertices = np.concatenate(all_vertices, axis=0)
+        triangles = np.concatenate(all_triangles, axis=0)
+
+        # stitch: vertices on block seams are produced by both blocks from the same lattice values, so they are identical.
+        vertices, inverse = np.unique(vertices, axis=0, return_inverse=True)
+        triangles = inverse.reshape(-1)[triangles]
+
+        return vertices, triangles
+
+
+    @torch.no_grad()
+    def export_mesh(self, path, resolution=None, S=128, sparse=True, format='obj'):
 
         if resolution is None:
             resolution = self.grid_size
 
-        if self.cuda_ray:
+        if self.cuda_ray or self.occ_grid:
             density_thresh = min(self.mean_density, self.density_thresh)
         else:
             density_thresh = self.density_thresh
 
-        sigmas = np.zeros([resolution, resolution, resolution], dtype=np.float32)
+        if sparse:
+            vertices, triangles = self.sparse_marching_cubes(resolution, density_thresh, S=S)
+        
+        else:
+            sigmas = np.zeros([resolution, resolution, resolution], dtype=np.float32)
 
-        # query
-        X = torch.linspace(-1, 1, resolution).split(S)
-        Y = torch.linspace(-1, 1, resolution).split(S)
-        Z = torch.linspace(-1, 1, resolution).split(S)
+            # query
+            X = torch.linspace(-1, 1, resolution).split(S)
+            Y = torch.linspace(-1, 1, resolution).split(S)
+            Z = torch.linspace(-1, 1, resolution).split(S)
 
-        for xi, xs in enumerate(X):
-            for yi, ys in enumerate(Y):
-                for zi, zs in enumerate(Z):
-                    xx, yy, zz = custom_meshgrid(xs, ys, zs)
-                    pts = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [S, 3]
-                    val = self.density(pts.to(self.aabb_train.device))
-                    sigmas[xi * S: xi * S + len(xs), yi * S: yi * S + len(ys), zi * S: zi * S + len(zs)] = val['sigma'].reshape(len(xs), len(ys), len(zs)).detach().cpu().numpy() # [S, 1] --> [x, y, z]
+            for xi, xs in enumerate(X):
+                for yi, ys in enumerate(Y):
+                    for zi, zs in enumerate(Z):
+                        xx, yy, zz = custom_meshgrid(xs, ys, zs)
+                        pts = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [S, 3]
+                        val = self.density(pts.to(self.aabb_train.device))
+                        sigmas[xi * S: xi * S + len(xs), yi * S: yi * S + len(ys), zi * S: zi * S + len(zs)] = val['sigma'].reshape(len(xs), len(ys), len(zs)).detach().cpu().numpy() # [S, 1] --> [x, y, z]
 
-        vertices, triangles = mcubes.marching_cubes(sigmas, density_thresh)
+            vertices, triangles = mcubes.marching_cubes(sigmas, density_thresh)
 
         vertices = vertices / (resolution - 1.0) * 2 - 1
         vertices = vertices.astype(np.float32)
@@ -183,7 +487,7 @@ class NeRFRenderer(nn.Module):
         # mesh.export(os.path.join(path, f'mesh.ply'))
 
         # texture?
-        def _export(v, f, h0=2048, w0=2048, ssaa=1, name=''):
+        def _export(v, f, h0=2048, w0=2048, ssaa=1, name='', dilation=3):
             # v, f: torch Tensor
             device = v.device
             v_np = v.cpu().numpy() # [N, 3]
@@ -193,11 +497,7 @@ class NeRFRenderer(nn.Module):
 
             # unwrap uvs
             import xatlas
-            import nvdiffrast.torch as dr
-            from sklearn.neighbors import NearestNeighbors
-            from scipy.ndimage import binary_dilation, binary_erosion
-
-            glctx = dr.RasterizeCudaContext()
+            from scipy.ndimage import distance_transform_edt
 
             atlas = xatlas.Atlas()
             atlas.add_mesh(v_np, f_np)
@@ -208,22 +508,36 @@ class NeRFRenderer(nn.Module):
 
             # vmapping, ft_np, vt_np = xatlas.parametrize(v_np, f_np) # [N], [M, 3], [N, 2]
 
-            vt = torch.from_numpy(vt_np.astype(np.float32)).float().to(device)
-            ft = torch.from_numpy(ft_np.astype(np.int64)).int().to(device)
-
-            # render uv maps
-            uv = vt * 2.0 - 1.0 # uvs to range [-1, 1]
-            uv = torch.cat((uv, torch.zeros_like(uv[..., :1]), torch.ones_like(uv[..., :1])), dim=-1) # [N, 4]
-
             if ssaa > 1:
                 h = int(h0 * ssaa)
                 w = int(w0 * ssaa)
             else:
                 h, w = h0, w0
 
-            rast, _ = dr.rasterize(glctx, uv.unsqueeze(0), ft, (h, w)) # [1, h, w, 4]
-            xyzs, _ = dr.interpolate(v.unsqueeze(0), rast, f) # [1, h, w, 3]
-            mask, _ = dr.interpolate(torch.ones_like(v[:, :1]).unsqueeze(0), rast, f) # [1, h, w, 1]
+            # render uv maps
+            if device.type == 'cuda':
+                import nvdiffrast.torch as dr
+
+                glctx = dr.RasterizeCudaContext()
+
+                vt = torch.from_numpy(vt_np.astype(np.float32)).float().to(device)
+                ft = torch.from_numpy(ft_np.astype(np.int64)).int().to(device)
+
+                uv = vt * 2.0 - 1.0 # uvs to range [-1, 1]
+                uv = torch.cat((uv, torch.zeros_like(uv[..., :1]), torch.ones_like(uv[..., :1])), dim=-1) # [N, 4]
+
+                rast, _ = dr.rasterize(glctx, uv.unsqueeze(0), ft, (h, w)) # [1, h, w, 4]
+                xyzs, _ = dr.interpolate(v.unsqueeze(0), rast, f) # [1, h, w, 3]
+                mask, _ = dr.interpolate(torch.ones_like(v[:, :1]).unsqueeze(0), rast, f) # [1, h, w, 1]
+            
+            # cpu fallback without nvdiffrast
+            else:
+                from .rasterizer import rasterize_uv, interpolate_uv
+
+                print(f'[INFO] rasterizing uv maps on cpu: {h}x{w}')
+                tri_ids, barys = rasterize_uv(vt_np, ft_np.astype(np.int64), h, w) # [h, w], [h, w, 3]
+                xyzs = torch.from_numpy(interpolate_uv(v_np, f_np.astype(np.int64), tri_ids, barys)).to(device) # [h, w, 3]
+                mask = torch.from_numpy(tri_ids >= 0).to(device) # [h, w]
 
             # masked query 
             xyzs = xyzs.view(-1, 3)
@@ -266,23 +580,18 @@ class NeRFRenderer(nn.Module):
             # alphas = alphas.cpu().numpy()
             # alphas = (alphas * 255).astype(np.uint8)
 
-            ### NN search as an antialiasing ...
+            ### NN fill as an antialiasing ...
+            # every empty texel copies its nearest valid texel (exact euclidean distance transform), within `dilation` texels (<= 0 to fill the whole atlas).
             mask = mask.cpu().numpy()
 
-            inpaint_region = binary_dilation(mask, iterations=3)
-            inpaint_region[mask] = 0
-
-            search_region = mask.copy()
-            not_search_region = binary_erosion(search_region, iterations=2)
-            search_region[not_search_region] = 0
-
-            search_coords = np.stack(np.nonzero(search_region), axis=-1)
-            inpaint_coords = np.stack(np.nonzero(inpaint_region), axis=-1)
+            if mask.any():
+                distances, indices = distance_transform_edt(~mask, return_indices=True) # [h, w], [2, h, w]
 
-            knn = NearestNeighbors(n_neighbors=1, algorithm='kd_tree').fit(search_coords)
-            _, indices = knn.kneighbors(inpaint_coords)
+                inpaint_region = ~mask
+                if dilation > 0:
+                    inpaint_region &= distances <= dilation
 
-            feats[tuple(inpaint_coords.T)] = feats[tuple(search_coords[indices[:, 0]].T)]
+                feats[inpaint_region] = feats[indices[0][inpaint_region], indices[1][inpaint_region]]
 
             # do ssaa after the NN search, in numpy
             feats = cv2.cvtColor(feats, cv2.COLOR_RGB2BGR)
@@ -292,47 +601,41 @@ class NeRFRenderer(nn.Module):
                 feats = cv2.resize(feats, (w0, h0), interpolation=cv2.INTER_LINEAR)
 
             # cv2.imwrite(os.path.join(path, f'alpha.png'), alphas)
-            cv2.imwrite(os.path.join(path, f'{name}albedo.png'), feats)
+            _, albedo_png = cv2.imencode('.png', feats)
 
-            # save obj (v, vt, f /)
-            obj_file = os.path.join(path, f'{name}mesh.obj')
-            mtl_file = os.path.join(path, f'{name}mesh.mtl')
-
-            print(f'[INFO] writing obj mesh to {obj_file}')
-            with open(obj_file, "w") as fp:
-                fp.write(f'mtllib {name}mesh.mtl \n')
-                
-                print(f'[INFO] writing vertices {v_np.shape}')
-                for v in v_np:
-                    fp.write(f'v {v[0]} {v[1]} {v[2]} \n')
+            if format == 'obj':
+                cv2.imwrite(os.path.join(path, f'{name}albedo.png'), feats)
+                obj_file = os.path.join(path, f'{name}mesh.obj')
+                print(f'[INFO] writing obj mesh to {obj_file}: v={v_np.shape} vt={vt_np.shape} f={f_np.shape}')
+                write_obj(obj_file, v_np, f_np, vt_np, ft_np, mtl_name=f'{name}mesh.mtl', texture_name=f'{name}albedo.png')
             
-                print(f'[INFO] writing vertices texture coords {vt_np.shape}')
-                for v in vt_np:
-                    fp.write(f'vt {v[0]} {1 - v[1]} \n') 
-
-                print(f'[INFO] writing faces {f_np.shape}')
-                fp.write(f'usemtl mat0 \n')
-                for i in range(len(f_np)):
-                    fp.write(f"f {f_np[i, 0] + 1}/{ft_np[i, 0] + 1} {f_np[i, 1] + 1}/{ft_np[i, 1] + 1} {f_np[i, 2] + 1}/{ft_np[i, 2] + 1} \n")
-
-            with open(mtl_file, "w") as fp:
-                fp.write(f'newmtl mat0 \n')
-                fp.write(f'Ka 1.000000 1.000000 1.000000 \n')
-                fp.write(f'Kd 1.000000 1.000000 1.000000 \n')
-                fp.write(f'Ks 0.000000 0.000000 0.000000 \n')
-                fp.write(f'Tr 1.000000 \n')
-                fp.write(f'illum 1 \n')
-                fp.write(f'Ns 0.000000 \n')
-                fp.write(f'map_Kd {name}albedo.png \n')
+            else:
+                # ply & glb only support one uv per vertex
+                v_split, vt_split, f_split = split_uv_seams(v_np, f_np, vt_np, ft_np)
+
+                if format == 'ply':
+                    cv2.imwrite(os.path.join(path, f'{name}albedo.png'), feats)
+                    ply_file = os.path.join(path, f'{name}mesh.ply')
+                    print(f'[INFO] writing ply mesh to {ply_file}: v={v_split.shape} f={f_split.shape}')
+                    write_ply(ply_file, v_split, f_split, vt_split, texture_name=f'{name}albedo.png')
+                
+                elif format == 'glb':
+                    glb_file = os.path.join(path, f'{name}mesh.glb')
+                    print(f'[INFO] writing glb mesh to {glb_file}: v={v_split.shape} f={f_split.shape}')
+                    write_glb(glb_file, v_split, f_split, vt_split, texture_png=albedo_png.tobytes())
+                
+                else:
+                    raise NotImplementedError(f'unknown mesh format: {format}')
 
         _export(v, f)
 
     def run(self, rays_o, rays_d, num_steps=128, upsample_steps=128, light_d=None, ambient_ratio=1.0, shading='albedo', bg_color=None, perturb=False, **kwargs):
-        # rays_o, rays_d: [B, N, 3], assumes B == 1
+        # rays_o, rays_d: [B, N, 3], B views are rendered together
         # bg_color: [BN, 3] in range [0, 1]
         # return: image: [B, N, 3], depth: [B, N]
 
         prefix = rays_o.shape[:-1]
+        light_d = self.ray_light_d(rays_o, light_d) # [3] or [BN, 3]
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
 
@@ -350,12 +653,6 @@ class NeRFRenderer(nn.Module):
         # fars.unsqueeze_(-1)
         nears, fars = near_far_from_bound(rays_o, rays_d, self.bound, type='sphere', min_near=self.min_near)
 
-        # random sample light_d if not provided
-        if light_d is None:
-            # gaussian noise around the ray origin, so the light always face the view dir (avoid dark face)
-            light_d = (rays_o[0] + torch.randn(3, device=device, dtype=torch.float))
-            light_d = safe_normalize(light_d)
-
         #print(f'nears = {nears.min().item()} ~ {nears.max().item()}, fars = {fars.min().item()} ~ {fars.max().item()}')
 
         z_vals = torch.linspace(0.0, 1.0, num_steps, device=device).unsqueeze(0) # [1, T]
@@ -374,8 +671,16 @@ class NeRFRenderer(nn.Module):
 
         #plot_pointcloud(xyzs.reshape(-1, 3).detach().cpu().numpy())
 
-        # query SDF and RGB
-        density_outputs = self.density(xyzs.reshape(-1, 3))
+        # skip samples in empty cells of the occupancy grid (they are treated as zero density)
+        if self.occ_grid and self.iter_density > 0:
+            occ = self.occupancy(xyzs) # [N, T]
+        else:
+            occ = None
+
+        # query SDF and RGB (and normal if shading), each sample is only evaluated once, the outputs are reused for compositing.
+        deferred = self.deferred_shading and shading in ['lambertian', 'textureless']
+        calc_normal = shading != 'albedo' and not deferred
+        density_outputs = self.masked_density(xyzs.reshape(-1, 3), None if occ is None else occ.view(-1), calc_normal=calc_normal)
 
         #sigmas = density_outputs['sigma'].view(N, num_steps) # [N, T]
         for k, v in density_outputs.items():
@@ -399,8 +704,11 @@ class NeRFRenderer(nn.Module):
                 new_xyzs = rays_o.unsqueeze(-2) + rays_d.unsqueeze(-2) * new_z_vals.unsqueeze(-1) # [N, 1, 3] * [N, t, 1] -> [N, t, 3]
                 new_xyzs = torch.min(torch.max(new_xyzs, aabb[:3]), aabb[3:]) # a manual clip.
 
+            if occ is not None:
+                new_occ = self.occupancy(new_xyzs) # [N, t]
+
             # only forward new points to save computation
-            new_density_outputs = self.density(new_xyzs.reshape(-1, 3))
+            new_density_outputs = self.masked_density(new_xyzs.reshape(-1, 3), None if occ is None else new_occ.view(-1), calc_normal=calc_normal)
             #new_sigmas = new_density_outputs['sigma'].view(N, upsample_steps) # [N, t]
             for k, v in new_density_outputs.items():
                 new_density_outputs[k] = v.view(N, upsample_steps, -1)
@@ -416,6 +724,12 @@ class NeRFRenderer(nn.Module):
                 tmp_output = torch.cat([density_outputs[k], new_density_outputs[k]], dim=1)
                 density_outputs[k] = torch.gather(tmp_output, dim=1, index=z_index.unsqueeze(-1).expand_as(tmp_output))
 
+            if occ is not None:
+                occ = torch.gather(torch.cat([occ, new_occ], dim=1), dim=1, index=z_index)
+
+        if occ is not None:
+            self.skipped_samples = (~occ).sum().detach() / N
+
         deltas = z_vals[..., 1:] - z_vals[..., :-1] # [N, T+t-1]
         deltas = torch.cat([deltas, sample_dist * torch.ones_like(deltas[..., :1])], dim=-1)
         alphas = 1 - torch.exp(-deltas * density_outputs['sigma'].squeeze(-1)) # [N, T+t]
@@ -426,8 +740,11 @@ class NeRFRenderer(nn.Module):
         for k, v in density_outputs.items():
             density_outputs[k] = v.view(-1, v.shape[-1])
 
-        sigmas, rgbs, normals = self(xyzs.reshape(-1, 3), dirs.reshape(-1, 3), light_d, ratio=ambient_ratio, shading=shading)
-        rgbs = rgbs.view(N, -1, 3) # [N, T+t, 3]
+        # no need to query the network again, shade the sorted density outputs directly.
+        normals = density_outputs.get('normal', None)
+        sample_light_d = light_d if light_d.dim() == 1 else light_d[:, None, :].expand(-1, xyzs.shape[1], 3).reshape(-1, 3)
+        rgbs = self.shade(density_outputs['albedo'], normals, sample_light_d, ratio=ambient_ratio, shading='albedo' if deferred else shading)
+        rgbs = rgbs.view(N, -1, rgbs.shape[-1]) # [N, T+t, 3 or 4]
 
         if normals is not None:
             # orientation loss
@@ -435,10 +752,15 @@ class NeRFRenderer(nn.Module):
             loss_orient = weights.detach() * (normals * dirs).sum(-1).clamp(min=0) ** 2
             results['loss_orient'] = loss_orient.sum(-1).mean()
 
-            # surface normal smoothness
-            normals_perturb = self.normal(xyzs + torch.randn_like(xyzs) * 1e-2).view(N, -1, 3)
-            loss_smooth = (normals - normals_perturb).abs()
-            results['loss_smooth'] = loss_smooth.mean()
+            # surface normal smoothness (only on occupied samples if using the occupancy grid)
+            if occ is None:
+                normals_perturb = self.normal(xyzs + torch.randn_like(xyzs) * 1e-2).view(N, -1, 3)
+                loss_smooth = (normals - normals_perturb).abs()
+                results['loss_smooth'] = loss_smooth.mean()
+            elif occ.any():
+                normals_perturb = self.normal(xyzs[occ] + torch.randn_like(xyzs[occ]) * 1e-2)
+                loss_smooth = (normals[occ] - normals_perturb).abs()
+                results['loss_smooth'] = loss_smooth.mean()
 
         # calculate weight_sum (mask)
         weights_sum = weights.sum(dim=-1) # [N]
@@ -448,10 +770,24 @@ class NeRFRenderer(nn.Module):
         depth = torch.sum(weights * ori_z_vals, dim=-1)
 
         # calculate color
-        image = torch.sum(weights.unsqueeze(-1) * rgbs, dim=-2) # [N, 3], in [0, 1]
+        image = torch.sum(weights.unsqueeze(-1) * rgbs, dim=-2) # [N, 3], in [0, 1] ([N, 4] latents in latent mode)
+
+        # deferred shading of the composited albedo
+        if deferred:
+            if self.deferred_topk > 0:
+                surface_weights, surface_index = torch.topk(weights.detach(), min(self.deferred_topk, weights.shape[1]), dim=-1) # [N, K]
+                surface_xyzs = torch.gather(xyzs, dim=1, index=surface_index.unsqueeze(-1).expand(-1, -1, 3)) # [N, K, 3]
+            else:
+                surface_weights = None
+                surface_z = torch.sum(weights * z_vals, dim=-1) / weights_sum.clamp(min=1e-5) # [N]
+                surface_xyzs = rays_o + rays_d * surface_z.unsqueeze(-1)
+                surface_xyzs = torch.min(torch.max(surface_xyzs, aabb[:3]), aabb[3:]).unsqueeze(1) # [N, 1, 3]
 
-        # mix background color
-        if self.bg_radius > 0:
+            image, deferred_results = self.deferred_shade(surface_xyzs, image, weights_sum, rays_d, light_d, ratio=ambient_ratio, shading=shading, surface_weights=surface_weights)
+            results.update(deferred_results)
+
+        # mix background color (the bg model is rgb only)
+        if self.bg_radius > 0 and image.shape[-1] == 3:
             # use the bg model to calculate bg_color
             # sph = raymarching.sph_from_ray(rays_o, rays_d, self.bg_radius) # [N, 2] in [-1, 1]
             bg_color = self.background(rays_d.reshape(-1, 3)) # [N, 3]
@@ -460,7 +796,7 @@ class NeRFRenderer(nn.Module):
             
         image = image + (1 - weights_sum).unsqueeze(-1) * bg_color
 
-        image = image.view(*prefix, 3)
+        image = image.view(*prefix, -1)
         depth = depth.view(*prefix)
 
         mask = (nears < fars).reshape(*prefix)
@@ -474,10 +810,11 @@ class NeRFRenderer(nn.Module):
 
 
     def run_cuda(self, rays_o, rays_d, dt_gamma=0, light_d=None, ambient_ratio=1.0, shading='albedo', bg_color=None, perturb=False, force_all_rays=False, max_steps=1024, T_thresh=1e-4, **kwargs):
-        # rays_o, rays_d: [B, N, 3], assumes B == 1
+        # rays_o, rays_d: [B, N, 3], B views are rendered together
         # return: image: [B, N, 3], depth: [B, N]
 
         prefix = rays_o.shape[:-1]
+        light_d = self.ray_light_d(rays_o, light_d) # [3] or [BN, 3]
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
 
@@ -487,14 +824,12 @@ class NeRFRenderer(nn.Module):
         # pre-calculate near far
         nears, fars = raymarching.near_far_from_aabb(rays_o, rays_d, self.aabb_train if self.training else self.aabb_infer)
 
-        # random sample light_d if not provided
-        if light_d is None:
-            # gaussian noise around the ray origin, so the light always face the view dir (avoid dark face)
-            light_d = (rays_o[0] + torch.randn(3, device=device, dtype=torch.float))
-            light_d = safe_normalize(light_d)
-
         results = {}
 
+        # deferred shading: only albedo is composited along the rays, normals are queried once per ray afterwards.
+        deferred = self.deferred_shading and shading in ['lambertian', 'textureless']
+        sample_shading = 'albedo' if deferred else shading
+
         if self.training:
             # setup counter
             counter = self.step_counter[self.local_step % 16]
@@ -505,11 +840,21 @@ class NeRFRenderer(nn.Module):
 
             #plot_pointcloud(xyzs.reshape(-1, 3).detach().cpu().numpy())
             
-            sigmas, rgbs, normals = self(xyzs, dirs, light_d, ratio=ambient_ratio, shading=shading)
+            # per-sample light direction, samples of ray i are stored at [offset_i, offset_i + count_i)
+            if light_d.dim() == 1 or sample_shading == 'albedo':
+                sample_light_d = light_d
+            else:
+                counts = rays[:, 2].long()
+                starts = torch.cumsum(counts, dim=0) - counts
+                positions = torch.arange(int(counts.sum()), device=device) + torch.repeat_interleave(rays[:, 1].long() - starts, counts)
+                sample_light_d = light_d.new_zeros(xyzs.shape[0], 3)
+                sample_light_d[positions] = torch.repeat_interleave(light_d[rays[:, 0].long()], counts, dim=0)
+
+            sigmas, rgbs, normals = self(xyzs, dirs, sample_light_d, ratio=ambient_ratio, shading=sample_shading)
 
             #print(f'valid RGB query ratio: {mask.sum().item() / mask.shape[0]} (total = {mask.sum().item()})')
 
-            weights_sum, depth, image = raymarching.composite_rays_train(sigmas, rgbs, deltas, rays, T_thresh)
+            weights_sum, depth, image = self.composite_rays_train(sigmas, rgbs, deltas, rays, T_thresh)
 
             # normals related regularizations
             if normals is not None:
@@ -530,7 +875,9 @@ class NeRFRenderer(nn.Module):
             
             weights_sum = torch.zeros(N, dtype=dtype, device=device)
             depth = torch.zeros(N, dtype=dtype, device=device)
-            image = torch.zeros(N, 3, dtype=dtype, device=device)
+            # the kernel composites 3 channels, one buffer per group of 3 channels
+            C = self.color_dim
+            images = [torch.zeros(N, 3, dtype=dtype, device=device) for _ in range(0, C, 3)]
             
             n_alive = N
             rays_alive = torch.arange(n_alive, dtype=torch.int32, device=device) # [N]
@@ -552,17 +899,41 @@ class NeRFRenderer(nn.Module):
 
                 xyzs, dirs, deltas = raymarching.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, self.bound, self.density_bitfield, self.cascade, self.grid_size, nears, fars, 128, perturb if step == 0 else False, dt_gamma, max_steps)
 
-                sigmas, rgbs, normals = self(xyzs, dirs, light_d, ratio=ambient_ratio, shading=shading)
+                # per-sample light direction, samples are ordered as [n_alive, n_step]
+                sample_light_d = light_d if light_d.dim() == 1 else light_d[rays_alive.long()][:, None, :].expand(-1, n_step, 3).reshape(-1, 3)
+
+                sigmas, rgbs, normals = self(xyzs, dirs, sample_light_d, ratio=ambient_ratio, shading=sample_shading)
 
-                raymarching.composite_rays(n_alive, n_step, rays_alive, rays_t, sigmas, rgbs, deltas, weights_sum, depth, image, T_thresh)
+                # extra channel groups first, on copies of the ray states (the kernel updates them in-place)
+                for g in range(1, len(images)):
+                    group = F.pad(rgbs[:, 3*g:3*g+3], (0, max(0, 3*g + 3 - C))).contiguous()
+                    raymarching.composite_rays(n_alive, n_step, rays_alive.clone(), rays_t.clone(), sigmas, group, deltas, weights_sum.clone(), depth.clone(), images[g], T_thresh)
+
+                raymarching.composite_rays(n_alive, n_step, rays_alive, rays_t, sigmas, rgbs[:, :3].contiguous(), deltas, weights_sum, depth, images[0], T_thresh)
 
                 rays_alive = rays_alive[rays_alive >= 0]
                 #print(f'step = {step}, n_step = {n_step}, n_alive = {n_alive}, xyzs: {xyzs.shape}')
 
                 step += n_step
 
-        # mix background color
-        if self.bg_radius > 0:
+            image = torch.cat(images, dim=-1)[:, :C]
+
+        # expected surface distance, the training composite accumulates t from the first sample (~ nears), the inference one from the ray origin.
+        surface_t = depth / weights_sum.clamp(min=1e-5) # [N]
+        if self.training:
+            surface_t = surface_t + nears
+
+        # deferred shading at the expected depth point
+        if deferred:
+            surface_xyzs = rays_o + rays_d * surface_t.unsqueeze(-1)
+            aabb = self.aabb_train if self.training else self.aabb_infer
+            surface_xyzs = torch.min(torch.max(surface_xyzs, aabb[:3]), aabb[3:]).unsqueeze(1) # [N, 1, 3]
+
+            image, deferred_results = self.deferred_shade(surface_xyzs, image, weights_sum, rays_d, light_d, ratio=ambient_ratio, shading=shading)
+            results.update(deferred_results)
+
+        # mix background color (the bg model is rgb only)
+        if self.bg_radius > 0 and image.shape[-1] == 3:
             
             # use the bg model to calculate bg_color
             # sph = raymarching.sph_from_ray(rays_o, rays_d, self.bg_radius) # [N, 2] in [-1, 1]
@@ -572,7 +943,7 @@ class NeRFRenderer(nn.Module):
             bg_color = 1
 
         image = image + (1 - weights_sum).unsqueeze(-1) * bg_color
-        image = image.view(*prefix, 3)
+        image = image.view(*prefix, -1)
 
         depth = torch.clamp(depth - nears, min=0) / (fars - nears)
         depth = depth.view(*prefix)
@@ -585,57 +956,136 @@ class NeRFRenderer(nn.Module):
         results['depth'] = depth
         results['weights_sum'] = weights_sum
         results['mask'] = mask
+        results['surface_t'] = surface_t.view(*prefix)
 
         return results
 
+    @torch.no_grad()
+    def check_surface_t(self, rays_o, rays_d, min_weight=0.5, **kwargs):
+        # rays_o, rays_d: [B, N, 3]
+        # return: max abs difference of the expected surface distance between the training and the inference composites on the same rays,
+        #         only rays with enough opacity in both are compared, None if there is none.
+        # the training composite only runs in train mode, which also advances the step counters used by update_extra_state:
+        # the check runs in eval mode otherwise, and restores the counters & the previous mode afterwards.
+        training = self.training
+        local_step, step_counter = self.local_step, self.step_counter.clone()
+        kwargs.update(perturb=False, shading='albedo', ambient_ratio=1.0)
+
+        try:
+            self.eval()
+            results_infer = self.run_cuda(rays_o, rays_d, **kwargs)
+            self.train()
+            results_train = self.run_cuda(rays_o, rays_d, force_all_rays=True, **kwargs)
+        finally:
+            self.local_step = local_step
+            self.step_counter.copy_(step_counter)
+            self.train(training)
+
+        mask = (results_train['weights_sum'] > min_weight) & (results_infer['weights_sum'] > min_weight)
+        if not mask.any():
+            return None
+        return (results_train['surface_t'] - results_infer['surface_t'])[mask].abs().max().item()
+
+
+    def query_grid_cells(self, xyzs, cas):
+        # xyzs: [N, 3], cell centers in [-1, 1]
+        # return: [N], density at a random position inside each cell of cascade `cas`
+        bound = min(2 ** cas, self.bound)
+        half_grid_size = bound / self.grid_size
+        # scale to current cascade's resolution
+        cas_xyzs = xyzs * (bound - half_grid_size)
+        # add noise in [-hgs, hgs]
+        cas_xyzs += (torch.rand_like(cas_xyzs) * 2 - 1) * half_grid_size
+        # query density
+        sigmas = self.density(cas_xyzs)['sigma'].reshape(-1).detach()
+        return sigmas
+
+
+    def sample_grid_cells(self, occupied, budget):
+        # occupied: [H * H * H] (morton order) or [H, H, H] (dense), bool
+        # return: [budget, 3] int32 coords in [0, H), half uniformly sampled, half sampled from the occupied cells (may duplicate).
+        H = self.grid_size
+        device = occupied.device
+        N = budget // 2
+        
+        coords = torch.randint(0, H, (budget - N, 3), dtype=torch.int32, device=device)
+
+        occ_indices = torch.nonzero(occupied.reshape(-1)).squeeze(-1) # [Nz]
+        if occ_indices.shape[0] > 0 and N > 0:
+            occ_indices = occ_indices[torch.randint(0, occ_indices.shape[0], (N,), device=device)] # [N]
+            if occupied.dim() == 1:
+                occ_coords = raymarching.morton3D_invert(occ_indices.int()) # [N, 3]
+            else:
+                occ_coords = torch.stack([occ_indices // (H * H), (occ_indices // H) % H, occ_indices % H], dim=-1).int() # [N, 3]
+            coords = torch.cat([coords, occ_coords], dim=0)
+        
+        return coords
+
 
     @torch.no_grad()
     def update_extra_state(self, decay=0.95, S=128):
         # call before each epoch to update extra states.
 
+        if self.occ_grid:
+            self.update_occ_grid(decay, S)
+            return
+
         if not self.cuda_ray:
             return 
         
         ### update density grid
         tmp_grid = - torch.ones_like(self.density_grid)
+
+        # full update during warmup
+        if self.iter_density < self.grid_warmup or self.grid_budget <= 0:
         
-        X = torch.arange(self.grid_size, dtype=torch.int32, device=self.aabb_train.device).split(S)
-        Y = torch.arange(self.grid_size, dtype=torch.int32, device=self.aabb_train.device).split(S)
-        Z = torch.arange(self.grid_size, dtype=torch.int32, device=self.aabb_train.device).split(S)
-
-        for xs in X:
-            for ys in Y:
-                for zs in Z:
-                    
-                    # construct points
-                    xx, yy, zz = custom_meshgrid(xs, ys, zs)
-                    coords = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [N, 3], in [0, 128)
-                    indices = raymarching.morton3D(coords).long() # [N]
-                    xyzs = 2 * coords.float() / (self.grid_size - 1) - 1 # [N, 3] in [-1, 1]
-
-                    # cascading
-                    for cas in range(self.cascade):
-                        bound = min(2 ** cas, self.bound)
-                        half_grid_size = bound / self.grid_size
-                        # scale to current cascade's resolution
-                        cas_xyzs = xyzs * (bound - half_grid_size)
-                        # add noise in [-hgs, hgs]
-                        cas_xyzs += (torch.rand_like(cas_xyzs) * 2 - 1) * half_grid_size
-                        # query density
-                        sigmas = self.density(cas_xyzs)['sigma'].reshape(-1).detach()
-                        # assign 
-                        tmp_grid[cas, indices] = sigmas
+            X = torch.arange(self.grid_size, dtype=torch.int32, device=self.aabb_train.device).split(S)
+            Y = torch.arange(self.grid_size, dtype=torch.int32, device=self.aabb_train.device).split(S)
+            Z = torch.arange(self.grid_size, dtype=torch.int32, device=self.aabb_train.device).split(S)
+
+            for xs in X:
+                for ys in Y:
+                    for zs in Z:
+                        
+                        # construct points
+                        xx, yy, zz = custom_meshgrid(xs, ys, zs)
+                        coords = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [N, 3], in [0, 128)
+                        indices = raymarching.morton3D(coords).long() # [N]
+                        xyzs = 2 * coords.float() / (self.grid_size - 1) - 1 # [N, 3] in [-1, 1]
+
+                        # cascading
+                        for cas in range(self.cascade):
+                            tmp_grid[cas, indices] = self.query_grid_cells(xyzs, cas)
+
+        # partial update, with a fixed budget of random cells and random occupied cells
+        else:
+            density_thresh = min(self.mean_density, self.density_thresh)
+            for cas in range(self.cascade):
+                coords = self.sample_grid_cells(self.density_grid[cas] > density_thresh, self.grid_budget) # [N, 3]
+                indices = raymarching.morton3D(coords).long() # [N]
+                xyzs = 2 * coords.float() / (self.grid_size - 1) - 1 # [N, 3] in [-1, 1]
+                tmp_grid[cas, indices] = self.query_grid_cells(xyzs, cas)
         
-        # ema update
-        valid_mask = self.density_grid >= 0
-        self.density_grid[valid_mask] = torch.maximum(self.density_grid[valid_mask] * decay, tmp_grid[valid_mask])
-        self.mean_density = torch.mean(self.density_grid[valid_mask]).item()
+        # ema update, cells not queried for several updates are decayed for each missed update.
+        valid_mask = (self.density_grid >= 0) & (tmp_grid >= 0)
+        self.density_age += 1
+        decays = decay ** self.density_age[valid_mask].float()
+        self.density_grid[valid_mask] = torch.maximum(self.density_grid[valid_mask] * decays, tmp_grid[valid_mask])
+        self.density_age[valid_mask] = 0
+        self.mean_density = torch.mean(self.density_grid[self.density_grid >= 0]).item()
         self.iter_density += 1
 
         # convert to bitfield
         density_thresh = min(self.mean_density, self.density_thresh)
+        old_bitfield = self.density_bitfield.clone()
         self.density_bitfield = raymarching.packbits(self.density_grid, density_thresh, self.density_bitfield)
 
+        # occupancy statistics
+        num_occ = count_bits(self.density_bitfield)
+        num_flips = count_bits(old_bitfield ^ self.density_bitfield)
+        self.occ_rate = num_occ / self.density_grid.numel()
+        self.flip_rate = num_flips / max(num_occ, 1)
+
         ### update step counter
         total_step = min(16, self.local_step)
         if total_step > 0:
@@ -645,9 +1095,69 @@ class NeRFRenderer(nn.Module):
         # print(f'[density grid] min={self.density_grid.min().item():.4f}, max={self.density_grid.max().item():.4f}, mean={self.mean_density:.4f}, occ_rate={(self.density_grid > density_thresh).sum() / (128**3 * self.cascade):.3f} | [step counter] mean={self.mean_count}')
 
 
+    @torch.no_grad()
+    def update_occ_grid(self, decay=0.95, S=128):
+        # update the dense occupancy grid used by the pytorch raymarching (`run`).
+
+        H = self.grid_size
+        device = self.occ_density.device
+
+        tmp_grid = - torch.ones_like(self.occ_density)
+
+        # full update during warmup
+        if self.iter_density < self.grid_warmup or self.grid_budget <= 0:
+
+            X = torch.arange(H, dtype=torch.int32, device=device).split(S)
+            Y = torch.arange(H, dtype=torch.int32, device=device).split(S)
+            Z = torch.arange(H, dtype=torch.int32, device=device).split(S)
+
+            for xi, xs in enumerate(X):
+                for yi, ys in enumerate(Y):
+                    for zi, zs in enumerate(Z):
+                        
+                        # construct points, with random position inside each cell
+                        xx, yy, zz = custom_meshgrid(xs, ys, zs)
+                        coords = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [N, 3], in [0, H)
+                        xyzs = (coords.float() + torch.rand_like(coords, dtype=torch.float32)) / H * 2 * self.bound - self.bound # [N, 3] in [-bound, bound]
+                        # query density
+                        sigmas = self.density(xyzs)['sigma'].reshape(len(xs), len(ys), len(zs)).detach()
+                        # assign
+                        tmp_grid[xi * S: xi * S + len(xs), yi * S: yi * S + len(ys), zi * S: zi * S + len(zs)] = sigmas
+
+        # partial update, with a fixed budget of random cells and random occupied cells
+        else:
+            coords = self.sample_grid_cells(self.occ_mask, self.grid_budget) # [N, 3]
+            xyzs = (coords.float() + torch.rand_like(coords, dtype=torch.float32)) / H * 2 * self.bound - self.bound # [N, 3] in [-bound, bound]
+            sigmas = self.density(xyzs)['sigma'].reshape(-1).detach()
+            coords = coords.long()
+            tmp_grid[coords[:, 0], coords[:, 1], coords[:, 2]] = sigmas
+
+        # ema update, cells not queried for several updates are decayed for each missed update.
+        valid_mask = tmp_grid >= 0
+        self.occ_age += 1
+        decays = decay ** self.occ_age[valid_mask].float()
+        self.occ_density[valid_mask] = torch.maximum(self.occ_density[valid_mask] * decays, tmp_grid[valid_mask])
+        self.occ_age[valid_mask] = 0
+        self.mean_density = torch.mean(self.occ_density).item()
+        self.iter_density += 1
+
+        # convert to occupancy mask
+        density_thresh = min(self.mean_density, self.density_thresh)
+        old_mask = self.occ_mask.clone()
+        self.occ_mask.copy_(self.occ_density > density_thresh)
+
+        # occupancy statistics
+        num_occ = self.occ_mask.sum().item()
+        num_flips = (old_mask != self.occ_mask).sum().item()
+        self.occ_rate = num_occ / self.occ_mask.numel()
+        self.flip_rate = num_flips / max(num_occ, 1)
+
+        # print(f'[occupancy grid] mean={self.mean_density:.4f}, occ_rate={self.occ_mask.float().mean().item():.3f}, skipped samples per ray={float(self.skipped_samples):.1f}')
+
+
     def render(self, rays_o, rays_d, staged=False, max_ray_batch=4096, **kwargs):
-        # rays_o, rays_d: [B, N, 3], assumes B == 1
-        # return: pred_rgb: [B, N, 3]
+        # rays_o, rays_d: [B, N, 3]
+        # return: pred_rgb: [B, N, 3] ([B, N, 4] latents when training in latent mode)
 
         if self.cuda_ray:
             _run = self.run_cuda
@@ -660,7 +1170,7 @@ class NeRFRenderer(nn.Module):
         # never stage when cuda_ray
         if staged and not self.cuda_ray:
             depth = torch.empty((B, N), device=device)
-            image = torch.empty((B, N, 3), device=device)
+            image = torch.empty((B, N, self.color_dim), device=device)
             weights_sum = torch.empty((B, N), device=device)
 
             for b in range(B):
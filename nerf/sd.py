@@ -9,8 +9,15 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torchvision.utils import save_image
 
+from .frame_store import FrameStore
+from .cfg_cache import CFGCache
+
 import time
 import os
+import copy
+import atexit
+import threading
+import collections
 
 def seed_everything(seed):
     torch.manual_seed(seed)
@@ -18,8 +25,149 @@ def seed_everything(seed):
     #torch.backends.cudnn.deterministic = True
     #torch.backends.cudnn.benchmark = True
 
+# memory profiles of the guidance models, from the fastest to the smallest footprint.
+#   fp16: load the weights in half precision (cuda only).
+#   channels_last: channels-last memory format of the unet convolutions.
+#   attention_slice: None (off), 'auto' (half the heads at a time) or an int (slice size, 1 is the smallest & slowest).
+#   vae_tiling: encode & decode in tiles (needs a recent diffusers).
+#   offload_text_encoder: move the text encoder to cpu once the prompts are encoded (see `offload_text_encoder`).
+MEMORY_PROFILES = {
+    'default': dict(fp16=False, channels_last=False, attention_slice=None, vae_tiling=False, offload_text_encoder=False),
+    'fast': dict(fp16=True, channels_last=True, attention_slice=None, vae_tiling=False, offload_text_encoder=False),
+    'balanced': dict(fp16=True, channels_last=True, attention_slice='auto', vae_tiling=False, offload_text_encoder=True),
+    'low-mem': dict(fp16=True, channels_last=False, attention_slice=1, vae_tiling=True, offload_text_encoder=True),
+}
+
+class VisualizationWorker:
+    # runs the diagnostics of StableDiffusion.train_step in a background thread, on its own cuda stream.
+    # train_step only enqueues detached snapshots, the oldest snapshot is dropped if the worker falls behind.
+    def __init__(self, guidance, max_queue=2):
+        self.guidance = guidance
+        self.queue = collections.deque(maxlen=max_queue)
+        self.cond = threading.Condition()
+        self.closed = False
+
+        self.stream = torch.cuda.Stream(device=guidance.device) if guidance.device.type == 'cuda' else None
+        # produce_latents changes the scheduler state, use a private copy.
+        self.scheduler = copy.deepcopy(guidance.scheduler)
+
+        # statistics
+        self.num_submitted = 0
+        self.num_dropped = 0
+        self.num_done = 0
+        self.stall = 0 # total time spent in submit (s)
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def submit(self, **snapshot):
+        # snapshot: tensors are cloned here (detached), the clones are owned by the worker.
+        _t = time.time()
+
+        snapshot = {k: v.detach().clone() if torch.is_tensor(v) else v for k, v in snapshot.items()}
+
+        if self.stream is not None:
+            # the worker stream waits for the clones, and the allocator must not reuse them until the worker is done.
+            event = torch.cuda.Event()
+            event.record()
+            snapshot['event'] = event
+            for v in snapshot.values():
+                if torch.is_tensor(v):
+                    v.record_stream(self.stream)
+
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                self.num_dropped += 1
+            self.queue.append(snapshot) # drops the oldest if full
+            self.num_submitted += 1
+            self.cond.notify()
+
+        self.stall += time.time() - _t
+
+    def run(self):
+        while True:
+            with self.cond:
+                while len(self.queue) == 0 and not self.closed:
+                    self.cond.wait()
+                if len(self.queue) == 0:
+                    return
+                snapshot = self.queue.popleft()
+
+            try:
+                if self.stream is not None:
+                    self.stream.wait_event(snapshot.pop('event'))
+                    with torch.cuda.stream(self.stream):
+                        self.visualize(**snapshot)
+                else:
+                    self.visualize(**snapshot)
+                self.num_done += 1
+            except Exception as e:
+                print(f'[WARN] visualization at iteration {snapshot["iteration"]} failed: {e}')
+
+    def close(self):
+        # finish the queued snapshots.
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        self.guidance.frame_store.close()
+        if self.num_submitted > 0:
+            print(f'[INFO] visualization: {self.num_done}/{self.num_submitted} done, {self.num_dropped} dropped, stall per event = {1000 * self.stall / self.num_submitted:.3f}ms')
+
+    @torch.no_grad()
+    def visualize(self, d, iteration, pred_rgb_512, latents, latents_noisy, noise, noise_pred, t, text_embeddings, guidance_scale):
+        # all tensors are of the first view: latents [1, 4, 64, 64], t: scalar, text_embeddings: [2, 77, 768]
+        guidance = self.guidance
+        scheduler = self.scheduler
+        frame_store = guidance.frame_store
+
+        # Store predicted (by NeRF) image, decoded from the rendered latents in latent mode
+        if pred_rgb_512 is None:
+            pred_rgb_512 = guidance.decode_latents(latents)
+        frame_store.append(d, 'nerf', iteration, pred_rgb_512)
+
+        # Store image corresponding to noisy latents
+        noisy_image = guidance.decode_latents(latents_noisy)
+        frame_store.append(d, 'noisy', iteration, noisy_image)
+
+        noise_image = guidance.decode_latents(noise)
+        frame_store.append(d, 'noise', iteration, noise_image)
+
+        # Denoised Image
+        prev_latents = scheduler._get_prev_sample(latents, t, t-1, noise_pred)
+        prev_image = guidance.decode_latents(prev_latents)
+        frame_store.append(d, 'denoised', iteration, prev_image)
+
+        # Completely Denoised Image
+        final_latents = guidance.produce_latents(text_embeddings, t, num_inference_steps=25, guidance_scale=guidance_scale, latents=latents, scheduler=scheduler)
+        final_image = guidance.decode_latents(final_latents)
+        frame_store.append(d, 'final_denoised', iteration, final_image)
+
+        # Noisy Image using Predicted Noise
+        pred_noisy_latents = scheduler.add_noise(latents, noise_pred, t)
+        pred_noisy_image = guidance.decode_latents(pred_noisy_latents)
+        frame_store.append(d, 'noisy_pred', iteration, pred_noisy_image)
+
+        # Image with residual noise applied
+        residual_noise = noise_pred-noise
+        res_latents = scheduler.add_noise(latents, residual_noise, t)
+        residual_image = guidance.decode_latents(res_latents)
+        frame_store.append(d, 'residual', iteration, residual_image)
+
+        # Predicted Noise
+        pred_noise_image = guidance.decode_latents(noise_pred)
+        frame_store.append(d, 'pred_noise', iteration, pred_noise_image)
+
+        # Residual Noise
+        res_noise_image = guidance.decode_latents(residual_noise)
+        frame_store.append(d, 'residual_noise', iteration, res_noise_image)
+
+
 class StableDiffusion(nn.Module):
-    def __init__(self, device, visualize=True, out_folder="visualizations/"):
+    def __init__(self, device, visualize=True, out_folder="visualizations/", vis_queue_size=2, cfg_cache_every=0, cfg_cache_buckets=4, memory_profile='default'):
         super().__init__()
 
         try:
@@ -39,60 +187,153 @@ class StableDiffusion(nn.Module):
         self.dirs = ['front', 'left_side', 'back', 'right_side', 'overhead', 'bottom']
         self.last_update = {name : -1000 for name in self.dirs}
 
+        # visualization frames are appended to a frame store instead of individual png files, see nerf/frame_store.py
         if self.visualize:
-            for d in self.dirs:
-                if not os.path.exists(os.path.join(self.out_folder, f"{d}/nerf")): os.makedirs(os.path.join(self.out_folder, f"{d}/nerf"))
-                if not os.path.exists(os.path.join(self.out_folder, f"{d}/noisy")): os.makedirs(os.path.join(self.out_folder, f"{d}/noisy"))
-                if not os.path.exists(os.path.join(self.out_folder, f"{d}/noisy_pred")): os.makedirs(os.path.join(self.out_folder, f"{d}/noisy_pred"))
-                if not os.path.exists(os.path.join(self.out_folder, f"{d}/final_denoised")): os.makedirs(os.path.join(self.out_folder, f"{d}/final_denoised"))
-                if not os.path.exists(os.path.join(self.out_folder, f"{d}/denoised")): os.makedirs(os.path.join(self.out_folder, f"{d}/denoised"))
-                if not os.path.exists(os.path.join(self.out_folder, f"{d}/residual")): os.makedirs(os.path.join(self.out_folder, f"{d}/residual"))
-                if not os.path.exists(os.path.join(self.out_folder, f"{d}/noise")): os.makedirs(os.path.join(self.out_folder, f"{d}/noise"))
-                if not os.path.exists(os.path.join(self.out_folder, f"{d}/pred_noise")): os.makedirs(os.path.join(self.out_folder, f"{d}/pred_noise"))
-                if not os.path.exists(os.path.join(self.out_folder, f"{d}/residual_noise")): os.makedirs(os.path.join(self.out_folder, f"{d}/residual_noise"))
-
-        print(f'[INFO] loading stable diffusion...')
+            self.frame_store = FrameStore(self.out_folder)
+
+        self.profile = MEMORY_PROFILES[memory_profile]
+        self.dtype = torch.float16 if self.profile['fp16'] and self.device.type == 'cuda' else torch.float32
+
+        print(f'[INFO] loading stable diffusion (memory profile: {memory_profile})...')
+
+        # memory held before loading (e.g. the nerf), excluded from the memory profile
+        self.base_memory = 0
+        if self.device.type == 'cuda':
+            self.base_memory = torch.cuda.memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
                 
         # 1. Load the autoencoder model which will be used to decode the latents into image space. 
-        self.vae = AutoencoderKL.from_pretrained("runwayml/stable-diffusion-v1-5", subfolder="vae", use_auth_token=self.token).to(self.device)
+        self.vae = AutoencoderKL.from_pretrained("runwayml/stable-diffusion-v1-5", subfolder="vae", use_auth_token=self.token, torch_dtype=self.dtype).to(self.device)
 
         # 2. Load the tokenizer and text encoder to tokenize and encode the text. 
-        self.tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14")
-        self.text_encoder = CLIPTextModel.from_pretrained("openai/clip-vit-large-patch14").to(self.device)
+        self.text_encoder_id = "openai/clip-vit-large-patch14" # identifies the cached text embeddings
+        self.tokenizer = CLIPTokenizer.from_pretrained(self.text_encoder_id)
+        self.text_encoder = CLIPTextModel.from_pretrained(self.text_encoder_id, torch_dtype=self.dtype).to(self.device)
 
         # 3. The UNet model for generating the latents.
-        self.unet = UNet2DConditionModel.from_pretrained("runwayml/stable-diffusion-v1-5", subfolder="unet", use_auth_token=self.token).to(self.device)
+        self.unet = UNet2DConditionModel.from_pretrained("runwayml/stable-diffusion-v1-5", subfolder="unet", use_auth_token=self.token, torch_dtype=self.dtype).to(self.device)
+
+        if self.profile['channels_last']:
+            self.unet.to(memory_format=torch.channels_last)
+
+        if self.profile['attention_slice'] is not None:
+            slice_size = self.profile['attention_slice']
+            if slice_size == 'auto':
+                # half the attention heads at a time, same as diffusers' pipelines
+                slice_size = self.unet.config.attention_head_dim // 2 if isinstance(self.unet.config.attention_head_dim, int) else 'auto'
+            self.unet.set_attention_slice(slice_size)
+
+        if self.profile['vae_tiling']:
+            if hasattr(self.vae, 'enable_tiling'):
+                self.vae.enable_tiling()
+            else:
+                print(f'[WARN] vae tiling is not supported by the installed diffusers, ignored.')
 
         # 4. Create a scheduler for inference
         self.scheduler = PNDMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", num_train_timesteps=self.num_train_timesteps)
         self.alphas = self.scheduler.alphas_cumprod.to(self.device) # for convenience
 
+        # diagnostics are written by a background worker
+        self.vis_worker = VisualizationWorker(self, max_queue=vis_queue_size) if self.visualize else None
+
+        # reuse the unconditional noise prediction across steps, see nerf/cfg_cache.py
+        self.cfg_cache = CFGCache(every=cfg_cache_every, num_buckets=cfg_cache_buckets, num_train_timesteps=self.num_train_timesteps)
+
         print(f'[INFO] loaded stable diffusion!')
 
+        self.report_memory_profile(memory_profile)
+
+    def benchmark_step(self):
+        # one guidance step of a single 512 x 512 view: vae encoder, unet with guidance, vae encoder backward.
+        pred_rgb = torch.rand(1, 3, 512, 512, device=self.device, requires_grad=True)
+        latents = self.encode_imgs(pred_rgb)
+        t = torch.full([2], self.max_step, dtype=torch.long, device=self.device)
+        text_embeddings = torch.zeros(2, self.tokenizer.model_max_length, self.text_encoder.config.hidden_size, device=self.device)
+        with torch.no_grad():
+            noise_pred = self.unet_forward(torch.cat([latents.detach()] * 2), t, text_embeddings)
+        # only w.r.t. the image, the guidance weights are frozen in training.
+        torch.autograd.grad(latents, pred_rgb, grad_outputs=noise_pred.chunk(2)[0])
+
+    def report_memory_profile(self, name, num_steps=3):
+        # peak memory of the loaded weights & one guidance step (on top of the memory held before loading), and the mean step time (cuda only, a step takes too long on cpu).
+        if self.device.type != 'cuda':
+            print(f'[INFO] memory profile {name}: no benchmark on {self.device}.')
+            return
+
+        load_peak = torch.cuda.max_memory_allocated(self.device) - self.base_memory
+
+        self.benchmark_step() # warm up
+        torch.cuda.reset_peak_memory_stats(self.device)
+        torch.cuda.synchronize(self.device)
+
+        _t = time.time()
+        for _ in range(num_steps):
+            self.benchmark_step()
+        torch.cuda.synchronize(self.device)
+        step_time = (time.time() - _t) / num_steps
+
+        step_peak = torch.cuda.max_memory_allocated(self.device) - self.base_memory
+        print(f'[INFO] memory profile {name}: peak memory = {load_peak / 2 ** 30:.2f} GB (weights), {step_peak / 2 ** 30:.2f} GB (guidance step), step time = {1000 * step_time:.1f}ms')
+
+    @property
+    def text_encoder_dtype(self):
+        # the dtype the prompts are encoded in (fp32 once offloaded), part of the text embedding cache key
+        return self.text_encoder.dtype
+
+    def offload_text_encoder(self):
+        # called once the prompts are encoded, later prompts are encoded on cpu.
+        if not self.profile['offload_text_encoder'] or self.text_encoder.device.type == 'cpu':
+            return
+        self.text_encoder.to('cpu', dtype=torch.float32)
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+        print(f'[INFO] offloaded the text encoder to cpu.')
+
+    def add_noise(self, latents, noise, t):
+        # t: [B] or scalar
+        return self.scheduler.add_noise(latents, noise, t)
+
+    def unet_forward(self, latents, t, text_embeddings):
+        # runs the unet in its own dtype, return: noise pred in float32
+        return self.unet(latents.to(self.dtype), t, encoder_hidden_states=text_embeddings.to(self.dtype)).sample.float()
+
     def get_text_embeds(self, prompt, negative_prompt):
         # prompt, negative_prompt: [str]
 
         # Tokenize text and get embeddings
         text_input = self.tokenizer(prompt, padding='max_length', max_length=self.tokenizer.model_max_length, truncation=True, return_tensors='pt')
 
+        # the text encoder may have been offloaded to cpu
+        encoder_device = self.text_encoder.device
+
         with torch.no_grad():
-            text_embeddings = self.text_encoder(text_input.input_ids.to(self.device))[0]
+            text_embeddings = self.text_encoder(text_input.input_ids.to(encoder_device))[0]
 
         # Do the same for unconditional embeddings
         uncond_input = self.tokenizer(negative_prompt, padding='max_length', max_length=self.tokenizer.model_max_length, return_tensors='pt')
 
         with torch.no_grad():
-            uncond_embeddings = self.text_encoder(uncond_input.input_ids.to(self.device))[0]
+            uncond_embeddings = self.text_encoder(uncond_input.input_ids.to(encoder_device))[0]
 
-        # Cat for final embeddings
-        text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
+        # Cat for final embeddings, always float32
+        text_embeddings = torch.cat([uncond_embeddings, text_embeddings]).to(self.device, torch.float32)
         return text_embeddings
 
     # TODO: Store visualizations of NeRF output, noise and residual
     def train_step(self, text_embeddings, pred_rgb, iteration, d, guidance_scale=100):
-        # Convert d into text
-        assert len(d) == 1, "Received more than one direction!"
-        d = self.dirs[d]
+        # text_embeddings: [2, 77, 768] shared by all views, or [2 * B, 77, 768] per view (uncond of all views, then cond of all views)
+        # pred_rgb: [B, 3, H, W], or latents [B, 4, 64, 64] rendered by the nerf (latent mode)
+        # d: [B], view directions, may be None
+        B = pred_rgb.shape[0]
+
+        if text_embeddings.shape[0] != 2 * B:
+            text_embeddings = text_embeddings.repeat_interleave(B, dim=0) # [2 * B, 77, 768]
+
+        # cfg cache keys: batch slot & direction of each view (the slot is the scene in multi-scene training)
+        keys = list(enumerate([None] * B if d is None else d.tolist()))
+
+        # Convert d into text, only the first view of the batch is visualized
+        d = self.dirs[0 if d is None else d[0]]
 
         # Visualize step (want to approximately store every tenth image for each direction)
         if self.visualize and abs(iteration-self.last_update[d]) >= 10:
@@ -101,24 +342,26 @@ class StableDiffusion(nn.Module):
         else:
             visualize = False
 
-        # interp to 512x512 to be fed into vae.
+        # timestep ~ U(0.02, 0.98) to avoid very high/low noise level
+        # per-view timesteps
+        t = torch.randint(self.min_step, self.max_step + 1, [B], dtype=torch.long, device=self.device)
 
-        # _t = time.time()
-        pred_rgb_512 = F.interpolate(pred_rgb, (512, 512), mode='bilinear', align_corners=False)
+        if pred_rgb.shape[1] == 4:
+            # latent mode: no interp & vae encoder, the latents require grad!
+            pred_rgb_512 = None
+            latents = pred_rgb
+        else:
+            # interp to 512x512 to be fed into vae.
 
-        # Store predicted (by NeRF) image
-        if visualize:
-            save_image(pred_rgb_512, os.path.join(self.out_folder, f"{d}/nerf/{iteration}.png"))
+            # _t = time.time()
+            pred_rgb_512 = F.interpolate(pred_rgb, (512, 512), mode='bilinear', align_corners=False)
 
-        # torch.cuda.synchronize(); print(f'[TIME] guiding: interp {time.time() - _t:.4f}s')
+            # torch.cuda.synchronize(); print(f'[TIME] guiding: interp {time.time() - _t:.4f}s')
 
-        # timestep ~ U(0.02, 0.98) to avoid very high/low noise level
-        t = torch.randint(self.min_step, self.max_step + 1, [1], dtype=torch.long, device=self.device)
-
-        # encode image into latents with vae, requires grad!
-        # _t = time.time()
-        latents = self.encode_imgs(pred_rgb_512)
-        # torch.cuda.synchronize(); print(f'[TIME] guiding: vae enc {time.time() - _t:.4f}s')
+            # encode image into latents with vae, requires grad!
+            # _t = time.time()
+            latents = self.encode_imgs(pred_rgb_512)
+            # torch.cuda.synchronize(); print(f'[TIME] guiding: vae enc {time.time() - _t:.4f}s')
 
         # predict the noise residual with unet, NO grad!
         # _t = time.time()
@@ -127,59 +370,28 @@ class StableDiffusion(nn.Module):
             noise = torch.randn_like(latents)
             latents_noisy = self.scheduler.add_noise(latents, noise, t)
 
-            # Store image corresponding to noisy latents
-            if visualize:
-                noisy_image = self.decode_latents(latents_noisy)
-                save_image(noisy_image, os.path.join(self.out_folder, f"{d}/noisy/{iteration}.png"))
-
-                noise_image = self.decode_latents(noise)
-                save_image(noise_image, os.path.join(self.out_folder, f"{d}/noise/{iteration}.png"))
-
-            # pred noise
-            latent_model_input = torch.cat([latents_noisy] * 2)
-            noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
+            # pred noise, the unconditional half may be reused from the cfg cache
+            noise_pred_uncond, noise_pred_text = self.cfg_cache.predict(self.unet_forward, latents_noisy, noise, t, text_embeddings, keys, iteration)
         # torch.cuda.synchronize(); print(f'[TIME] guiding: unet {time.time() - _t:.4f}s')
 
         # perform guidance (high scale from paper!)
-        noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
         noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
 
-        # Compute previous noisy sample based on predicted noise by diffusion model
-        with torch.no_grad():
-            if visualize:
-                # Denoised Image
-                prev_latents = self.get_previous_sample(latents, t, noise_pred)
-                prev_image = self.decode_latents(prev_latents)
-                save_image(prev_image, os.path.join(self.out_folder, f"{d}/denoised/{iteration}.png"))
-
-                # Completely Denoised Image
-                num_inf_steps = self.scheduler.num_inference_steps
-                final_latents = self.produce_latents(text_embeddings, t, num_inference_steps=25, guidance_scale=guidance_scale, latents=latents)
-                self.scheduler.set_timesteps(num_inf_steps)
-                final_image = self.decode_latents(final_latents)
-                save_image(final_image, os.path.join(self.out_folder, f"{d}/final_denoised/{iteration}.png"))
-
-                # Noisy Image using Predicted Noise
-                pred_noisy_latents = self.scheduler.add_noise(latents, noise_pred, t)
-                pred_noisy_image = self.decode_latents(pred_noisy_latents)
-                save_image(pred_noisy_image, os.path.join(self.out_folder, f"{d}/noisy_pred/{iteration}.png"))
-
-                # Image with residual noise applied
-                residual_noise = noise_pred-noise
-                res_latents = self.scheduler.add_noise(latents, residual_noise, t)
-                residual_image = self.decode_latents(res_latents)
-                save_image(residual_image, os.path.join(self.out_folder, f"{d}/residual/{iteration}.png"))
-
-                # Predicted Noise
-                pred_noise_image = self.decode_latents(noise_pred)
-                save_image(pred_noise_image, os.path.join(self.out_folder, f"{d}/pred_noise/{iteration}.png"))
-
-                # Residual Noise
-                res_noise_image = self.decode_latents(residual_noise)
-                save_image(res_noise_image, os.path.join(self.out_folder, f"{d}/residual_noise/{iteration}.png"))
+        # enqueue a snapshot of the first view for the visualization worker, never blocks.
+        if visualize:
+            self.vis_worker.submit(
+                d=d, iteration=iteration, guidance_scale=guidance_scale,
+                pred_rgb_512=None if pred_rgb_512 is None else pred_rgb_512[:1],
+                latents=latents[:1],
+                latents_noisy=latents_noisy[:1],
+                noise=noise[:1],
+                noise_pred=noise_pred[:1],
+                t=t[0],
+                text_embeddings=text_embeddings[[0, B]],
+            )
 
         # w(t), sigma_t^2
-        w = (1 - self.alphas[t])
+        w = (1 - self.alphas[t]).view(B, 1, 1, 1)
         # w = self.alphas[t] ** 0.5 * (1 - self.alphas[t])
         grad = w * (noise_pred - noise)
 
@@ -198,29 +410,33 @@ class StableDiffusion(nn.Module):
         return self.scheduler._get_prev_sample(sample, timestep, timestep-1, noise_pred)
 
 
-    def produce_latents(self, text_embeddings, height=512, width=512, num_inference_steps=50, guidance_scale=7.5, latents=None):
+    def produce_latents(self, text_embeddings, height=512, width=512, num_inference_steps=50, guidance_scale=7.5, latents=None, scheduler=None):
+
+        # scheduler: defaults to self.scheduler, the visualization worker passes its own copy.
+        if scheduler is None:
+            scheduler = self.scheduler
 
         if latents is None:
             latents = torch.randn((text_embeddings.shape[0] // 2, self.unet.in_channels, height // 8, width // 8), device=self.device)
 
-        self.scheduler.set_timesteps(num_inference_steps)
+        scheduler.set_timesteps(num_inference_steps)
 
         with torch.autocast('cuda'):
-            for i, t in enumerate(self.scheduler.timesteps):
+            for i, t in enumerate(scheduler.timesteps):
                 # expand the latents if we are doing classifier-free guidance to avoid doing two forward passes.
                 latent_model_input = torch.cat([latents] * 2)
 
                 # predict the noise residual
                 torch.cuda.empty_cache()
                 with torch.no_grad():
-                    noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings)['sample']
+                    noise_pred = self.unet_forward(latent_model_input, t, text_embeddings)
 
                 # perform guidance
                 noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
                 noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
 
                 # compute the previous noisy sample x_t -> x_t-1
-                latents = self.scheduler.step(noise_pred, t, latents)['prev_sample']
+                latents = scheduler.step(noise_pred, t, latents)['prev_sample']
         
         return latents
 
@@ -229,7 +445,7 @@ class StableDiffusion(nn.Module):
         latents = 1 / 0.18215 * latents
 
         with torch.no_grad():
-            imgs = self.vae.decode(latents).sample
+            imgs = self.vae.decode(latents.to(self.dtype)).sample.float()
 
         imgs = (imgs / 2 + 0.5).clamp(0, 1)
         
@@ -240,8 +456,8 @@ class StableDiffusion(nn.Module):
 
         imgs = 2 * imgs - 1
 
-        posterior = self.vae.encode(imgs).latent_dist
-        latents = posterior.sample() * 0.18215
+        posterior = self.vae.encode(imgs.to(self.dtype)).latent_dist
+        latents = posterior.sample().float() * 0.18215
 
         return latents
 
@@ -281,13 +497,14 @@ if __name__ == '__main__':
     parser.add_argument('-W', type=int, default=512)
     parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--profile', type=str, default='default', choices=list(MEMORY_PROFILES.keys()))
     opt = parser.parse_args()
 
     seed_everything(opt.seed)
 
     device = torch.device('cpu')
 
-    sd = StableDiffusion(device)
+    sd = StableDiffusion(device, memory_profile=opt.profile)
 
     imgs = sd.prompt_to_img(opt.prompt, opt.negative, opt.H, opt.W, opt.steps)
 
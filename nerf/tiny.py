@@ -0,0 +1,235 @@
+import math
+import zlib
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .cfg_cache import CFGCache
+
+# a randomly initialized stand-in for StableDiffusion with the same interfaces, for offline benchmarking of the renderer, trainer & I/O.
+# nothing is downloaded, and the cost of the denoiser is configurable (channels & layers).
+# the guidance it gives is meaningless, only the shapes & the amount of compute mimic the real model.
+
+class TinyTextEncoder(nn.Module):
+    # hashed word tokens --> [N, max_length, dim]
+    def __init__(self, dim=768, vocab_size=4096, max_length=77):
+        super().__init__()
+        self.vocab_size = vocab_size
+        self.max_length = max_length
+        self.embedding = nn.Embedding(vocab_size, dim)
+        self.position = nn.Parameter(torch.randn(max_length, dim) * 0.02)
+        self.net = nn.Sequential(nn.Linear(dim, dim), nn.GELU(), nn.Linear(dim, dim))
+
+    def tokenize(self, prompts):
+        # prompts: [str] * N
+        # return: int64 [N, max_length], 0 is the padding token
+        tokens = torch.zeros(len(prompts), self.max_length, dtype=torch.long)
+        for i, prompt in enumerate(prompts):
+            words = prompt.lower().replace(',', ' , ').split()[:self.max_length]
+            for j, word in enumerate(words):
+                tokens[i, j] = 1 + zlib.crc32(word.encode('utf-8')) % (self.vocab_size - 1)
+        return tokens
+
+    def forward(self, tokens):
+        h = self.embedding(tokens) + self.position[None]
+        return h + self.net(h)
+
+
+class TinyDenoiser(nn.Module):
+    # conv stack conditioned on the timestep and the pooled text embedding.
+    def __init__(self, in_channels=4, channels=64, num_layers=4, text_dim=768):
+        super().__init__()
+        self.in_channels = in_channels
+        self.channels = channels
+        self.num_layers = num_layers
+
+        self.conv_in = nn.Conv2d(in_channels, channels, 3, padding=1)
+        self.convs = nn.ModuleList([nn.Conv2d(channels, channels, 3, padding=1) for _ in range(num_layers)])
+        self.cond = nn.Linear(channels + text_dim, channels * num_layers)
+        self.conv_out = nn.Conv2d(channels, in_channels, 3, padding=1)
+
+    def timestep_embedding(self, t):
+        # t: [B], int64
+        half = self.channels // 2
+        freqs = torch.exp(-math.log(10000) * torch.arange(half, dtype=torch.float32, device=t.device) / half)
+        args = t.float()[:, None] * freqs[None]
+        return torch.cat([torch.sin(args), torch.cos(args)], dim=-1) # [B, channels]
+
+    def forward(self, x, t, encoder_hidden_states):
+        # x: [B, 4, h, w], t: [B] or scalar, encoder_hidden_states: [B, 77, text_dim]
+        B = x.shape[0]
+        t = t.reshape(-1).expand(B)
+
+        cond = torch.cat([self.timestep_embedding(t), encoder_hidden_states.mean(dim=1)], dim=-1)
+        cond = self.cond(cond.to(x.dtype)).view(B, self.num_layers, self.channels, 1, 1)
+
+        h = self.conv_in(x)
+        for l in range(self.num_layers):
+            h = h + F.silu(self.convs[l](h) + cond[:, l])
+        return self.conv_out(h)
+
+    def flops(self, h, w):
+        # multiply-adds of one forward at latent resolution h x w, x 2
+        per_pixel = 9 * self.in_channels * self.channels * 2 + 9 * self.channels * self.channels * self.num_layers
+        return 2 * per_pixel * h * w
+
+
+class TinyGuidance(nn.Module):
+    def __init__(self, device, channels=64, num_layers=4, resolution=512, seed=0, cfg_cache_every=0, cfg_cache_buckets=4):
+        super().__init__()
+
+        self.device = device
+        self.num_train_timesteps = 1000
+        self.min_step = int(self.num_train_timesteps * 0.02)
+        self.max_step = int(self.num_train_timesteps * 0.98)
+        self.resolution = resolution # image resolution fed into the vae, latents are 8x smaller
+        self.text_encoder_id = f"tiny-{seed}" # identifies the cached text embeddings
+
+        print(f'[INFO] loading tiny guidance (random weights)...')
+
+        # fixed random weights, independent of the global seed (manual_seed also reseeds cuda, so fork the cuda generator too)
+        with torch.random.fork_rng(devices=[self.device] if self.device.type == 'cuda' else []):
+            torch.manual_seed(seed)
+
+            self.text_encoder = TinyTextEncoder().to(self.device)
+            self.vae_encoder = nn.Conv2d(3, 8, 8, stride=8).to(self.device) # mean & logvar
+            self.vae_decoder = nn.ConvTranspose2d(4, 3, 8, stride=8).to(self.device)
+            self.unet = TinyDenoiser(channels=channels, num_layers=num_layers).to(self.device)
+
+        # same noise schedule as stable diffusion (scaled_linear)
+        betas = torch.linspace(0.00085 ** 0.5, 0.012 ** 0.5, self.num_train_timesteps, dtype=torch.float32) ** 2
+        self.alphas = torch.cumprod(1.0 - betas, dim=0).to(self.device) # alphas_cumprod, same naming as StableDiffusion
+
+        latent_res = self.resolution // 8
+
+        self.cfg_cache = CFGCache(every=cfg_cache_every, num_buckets=cfg_cache_buckets, num_train_timesteps=self.num_train_timesteps)
+        self.cfg_cache.flops_per_latent = self.unet.flops(latent_res, latent_res)
+        print(f'[INFO] loaded tiny guidance! unet: {self.unet.flops(latent_res, latent_res) / 1e9:.3f} GFLOPs per latent (x2 with guidance)')
+
+    @property
+    def text_encoder_dtype(self):
+        return self.text_encoder.position.dtype
+
+    def get_text_embeds(self, prompt, negative_prompt):
+        # prompt, negative_prompt: [str]
+        with torch.no_grad():
+            text_embeddings = self.text_encoder(self.text_encoder.tokenize(prompt).to(self.device))
+            uncond_embeddings = self.text_encoder(self.text_encoder.tokenize(negative_prompt).to(self.device))
+
+        # Cat for final embeddings
+        text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
+        return text_embeddings
+
+    def add_noise(self, latents, noise, t):
+        # t: [B] or scalar
+        alphas = self.alphas[t].reshape(-1, 1, 1, 1)
+        return alphas ** 0.5 * latents + (1 - alphas) ** 0.5 * noise
+
+    def unet_forward(self, latents, t, text_embeddings):
+        # same as StableDiffusion.unet_forward
+        return self.unet(latents, t, encoder_hidden_states=text_embeddings)
+
+    def train_step(self, text_embeddings, pred_rgb, iteration, d, guidance_scale=100):
+        # same as StableDiffusion.train_step, without the visualizations.
+        B = pred_rgb.shape[0]
+
+        if text_embeddings.shape[0] != 2 * B:
+            text_embeddings = text_embeddings.repeat_interleave(B, dim=0) # [2 * B, 77, 768]
+
+        t = torch.randint(self.min_step, self.max_step + 1, [B], dtype=torch.long, device=self.device)
+
+        if pred_rgb.shape[1] == 4:
+            # latent mode: the rendered latents are used directly, requires grad!
+            latents = pred_rgb
+        else:
+            pred_rgb = F.interpolate(pred_rgb, (self.resolution, self.resolution), mode='bilinear', align_corners=False)
+
+            # encode image into latents, requires grad!
+            latents = self.encode_imgs(pred_rgb)
+
+        with torch.no_grad():
+            noise = torch.randn_like(latents)
+            latents_noisy = self.add_noise(latents, noise, t)
+            keys = list(enumerate([None] * B if d is None else d.tolist())) # batch slot & direction
+            noise_pred_uncond, noise_pred_text = self.cfg_cache.predict(self.unet_forward, latents_noisy, noise, t, text_embeddings, keys, iteration)
+
+        noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+        # w(t), sigma_t^2
+        w = (1 - self.alphas[t]).view(B, 1, 1, 1)
+        grad = w * (noise_pred - noise)
+        grad = torch.nan_to_num(grad)
+
+        latents.backward(gradient=grad, retain_graph=True)
+
+        return 0 # dummy loss value
+
+    def produce_latents(self, text_embeddings, height=512, width=512, num_inference_steps=50, guidance_scale=7.5, latents=None):
+        # deterministic DDIM sampling
+
+        if latents is None:
+            latents = torch.randn((text_embeddings.shape[0] // 2, self.unet.in_channels, height // 8, width // 8), device=self.device)
+
+        timesteps = torch.linspace(self.num_train_timesteps - 1, 0, num_inference_steps, device=self.device).long()
+
+        with torch.no_grad():
+            for i, t in enumerate(timesteps):
+                latent_model_input = torch.cat([latents] * 2)
+                noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings)
+
+                noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+                # x_t --> x_0 --> x_{t-1}
+                alpha = self.alphas[t]
+                alpha_prev = self.alphas[timesteps[i + 1]] if i + 1 < len(timesteps) else torch.ones_like(alpha)
+                pred_x0 = (latents - (1 - alpha) ** 0.5 * noise_pred) / alpha ** 0.5
+                latents = alpha_prev ** 0.5 * pred_x0 + (1 - alpha_prev) ** 0.5 * noise_pred
+
+        return latents
+
+    def decode_latents(self, latents):
+
+        latents = 1 / 0.18215 * latents
+
+        with torch.no_grad():
+            imgs = self.vae_decoder(latents)
+
+        imgs = (imgs / 2 + 0.5).clamp(0, 1)
+
+        return imgs
+
+    def encode_imgs(self, imgs):
+        # imgs: [B, 3, H, W]
+
+        imgs = 2 * imgs - 1
+
+        mean, logvar = self.vae_encoder(imgs).chunk(2, dim=1)
+        latents = mean + torch.exp(0.5 * logvar.clamp(-30, 20)) * torch.randn_like(mean)
+        latents = latents * 0.18215
+
+        return latents
+
+    def prompt_to_img(self, prompts, negative_prompts='', height=512, width=512, num_inference_steps=50, guidance_scale=7.5, latents=None):
+
+        if isinstance(prompts, str):
+            prompts = [prompts]
+
+        if isinstance(negative_prompts, str):
+            negative_prompts = [negative_prompts] * len(prompts)
+
+        # Prompts -> text embeds
+        text_embeds = self.get_text_embeds(prompts, negative_prompts) # [2, 77, 768]
+
+        # Text embeds -> img latents
+        latents = self.produce_latents(text_embeds, height=height, width=width, latents=latents, num_inference_steps=num_inference_steps, guidance_scale=guidance_scale) # [1, 4, 64, 64]
+
+        # Img latents -> imgs
+        imgs = self.decode_latents(latents) # [1, 3, 512, 512]
+
+        # Img to Numpy
+        imgs = imgs.detach().cpu().permute(0, 2, 3, 1).numpy()
+        imgs = (imgs * 255).round().astype('uint8')
+
+        return imgs
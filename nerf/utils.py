@@ -1,5 +1,7 @@
 import os
 import glob
+import json
+import hashlib
 import tqdm
 import math
 import imageio
@@ -148,6 +150,69 @@ def srgb_to_linear(x):
     return torch.where(x < 0.04045, x / 12.92, ((x + 0.055) / 1.055) ** 2.4)
 
 
+class GridUpdateScheduler(object):
+    # decide when to update the density/occupancy grid, from how much the occupancy changed at the last update.
+    # the interval is doubled when the ratio of flipped cells is below flip_low, and halved when above flip_high.
+    def __init__(self, interval=16, min_interval=16, max_interval=16, flip_low=0.01, flip_high=0.05):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        self.flip_low = flip_low
+        self.flip_high = flip_high
+        self.next_step = 0 # global step of the next update
+        self.num_updates = 0
+
+    def should_update(self, step):
+        return step >= self.next_step
+
+    def step(self, step, flip_rate):
+        # call after each update.
+        if flip_rate < self.flip_low:
+            self.interval = min(self.interval * 2, self.max_interval)
+        elif flip_rate > self.flip_high:
+            self.interval = max(self.interval // 2, self.min_interval)
+        self.next_step = step + self.interval
+        self.num_updates += 1
+
+    def state_dict(self):
+        return {'interval': self.interval, 'next_step': self.next_step, 'num_updates': self.num_updates}
+
+    def load_state_dict(self, state_dict):
+        self.interval = state_dict['interval']
+        self.next_step = state_dict['next_step']
+        self.num_updates = state_dict['num_updates']
+
+
+class TextEmbeddingCache(object):
+    # content-addressed on-disk cache of text embeddings, keyed by (text encoder, its dtype, prompt, negative prompt).
+    def __init__(self, path, encoder_id, encoder_dtype=None):
+        self.path = path
+        self.encoder_id = encoder_id
+        self.encoder_dtype = str(encoder_dtype) # e.g. fp16 & fp32 embeddings are cached separately
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, text, negative_text):
+        content = json.dumps([self.encoder_id, self.encoder_dtype, text, negative_text])
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def load(self, text, negative_text):
+        file = os.path.join(self.path, f'{self.key(text, negative_text)}.pt')
+        if not os.path.exists(file):
+            return None
+        try:
+            return torch.load(file, map_location='cpu')
+        except Exception:
+            # corrupted entry, re-encode
+            return None
+
+    def save(self, text, negative_text, text_z):
+        file = os.path.join(self.path, f'{self.key(text, negative_text)}.pt')
+        # write to a temp file first, so concurrent processes never read a partial entry.
+        tmp_file = f'{file}.{os.getpid()}.tmp'
+        torch.save(text_z.detach().cpu(), tmp_file)
+        os.replace(tmp_file, file)
+
+
 class Trainer(object):
     def __init__(self, 
                  name, # name of this experiment
@@ -205,17 +270,6 @@ class Trainer(object):
         # guide model
         self.guidance = guidance
 
-        # text prompt
-        if self.guidance is not None:
-            
-            for p in self.guidance.parameters():
-                p.requires_grad = False
-
-            self.prepare_text_embeddings()
-        
-        else:
-            self.text_z = None
-    
         if isinstance(criterion, nn.Module):
             criterion.to(self.device)
         self.criterion = criterion
@@ -230,6 +284,12 @@ class Trainer(object):
         else:
             self.lr_scheduler = lr_scheduler(self.optimizer)
 
+        # density/occupancy grid update cadence
+        if self.opt.adaptive_update_extra:
+            self.grid_scheduler = GridUpdateScheduler(self.opt.update_extra_interval, self.opt.update_extra_min_interval, self.opt.update_extra_max_interval, self.opt.update_extra_flip_low, self.opt.update_extra_flip_high)
+        else:
+            self.grid_scheduler = GridUpdateScheduler(self.opt.update_extra_interval, self.opt.update_extra_interval, self.opt.update_extra_interval)
+
         if ema_decay is not None:
             self.ema = ExponentialMovingAverage(self.model.parameters(), decay=ema_decay)
         else:
@@ -241,6 +301,8 @@ class Trainer(object):
         self.epoch = 0
         self.global_step = 0
         self.local_step = 0
+        self.surface_t_checked = False # deferred shading with cuda raymarching, see train_step
+        self.writer = None
         self.stats = {
             "loss": [],
             "valid_loss": [],
@@ -267,6 +329,21 @@ class Trainer(object):
         self.log(f'[INFO] Trainer: {self.name} | {self.time_stamp} | {self.device} | {"fp16" if self.fp16 else "fp32"} | {self.workspace}')
         self.log(f'[INFO] #parameters: {sum([p.numel() for p in model.parameters() if p.requires_grad])}')
 
+        # text prompt (after the log is ready, to report the embedding cache)
+        if self.guidance is not None:
+            
+            for p in self.guidance.parameters():
+                p.requires_grad = False
+
+            self.prepare_text_embeddings()
+
+            # the text encoder is not needed in training anymore (memory profiles of stable diffusion)
+            if hasattr(self.guidance, 'offload_text_encoder'):
+                self.guidance.offload_text_encoder()
+        
+        else:
+            self.text_z = None
+
         if self.workspace is not None:
             if self.use_checkpoint == "scratch":
                 self.log("[INFO] Training from scratch ...")
@@ -290,35 +367,74 @@ class Trainer(object):
     # calculate the text embs.
     def prepare_text_embeddings(self):
 
-        if self.opt.text is None:
+        if self.opt.text is None and len(self.opt.scenes) == 0:
             self.log(f"[WARN] text prompt is not provided.")
             self.text_z = None
             return
 
+        # multi-scene training: one prompt per scene
+        prompts = self.opt.scenes if len(self.opt.scenes) > 0 else [self.opt.text]
+
         if not self.opt.dir_text:
-            self.text_z = self.guidance.get_text_embeds([self.opt.text], [self.opt.negative])
+            text_z = self.get_text_embeds(prompts, [self.opt.negative] * len(prompts))
         else:
-            self.text_z = []
             self.text = []
-            for d in ['front', 'left side', 'back', 'right side', 'overhead', 'bottom']:
-                # construct dir-encoded text
-                text = f"{self.opt.text}, {d} view"
-                self.text.append(text)
-
-                negative_text = f"{self.opt.negative}"
-
-                # explicit negative dir-encoded text
-                if self.opt.suppress_face:
-                    if negative_text != '': negative_text += ', '
-
-                    if d == 'back': negative_text += "face"
-                    # elif d == 'front': negative_text += ""
-                    elif d == 'side': negative_text += "face"
-                    elif d == 'overhead': negative_text += "face"
-                    elif d == 'bottom': negative_text += "face"
-                
-                text_z = self.guidance.get_text_embeds([text], [negative_text])
-                self.text_z.append(text_z)
+            negative_texts = []
+            for prompt in prompts:
+                for d in ['front', 'left side', 'back', 'right side', 'overhead', 'bottom']:
+                    # construct dir-encoded text
+                    text = f"{prompt}, {d} view"
+                    self.text.append(text)
+
+                    negative_text = f"{self.opt.negative}"
+
+                    # explicit negative dir-encoded text
+                    if self.opt.suppress_face:
+                        if negative_text != '': negative_text += ', '
+
+                        if d == 'back': negative_text += "face"
+                        # elif d == 'front': negative_text += ""
+                        elif d == 'side': negative_text += "face"
+                        elif d == 'overhead': negative_text += "face"
+                        elif d == 'bottom': negative_text += "face"
+                    
+                    negative_texts.append(negative_text)
+
+            # all prompts & directions are encoded in one batch
+            text_z = self.get_text_embeds(self.text, negative_texts)
+            text_z = [text_z[i:i+6] for i in range(0, len(text_z), 6)] # per prompt
+
+        # a list of per-scene embeddings in multi-scene training
+        self.text_z = text_z if len(self.opt.scenes) > 0 else text_z[0]
+
+    def get_text_embeds(self, texts, negative_texts):
+        # texts, negative_texts: [str] * N
+        # return: list of N text embeddings, each in the layout of guidance.get_text_embeds([text], [negative_text])
+        # cached embeddings are loaded from disk, the others are encoded in a single batch.
+
+        cache = TextEmbeddingCache(self.opt.text_cache, getattr(self.guidance, 'text_encoder_id', type(self.guidance).__name__), getattr(self.guidance, 'text_encoder_dtype', None)) if self.opt.text_cache else None
+
+        results = [None] * len(texts)
+        if cache is not None:
+            for i in range(len(texts)):
+                results[i] = cache.load(texts[i], negative_texts[i])
+
+        misses = [i for i in range(len(texts)) if results[i] is None]
+
+        if len(misses) > 0:
+            text_z = self.guidance.get_text_embeds([texts[i] for i in misses], [negative_texts[i] for i in misses])
+
+            # stable diffusion returns [uncond * M, cond * M], clip returns [M, C]
+            M = len(misses)
+            for k, i in enumerate(misses):
+                results[i] = text_z[[k, M + k]] if text_z.shape[0] == 2 * M else text_z[k:k+1]
+                if cache is not None:
+                    cache.save(texts[i], negative_texts[i], results[i])
+
+        if cache is not None:
+            self.log(f"[INFO] text embeddings: {len(texts) - len(misses)} cache hits, {len(misses)} misses ({self.opt.text_cache})")
+
+        return [text_z.to(self.device) for text_z in results]
 
     def __del__(self):
         if self.log_ptr: 
@@ -336,6 +452,23 @@ class Trainer(object):
 
     ### ------------------------------	
 
+    def get_text_z(self, data):
+        # return: text embeddings of the batch, view directions [B,] (None if not dir_text)
+        if len(self.opt.scenes) > 0:
+            # multi-scene: view b is rendered by scene b
+            dirs = data['dir'] if self.opt.dir_text else None # [B,]
+            text_z = [self.text_z[b][d] for b, d in enumerate(dirs.tolist())] if self.opt.dir_text else self.text_z
+            text_z = torch.stack(text_z, dim=1).flatten(0, 1) # [2 * B, 77, 768]
+        elif self.opt.dir_text:
+            dirs = data['dir'] # [B,]
+            # per-view embeddings, [2, 77, 768] each --> [2 * B, 77, 768], uncond of all views then cond of all views
+            text_z = torch.stack([self.text_z[d] for d in dirs.tolist()], dim=1).flatten(0, 1)
+        else:
+            text_z = self.text_z
+            dirs = None
+
+        return text_z, dirs
+
     def train_step(self, data, iteration):
 
         rays_o = data['rays_o'] # [B, N, 3]
@@ -345,7 +478,11 @@ class Trainer(object):
         H, W = data['H'], data['W']
 
         # TODO: shading is not working right now...
-        if self.global_step < self.opt.albedo_iters:
+        if self.opt.latent:
+            # latents are not shaded
+            shading = 'albedo'
+            ambient_ratio = 1.0
+        elif self.global_step < self.opt.albedo_iters:
             shading = 'albedo'
             ambient_ratio = 1.0
         else: 
@@ -361,21 +498,32 @@ class Trainer(object):
                 ambient_ratio = 0.1
 
         # _t = time.time()
-        bg_color = torch.rand((B * N, 3), device=rays_o.device) # pixel-wise random
+        if self.opt.latent:
+            bg_color = torch.randn((B * N, self.model.latent_dim), device=rays_o.device) # pixel-wise random latents
+        else:
+            bg_color = torch.rand((B * N, 3), device=rays_o.device) # pixel-wise random
+
+        # the training and the inference composites must place the deferred shading point at the same surface, check once.
+        if self.opt.cuda_ray and self.opt.deferred_shading and shading != 'albedo' and not self.surface_t_checked:
+            err = self.model.check_surface_t(rays_o, rays_d, **vars(self.opt))
+            if err is not None:
+                self.log(f"[INFO] deferred shading: max surface distance error between training and inference = {err:.4f}")
+                if err > 0.05:
+                    self.log(f"[WARN] deferred shading is shaded at different surfaces in training and inference!")
+                self.surface_t_checked = True
+
+        if self.opt.backward_chunk > 0:
+            return self.train_step_two_pass(data, iteration, shading, ambient_ratio, bg_color)
+
         outputs = self.model.render(rays_o, rays_d, staged=False, perturb=True, bg_color=bg_color, ambient_ratio=ambient_ratio, shading=shading, force_all_rays=True, **vars(self.opt))
-        pred_rgb = outputs['image'].reshape(B, H, W, 3).permute(0, 3, 1, 2).contiguous() # [1, 3, H, W]
+        pred_rgb = outputs['image'].reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous() # [B, 3, H, W], or latents [B, 4, H, W]
         # torch.cuda.synchronize(); print(f'[TIME] nerf render {time.time() - _t:.4f}s')
         
         # print(shading)
         # torch_vis_2d(pred_rgb[0])
         
         # text embeddings
-        if self.opt.dir_text:
-            dirs = data['dir'] # [B,]
-            text_z = self.text_z[dirs]
-        else:
-            text_z = self.text_z
-            dirs = None
+        text_z, dirs = self.get_text_z(data)
         
         # encode pred_rgb to latents
         # _t = time.time()
@@ -406,6 +554,165 @@ class Trainer(object):
             
         return pred_rgb, pred_ws, loss
 
+    def train_step_two_pass(self, data, iteration, shading, ambient_ratio, bg_color):
+        # peak memory only depends on --backward_chunk instead of H * W:
+        # 1. render the full image without grad, and get dL/dpred_rgb (and dL/dpred_ws) from the guidance.
+        # 2. re-render the rays in chunks with grad, and backward each chunk with its slice of the image gradient.
+        # the backward is done here, the returned loss is only for logging.
+
+        rays_o = data['rays_o'] # [B, N, 3]
+        rays_d = data['rays_d'] # [B, N, 3]
+
+        B, N = rays_o.shape[:2]
+        H, W = data['H'], data['W']
+        device = rays_o.device
+        chunk = self.opt.backward_chunk
+
+        # both passes must render exactly the same samples: fix the light direction, and the random seed of each chunk.
+        light_d = safe_normalize(rays_o[:, 0] + torch.randn(B, 3, device=device, dtype=torch.float)) # [B, 3]
+        bg_color = bg_color.view(B, N, -1)
+        C = bg_color.shape[-1] # 3, or 4 in latent mode
+        seed = random.randint(0, 2 ** 31 - 1)
+        rng_devices = [device] if device.type == 'cuda' else []
+
+        def render_chunk(head, tail):
+            with torch.random.fork_rng(devices=rng_devices):
+                torch.manual_seed(seed + head)
+                return self.model.render(rays_o[:, head:tail], rays_d[:, head:tail], staged=False, perturb=True, bg_color=bg_color[:, head:tail].reshape(-1, C), light_d=light_d, ambient_ratio=ambient_ratio, shading=shading, force_all_rays=True, **vars(self.opt))
+
+        # pass 1
+        images = []
+        weights_sums = []
+        with torch.no_grad():
+            for head in range(0, N, chunk):
+                outputs = render_chunk(head, min(head + chunk, N))
+                images.append(outputs['image'].reshape(B, -1, C))
+                weights_sums.append(outputs['weights_sum'].reshape(B, -1))
+
+        pred_rgb = torch.cat(images, dim=1).reshape(B, H, W, C).permute(0, 3, 1, 2).contiguous().float().requires_grad_(True) # [B, C, H, W]
+        pred_ws = torch.cat(weights_sums, dim=1).reshape(B, 1, H, W).float().requires_grad_(True)
+
+        text_z, dirs = self.get_text_z(data)
+
+        # the guidance backwards into pred_rgb by itself, or returns a loss of pred_rgb.
+        loss = self.guidance.train_step(text_z, pred_rgb, iteration=iteration, d=dirs)
+
+        if self.opt.lambda_opacity > 0:
+            loss_opacity = (pred_ws ** 2).mean()
+            loss = loss + self.opt.lambda_opacity * loss_opacity
+
+        if self.opt.lambda_entropy > 0:
+            alphas = (pred_ws).clamp(1e-5, 1 - 1e-5)
+            loss_entropy = (- alphas * torch.log2(alphas) - (1 - alphas) * torch.log2(1 - alphas)).mean()
+            loss = loss + self.opt.lambda_entropy * loss_entropy
+
+        if torch.is_tensor(loss) and loss.requires_grad:
+            self.scaler.scale(loss).backward()
+
+        grad_rgb = None if pred_rgb.grad is None else pred_rgb.grad.permute(0, 2, 3, 1).reshape(B, N, C)
+        grad_ws = None if pred_ws.grad is None else pred_ws.grad.reshape(B, N)
+
+        # pass 2
+        loss = float(loss)
+        for head in range(0, N, chunk):
+            tail = min(head + chunk, N)
+            outputs = render_chunk(head, tail)
+
+            # surrogate loss, its gradient w.r.t. the chunk outputs is the slice of the image gradient.
+            chunk_loss = 0
+            if grad_rgb is not None:
+                chunk_loss = chunk_loss + (outputs['image'].reshape(B, -1, C) * grad_rgb[:, head:tail]).sum()
+            if grad_ws is not None:
+                chunk_loss = chunk_loss + (outputs['weights_sum'].reshape(B, -1) * grad_ws[:, head:tail]).sum()
+
+            # regularizations are averaged over rays, weight each chunk by its share.
+            loss_reg = 0
+            if self.opt.lambda_orient > 0 and 'loss_orient' in outputs:
+                loss_reg = loss_reg + self.opt.lambda_orient * outputs['loss_orient'] * (tail - head) / N
+            if self.opt.lambda_smooth > 0 and 'loss_smooth' in outputs:
+                loss_reg = loss_reg + self.opt.lambda_smooth * outputs['loss_smooth'] * (tail - head) / N
+            
+            if torch.is_tensor(loss_reg):
+                chunk_loss = chunk_loss + self.scaler.scale(loss_reg)
+                loss += loss_reg.item()
+
+            if torch.is_tensor(chunk_loss):
+                chunk_loss.backward()
+
+        loss = torch.tensor(loss, device=device)
+
+        return pred_rgb.detach(), pred_ws.detach(), loss
+
+    def finetune_rgb(self, loader, iters):
+        # latent mode: render latents & rgb together, and fit the rgb head to the vae decoded latents.
+        # only the rgb head is trained, the geometry & latents are frozen.
+        self.log(f"==> Start fine-tuning the rgb head for {iters} iterations ...")
+
+        model = self.model
+        rgb_params = list(model.rgb_net.parameters())
+        requires_grad = {p: p.requires_grad for p in model.parameters()}
+        for p in model.parameters():
+            p.requires_grad_(False)
+        for p in rgb_params:
+            p.requires_grad_(True)
+
+        optimizer = torch.optim.Adam(rgb_params, lr=self.opt.lr * 10, betas=(0.9, 0.99), eps=1e-15)
+
+        model.train()
+        model.rgb_finetune = True
+        C = model.latent_dim
+
+        # white background in both spaces
+        with torch.no_grad():
+            bg_latent = self.guidance.encode_imgs(torch.ones(1, 3, 512, 512, device=self.device)).mean(dim=(0, 2, 3)) # [4]
+        bg_color = torch.cat([bg_latent, torch.ones(3, device=self.device)]) # [4 + 3]
+
+        if self.local_rank == 0:
+            pbar = tqdm.tqdm(total=iters, bar_format='{desc}: {percentage:3.0f}% {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]')
+
+        step = 0
+        while step < iters:
+            for data in loader:
+                rays_o = data['rays_o'] # [B, N, 3]
+                rays_d = data['rays_d'] # [B, N, 3]
+                B, N = rays_o.shape[:2]
+                H, W = data['H'], data['W']
+
+                with torch.cuda.amp.autocast(enabled=self.fp16):
+                    outputs = model.render(rays_o, rays_d, staged=False, perturb=True, bg_color=bg_color, ambient_ratio=1.0, shading='albedo', force_all_rays=True, **vars(self.opt))
+                    image = outputs['image'].reshape(B, H, W, -1).permute(0, 3, 1, 2) # [B, 4 + 3, H, W]
+                    latents, pred_rgb = image[:, :C], image[:, C:]
+
+                    with torch.no_grad():
+                        gt_rgb = self.guidance.decode_latents(latents.float()) # [B, 3, 512, 512]
+                        gt_rgb = F.interpolate(gt_rgb, (H, W), mode='area')
+
+                    loss = F.mse_loss(pred_rgb.float(), gt_rgb)
+
+                optimizer.zero_grad()
+                self.scaler.scale(loss).backward()
+                self.scaler.step(optimizer)
+                self.scaler.update()
+
+                step += 1
+                if self.local_rank == 0:
+                    pbar.set_description(f"loss={loss.item():.6f}")
+                    pbar.update(1)
+                    if self.use_tensorboardX:
+                        self.writer.add_scalar("train/loss_rgb", loss.item(), self.global_step + step)
+
+                if step >= iters:
+                    break
+
+        if self.local_rank == 0:
+            pbar.close()
+
+        model.rgb_finetune = False
+        for p, r in requires_grad.items():
+            p.requires_grad_(r)
+
+        self.log(f"==> Finished fine-tuning the rgb head.")
+
     def eval_step(self, data):
 
         rays_o = data['rays_o'] # [B, N, 3]
@@ -459,7 +766,7 @@ class Trainer(object):
         return pred_rgb, pred_depth
 
 
-    def save_mesh(self, save_path=None, resolution=128):
+    def save_mesh(self, save_path=None, resolution=128, format='obj'):
 
         if save_path is None:
             save_path = os.path.join(self.workspace, 'mesh')
@@ -468,7 +775,8 @@ class Trainer(object):
 
         os.makedirs(save_path, exist_ok=True)
 
-        self.model.export_mesh(save_path, resolution=resolution)
+        self.model.eval() # rgb texture in latent mode
+        self.model.export_mesh(save_path, resolution=resolution, format=format)
 
         self.log(f"==> Finished saving mesh.")
 
@@ -494,9 +802,23 @@ class Trainer(object):
                 self.save_checkpoint(full=True, best=False)
 
             if self.epoch % self.eval_interval == 0:
-                self.evaluate_one_epoch(valid_loader)
+                if len(self.opt.scenes) > 0:
+                    # multi-scene: validate each scene
+                    for k in range(len(self.opt.scenes)):
+                        self.model.select_scene(k)
+                        self.evaluate_one_epoch(valid_loader, name=f'{self.name}_ep{self.epoch:04d}_scene{k}')
+                    self.model.select_scene(None)
+                else:
+                    self.evaluate_one_epoch(valid_loader)
                 self.save_checkpoint(full=False, best=True)
 
+        # latent mode: fit the rgb head to the decoded latents before evaluation & export
+        if self.opt.latent and self.opt.rgb_finetune_iters > 0:
+            self.finetune_rgb(train_loader, self.opt.rgb_finetune_iters)
+
+            if self.workspace is not None and self.local_rank == 0:
+                self.save_checkpoint(full=True, best=False)
+
         end_t = time.time()
 
         self.log(f"[INFO] training takes {(end_t - start_t)/ 60:.4f} minutes.")
@@ -559,6 +881,23 @@ class Trainer(object):
 
         self.log(f"==> Finished Test.")
     
+    # update the density/occupancy grid when the scheduler asks for it.
+    def update_extra_state(self):
+
+        if not (self.model.cuda_ray or self.model.occ_grid) or not self.grid_scheduler.should_update(self.global_step):
+            return
+
+        with torch.cuda.amp.autocast(enabled=self.fp16):
+            self.model.update_extra_state()
+
+        self.grid_scheduler.step(self.global_step, self.model.flip_rate)
+
+        if self.local_rank == 0 and self.writer is not None:
+            self.writer.add_scalar("grid/occ_rate", self.model.occ_rate, self.global_step)
+            self.writer.add_scalar("grid/flip_rate", self.model.flip_rate, self.global_step)
+            self.writer.add_scalar("grid/interval", self.grid_scheduler.interval, self.global_step)
+            self.writer.add_scalar("grid/num_updates", self.grid_scheduler.num_updates, self.global_step)
+
     # [GUI] train text step.
     def train_gui(self, train_loader, step=16):
 
@@ -577,19 +916,19 @@ class Trainer(object):
                 loader = iter(train_loader)
                 data = next(loader)
 
-            # update grid every 16 steps
-            if self.model.cuda_ray and self.global_step % self.opt.update_extra_interval == 0:
-                with torch.cuda.amp.autocast(enabled=self.fp16):
-                    self.model.update_extra_state()
+            # update grid every 16 steps (or adaptively)
+            self.update_extra_state()
             
             self.global_step += 1
 
             self.optimizer.zero_grad()
 
             with torch.cuda.amp.autocast(enabled=self.fp16):
-                pred_rgbs, pred_ws, loss = self.train_step(data)
+                pred_rgbs, pred_ws, loss = self.train_step(data, iteration=self.global_step)
          
-            self.scaler.scale(loss).backward()
+            # the two-pass train step has already backwarded.
+            if self.opt.backward_chunk <= 0:
+                self.scaler.scale(loss).backward()
             self.scaler.step(self.optimizer)
             self.scaler.update()
             
@@ -697,10 +1036,8 @@ class Trainer(object):
 
         for i, data in enumerate(loader):
             
-            # update grid every 16 steps
-            if self.model.cuda_ray and self.global_step % self.opt.update_extra_interval == 0:
-                with torch.cuda.amp.autocast(enabled=self.fp16):
-                    self.model.update_extra_state()
+            # update grid every 16 steps (or adaptively)
+            self.update_extra_state()
                     
             self.local_step += 1
             self.global_step += 1
@@ -710,7 +1047,9 @@ class Trainer(object):
             with torch.cuda.amp.autocast(enabled=self.fp16):
                 pred_rgbs, pred_ws, loss = self.train_step(data, iteration=((epoch-1)*len(loader)+i))
          
-            self.scaler.scale(loss).backward()
+            # the two-pass train step has already backwarded.
+            if self.opt.backward_chunk <= 0:
+                self.scaler.scale(loss).backward()
             self.scaler.step(self.optimizer)
             self.scaler.update()
 
@@ -728,6 +1067,12 @@ class Trainer(object):
                 if self.use_tensorboardX:
                     self.writer.add_scalar("train/loss", loss_val, self.global_step)
                     self.writer.add_scalar("train/lr", self.optimizer.param_groups[0]['lr'], self.global_step)
+                    if self.model.occ_grid:
+                        self.writer.add_scalar("train/skipped_samples_per_ray", float(self.model.skipped_samples), self.global_step)
+                    cfg_cache = getattr(self.guidance, 'cfg_cache', None)
+                    if cfg_cache is not None and cfg_cache.enabled:
+                        self.writer.add_scalar("train/cfg_cache_hit_ratio", cfg_cache.hit_ratio(), self.global_step)
+                        self.writer.add_scalar("train/cfg_cache_tflops_saved", cfg_cache.flops_saved / 1e12, self.global_step)
 
                 if self.scheduler_update_every_step:
                     pbar.set_description(f"loss={loss_val:.4f} ({total_loss/self.local_step:.4f}), lr={self.optimizer.param_groups[0]['lr']:.6f}")
@@ -761,6 +1106,10 @@ class Trainer(object):
             else:
                 self.lr_scheduler.step()
 
+        cfg_cache = getattr(self.guidance, 'cfg_cache', None)
+        if cfg_cache is not None and cfg_cache.enabled:
+            self.log(cfg_cache.report())
+
         self.log(f"==> Finished Epoch {self.epoch}.")
 
 
@@ -869,6 +1218,13 @@ class Trainer(object):
             state['mean_count'] = self.model.mean_count
             state['mean_density'] = self.model.mean_density
 
+        if self.model.occ_grid:
+            state['mean_density'] = self.model.mean_density
+            state['iter_density'] = self.model.iter_density
+
+        if self.model.cuda_ray or self.model.occ_grid:
+            state['grid_scheduler'] = self.grid_scheduler.state_dict()
+
         if full:
             state['optimizer'] = self.optimizer.state_dict()
             state['lr_scheduler'] = self.lr_scheduler.state_dict()
@@ -949,6 +1305,15 @@ class Trainer(object):
             if 'mean_density' in checkpoint_dict:
                 self.model.mean_density = checkpoint_dict['mean_density']
 
+        if self.model.occ_grid:
+            if 'mean_density' in checkpoint_dict:
+                self.model.mean_density = checkpoint_dict['mean_density']
+            if 'iter_density' in checkpoint_dict:
+                self.model.iter_density = checkpoint_dict['iter_density']
+
+        if 'grid_scheduler' in checkpoint_dict:
+            self.grid_scheduler.load_state_dict(checkpoint_dict['grid_scheduler'])
+
         if model_only:
             return
 
@@ -467,4 +467,94 @@ class Shampoo(optim.Optimizer):
           momentum_update.mul_(group['momentum']).add_(wd_update)
 
         # Final update
-        p.data.add_(momentum_update, alpha=-lr)    
\ No newline at end of file
+        p.data.add_(momentum_update, alpha=-lr)    
+
+class LazyAdam(optim.Optimizer):
+  """Adam that accepts both dense and sparse gradients.
+
+  Dense gradients get the usual Adam update. For sparse gradients (e.g. the
+  grid encoder with sparse_grad=True), only the rows present in the gradient
+  are updated, each with its own step count for bias correction, so rows that
+  are not touched in a step cost nothing.
+  Args:
+    params: iterable of parameters or param groups.
+    lr: learning rate.
+    betas: coefficients for the running averages of gradient and its square.
+    eps: term added to the denominator for numerical stability.
+    weight_decay: L2 penalty, only applied to the touched rows for sparse gradients.
+  """
+
+  def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.0):
+    defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+    super(LazyAdam, self).__init__(params, defaults)
+
+  @torch.no_grad()
+  def step(self, closure=None):
+    loss = None
+    if closure is not None:
+      with torch.enable_grad():
+        loss = closure()
+
+    for group in self.param_groups:
+      lr = group['lr']
+      beta1, beta2 = group['betas']
+      eps = group['eps']
+      weight_decay = group['weight_decay']
+
+      for p in group['params']:
+        if p.grad is None:
+          continue
+        grad = p.grad
+        state = self.state[p]
+
+        if len(state) == 0:
+          state['step'] = 0
+          state['exp_avg'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+          state['exp_avg_sq'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+
+        exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+        state['step'] += 1
+
+        if grad.is_sparse:
+          # row-wise lazy update
+          if 'row_step' not in state:
+            state['row_step'] = torch.zeros(p.shape[0], dtype=torch.float32, device=p.device)
+
+          grad = grad.coalesce()
+          rows = grad._indices()[0]
+          values = grad._values().to(p.dtype)
+          if rows.numel() == 0:
+            continue
+
+          if weight_decay != 0:
+            values = values + weight_decay * p[rows]
+
+          row_step = state['row_step'][rows] + 1
+          state['row_step'][rows] = row_step
+
+          m = exp_avg[rows].mul_(beta1).add_(values, alpha=1 - beta1)
+          v = exp_avg_sq[rows].mul_(beta2).addcmul_(values, values, value=1 - beta2)
+          exp_avg[rows] = m
+          exp_avg_sq[rows] = v
+
+          shape = [-1] + [1] * (p.dim() - 1)
+          bias_correction1 = (1 - beta1 ** row_step).view(shape)
+          bias_correction2 = (1 - beta2 ** row_step).view(shape)
+
+          denom = (v / bias_correction2).sqrt_().add_(eps)
+          p[rows] = p[rows] - lr * (m / bias_correction1) / denom
+
+        else:
+          if weight_decay != 0:
+            grad = grad.add(p, alpha=weight_decay)
+
+          exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+          exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+          bias_correction1 = 1 - beta1 ** state['step']
+          bias_correction2 = 1 - beta2 ** state['step']
+
+          denom = (exp_avg_sq / bias_correction2).sqrt_().add_(eps)
+          p.addcdiv_(exp_avg, denom, value=-lr / bias_correction1)
+
+    return loss
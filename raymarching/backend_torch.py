@@ -0,0 +1,380 @@
+import math
+import torch
+
+# Pure pytorch (vectorized) implementation of the `_raymarching` extension.
+# Every function mirrors the binding with the same name in `src/bindings.cpp`,
+# takes the same arguments and writes into the same pre-allocated outputs,
+# so `raymarching.py` can use it as a drop-in backend on devices without CUDA.
+
+SQRT3 = 1.7320508075688772
+
+# ----------------------------------------
+# helpers
+# ----------------------------------------
+
+def _expand_bits(v):
+    # v: int64 tensor, in [0, 1024)
+    v = (v * 0x00010001) & 0xFF0000FF
+    v = (v * 0x00000101) & 0x0F00F00F
+    v = (v * 0x00000011) & 0xC30C30C3
+    v = (v * 0x00000005) & 0x49249249
+    return v
+
+
+def _morton3D(x, y, z):
+    return _expand_bits(x) | (_expand_bits(y) << 1) | (_expand_bits(z) << 2)
+
+
+def _morton3D_invert(x):
+    x = x & 0x49249249
+    x = (x | (x >> 2)) & 0xc30c30c3
+    x = (x | (x >> 4)) & 0x0f00f00f
+    x = (x | (x >> 8)) & 0xff0000ff
+    x = (x | (x >> 16)) & 0x0000ffff
+    return x
+
+
+def _mip_level(mx, C):
+    # frexp: [0, 0.5) --> -1, [0.5, 1) --> 0, [1, 2) --> 1, [2, 4) --> 2, ...
+    _, exponent = torch.frexp(mx)
+    return exponent.long().clamp(0, C - 1)
+
+
+def _segments(rays, M):
+    # rays: int32, [N, 3], (index, offset, num_steps)
+    # return the flattened samples of all valid rays (ordered by ray, then by step)
+    #   index: [K], output slot of each sample's ray
+    #   sample: [K], position of each sample in the [M] arrays
+    #   seg: [K], which valid ray each sample belongs to
+    #   starts: [R], first sample of each valid ray in [K]
+    rays = rays.long()
+    index, offset, num_steps = rays[:, 0], rays[:, 1], rays[:, 2]
+
+    valid = (num_steps > 0) & (offset + num_steps <= M)
+    index, offset, num_steps = index[valid], offset[valid], num_steps[valid]
+
+    seg = torch.repeat_interleave(torch.arange(num_steps.shape[0], device=rays.device), num_steps)
+    starts = torch.cumsum(num_steps, 0) - num_steps
+    local = torch.arange(seg.shape[0], device=rays.device) - starts[seg]
+    sample = offset[seg] + local
+
+    return index[seg], sample, seg, starts
+
+
+def _segment_cumsum(x, seg, starts, exclusive=False):
+    # x: [K, ...], cumsum restarted at each segment, accumulated in float64 to avoid cancellation.
+    if x.shape[0] == 0:
+        return x
+    cs = torch.cumsum(x.double(), dim=0)
+    base = (cs - x.double())[starts][seg]
+    out = cs - base
+    if exclusive:
+        out = out - x.double()
+    return out
+
+
+def _march(rays_o, rays_d, t0, far, limit, grid, bound, dt_gamma, max_steps, C, H):
+    ''' march all rays simultaneously, skipping empty cells of the density bitfield.
+    Args:
+        rays_o/d: float, [R, 3]
+        t0, far: float, [R]
+        limit: int, max number of generated points per ray
+        grid: uint8, [CHHH // 8]
+    Returns:
+        ray_ids: long, [K], which ray each point belongs to
+        steps: long, [K], the point's step index along its ray
+        xyzs: float, [K, 3]
+        deltas: float, [K, 2]
+    '''
+    R = rays_o.shape[0]
+    device = rays_o.device
+
+    rd = 1 / rays_d
+    H3 = H * H * H
+    dt_min = 2 * SQRT3 / max_steps
+    dt_max = 2 * SQRT3 * (1 << (C - 1)) / H
+
+    t = t0.clone()
+    last_t = t0.clone()
+    count = torch.zeros(R, dtype=torch.long, device=device)
+
+    all_ids, all_steps, all_xyzs, all_deltas = [], [], [], []
+
+    alive = torch.nonzero(t < far, as_tuple=False).squeeze(-1)
+
+    while alive.shape[0] > 0:
+
+        o, d, ta = rays_o[alive], rays_d[alive], t[alive]
+
+        # current point
+        xyzs = (o + ta.unsqueeze(-1) * d).clamp(-bound, bound)
+        dt = (ta * dt_gamma).clamp(dt_min, dt_max)
+
+        # get mip level
+        level = torch.maximum(_mip_level(xyzs.abs().max(dim=-1)[0], C), _mip_level(dt * H * 0.5, C))
+        mip_bound = torch.clamp(torch.pow(2.0, level.to(xyzs.dtype)), max=bound)
+
+        # convert to nearest grid position
+        nxyz = (0.5 * (xyzs / mip_bound.unsqueeze(-1) + 1) * H).clamp(0, H - 1).long()
+
+        index = level * H3 + _morton3D(nxyz[:, 0], nxyz[:, 1], nxyz[:, 2])
+        occ = ((grid[index // 8].long() >> (index % 8)) & 1).bool()
+
+        # if occupied, advance a small step, and write to output
+        if occ.any():
+            ids = alive[occ]
+            t_new = ta[occ] + dt[occ]
+            all_ids.append(ids)
+            all_steps.append(count[ids])
+            all_xyzs.append(xyzs[occ])
+            all_deltas.append(torch.stack([dt[occ], t_new - last_t[ids]], dim=-1))
+            t[ids] = t_new
+            last_t[ids] = t_new
+            count[ids] += 1
+
+        # else, skip a large step (basically skip a voxel grid)
+        empty = ~occ
+        if empty.any():
+            ids = alive[empty]
+            x, n, mb = xyzs[empty], nxyz[empty], mip_bound[empty].unsqueeze(-1)
+            # calc distance to next voxel
+            sign = torch.copysign(torch.ones_like(x), d[empty])
+            txyz = (((n + 0.5 + 0.5 * sign) / H * 2 - 1) * mb - x) * rd[ids]
+            txyz = torch.fmin(torch.fmin(txyz[:, 0], txyz[:, 1]), txyz[:, 2])
+            ts = ta[empty]
+            tt = ts + torch.fmax(txyz, torch.zeros_like(txyz))
+            # step until next voxel
+            if dt_gamma == 0:
+                num = torch.ceil((tt - ts) / dt_min).clamp(min=1)
+                ts = ts + num * dt_min
+            else:
+                ts = ts + (ts * dt_gamma).clamp(dt_min, dt_max)
+                mask = ts < tt
+                while mask.any():
+                    ts[mask] += (ts[mask] * dt_gamma).clamp(dt_min, dt_max)
+                    mask = ts < tt
+            t[ids] = ts
+
+        alive = alive[(t[alive] < far[alive]) & (count[alive] < limit)]
+
+    if len(all_ids) > 0:
+        return torch.cat(all_ids), torch.cat(all_steps), torch.cat(all_xyzs), torch.cat(all_deltas)
+
+    dtype = rays_o.dtype
+    empty_long = torch.zeros(0, dtype=torch.long, device=device)
+    return empty_long, empty_long, torch.zeros(0, 3, dtype=dtype, device=device), torch.zeros(0, 2, dtype=dtype, device=device)
+
+# ----------------------------------------
+# utils
+# ----------------------------------------
+
+def near_far_from_aabb(rays_o, rays_d, aabb, N, min_near, nears, fars):
+    aabb = aabb.to(rays_o)
+    rd = 1 / rays_d
+
+    t1 = (aabb[:3] - rays_o) * rd # [N, 3]
+    t2 = (aabb[3:] - rays_o) * rd
+    tmin = torch.minimum(t1, t2)
+    tmax = torch.maximum(t1, t2)
+
+    near = tmin.max(dim=-1)[0]
+    far = tmax.min(dim=-1)[0]
+
+    # no intersection
+    miss = near > far
+    near = near.clamp(min=min_near)
+
+    inf = torch.finfo(nears.dtype).max
+    nears.copy_(near.masked_fill(miss, inf))
+    fars.copy_(far.masked_fill(miss, inf))
+
+
+def sph_from_ray(rays_o, rays_d, radius, N, coords):
+    # solve t from || o + td || = radius
+    A = (rays_d * rays_d).sum(-1)
+    B = (rays_o * rays_d).sum(-1) # in fact B / 2
+    C = (rays_o * rays_o).sum(-1) - radius * radius
+
+    t = (- B + torch.sqrt(B * B - A * C)) / A # always use the larger solution (positive)
+
+    # solve theta, phi (assume y is the up axis)
+    xyzs = rays_o + t.unsqueeze(-1) * rays_d
+    x, y, z = xyzs.unbind(-1)
+    theta = torch.atan2(torch.sqrt(x * x + z * z), y) # [0, PI)
+    phi = torch.atan2(z, x) # [-PI, PI)
+
+    # normalize to [-1, 1]
+    coords[:, 0] = 2 * theta / math.pi - 1
+    coords[:, 1] = phi / math.pi
+
+
+def morton3D(coords, N, indices):
+    coords = coords.long()
+    indices.copy_(_morton3D(coords[:, 0], coords[:, 1], coords[:, 2]))
+
+
+def morton3D_invert(indices, N, coords):
+    indices = indices.long()
+    coords.copy_(torch.stack([
+        _morton3D_invert(indices >> 0),
+        _morton3D_invert(indices >> 1),
+        _morton3D_invert(indices >> 2),
+    ], dim=-1))
+
+
+def packbits(grid, N, density_thresh, bitfield):
+    bits = (grid.reshape(N, 8) > density_thresh).to(torch.uint8)
+    shifts = torch.arange(8, dtype=torch.uint8, device=grid.device)
+    bitfield.copy_((bits << shifts).sum(dim=-1).to(torch.uint8))
+
+# ----------------------------------------
+# train functions
+# ----------------------------------------
+
+def march_rays_train(rays_o, rays_d, grid, bound, dt_gamma, max_steps, N, C, H, M, nears, fars, xyzs, dirs, deltas, rays, counter, noises):
+
+    dt_min = 2 * SQRT3 / max_steps
+    dt_max = 2 * SQRT3 * (1 << (C - 1)) / H
+
+    # perturb
+    t0 = nears + (nears * dt_gamma).clamp(dt_min, dt_max) * noises
+
+    ray_ids, steps, points, point_deltas = _march(rays_o, rays_d, t0, fars, max_steps, grid, bound, dt_gamma, max_steps, C, H)
+
+    # rays are laid out in order, instead of the atomicAdd order in CUDA.
+    num_steps = torch.bincount(ray_ids, minlength=N)
+    offsets = torch.cumsum(num_steps, 0) - num_steps
+
+    rays[:, 0] = torch.arange(N, dtype=rays.dtype, device=rays.device)
+    rays[:, 1] = offsets.to(rays.dtype)
+    rays[:, 2] = num_steps.to(rays.dtype)
+
+    counter[0] += num_steps.sum().to(counter.dtype)
+    counter[1] += N
+
+    # rays that exceed M are not written (same as CUDA)
+    fits = (offsets + num_steps <= M)[ray_ids]
+    index = offsets[ray_ids[fits]] + steps[fits]
+
+    xyzs[index] = points[fits]
+    dirs[index] = rays_d[ray_ids[fits]]
+    deltas[index] = point_deltas[fits]
+
+
+def composite_rays_train_forward(sigmas, rgbs, deltas, rays, M, N, T_thresh, weights_sum, depth, image):
+
+    weights_sum.zero_()
+    depth.zero_()
+    image.zero_()
+
+    index, sample, seg, starts = _segments(rays, M)
+    if sample.shape[0] == 0:
+        return
+
+    # T_i = \prod_{j<i} (1 - alpha_j) = exp(- \sum_{j<i} sigma_j * delta_j)
+    tau = sigmas[sample] * deltas[sample, 0]
+    alphas = 1 - torch.exp(-tau)
+    T = torch.exp(-_segment_cumsum(tau, seg, starts, exclusive=True)).to(sigmas.dtype)
+
+    # minimal remained transmittence (a sample is still accumulated when T drops below T_thresh after it)
+    weights = alphas * T * (T >= T_thresh)
+
+    t = _segment_cumsum(deltas[sample, 1], seg, starts).to(sigmas.dtype) # real delta
+
+    weights_sum.index_add_(0, index, weights)
+    depth.index_add_(0, index, weights * t)
+    image.index_add_(0, index, weights.unsqueeze(-1) * rgbs[sample])
+
+
+def composite_rays_train_backward(grad_weights_sum, grad_image, sigmas, rgbs, deltas, rays, weights_sum, image, M, N, T_thresh, grad_sigmas, grad_rgbs):
+
+    index, sample, seg, starts = _segments(rays, M)
+    if sample.shape[0] == 0:
+        return
+
+    tau = sigmas[sample] * deltas[sample, 0]
+    alphas = 1 - torch.exp(-tau)
+    T = torch.exp(-_segment_cumsum(tau, seg, starts, exclusive=True)).to(sigmas.dtype)
+    T_next = T * (1 - alphas)
+
+    mask = T >= T_thresh
+    weights = alphas * T * mask
+
+    rgb = rgbs[sample]
+    rgb_acc = _segment_cumsum(weights.unsqueeze(-1) * rgb, seg, starts).to(sigmas.dtype) # [K, 3]
+
+    g_image = grad_image[index] # [K, 3]
+    g_ws = grad_weights_sum[index] # [K]
+
+    # check https://note.kiui.moe/others/nerf_gradient/ for the gradient calculation.
+    grad_rgbs[sample] = g_image * weights.unsqueeze(-1)
+    grad_sigmas[sample] = mask * deltas[sample, 0] * (
+        (g_image * (T_next.unsqueeze(-1) * rgb - (image[index] - rgb_acc))).sum(-1) +
+        g_ws * (1 - weights_sum[index])
+    )
+
+# ----------------------------------------
+# infer functions
+# ----------------------------------------
+
+def march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound, dt_gamma, max_steps, C, H, grid, near, far, xyzs, dirs, deltas, noises):
+
+    if n_alive <= 0:
+        return
+
+    dt_min = 2 * SQRT3 / max_steps
+    dt_max = 2 * SQRT3 * (1 << (C - 1)) / H
+
+    index = rays_alive[:n_alive].long()
+    t = rays_t[index]
+
+    # introduce some randomness
+    t0 = t + (t * dt_gamma).clamp(dt_min, dt_max) * noises
+
+    ray_ids, steps, points, point_deltas = _march(rays_o[index], rays_d[index], t0, far[index], n_step, grid, bound, dt_gamma, max_steps, C, H)
+
+    # each alive ray owns n_step slots, unused slots are left as zeros (delta == 0 terminates the ray)
+    out = ray_ids * n_step + steps
+
+    xyzs[out] = points
+    dirs[out] = rays_d[index[ray_ids]]
+    deltas[out] = point_deltas
+
+
+def composite_rays(n_alive, n_step, T_thresh, rays_alive, rays_t, sigmas, rgbs, deltas, weights_sum, depth, image):
+
+    if n_alive <= 0:
+        return
+
+    K = n_alive * n_step
+    index = rays_alive[:n_alive].long()
+
+    sigmas = sigmas[:K].view(n_alive, n_step).to(image.dtype)
+    rgbs = rgbs[:K].view(n_alive, n_step, 3).to(image.dtype)
+    deltas = deltas[:K].view(n_alive, n_step, 2)
+
+    ws = weights_sum[index]
+    t0 = rays_t[index]
+
+    alphas = 1 - torch.exp(-sigmas * deltas[..., 0])
+
+    # T_i = 1 - \sum_{j<i} w_j = (1 - ws) * \prod_{j<i} (1 - alpha_j)
+    T = torch.cumprod(torch.cat([(1 - ws).unsqueeze(-1), 1 - alphas[:, :-1]], dim=-1), dim=-1)
+
+    # ray is terminated if delta == 0 (before this step), or T is too small (after this step)
+    nonzero = deltas[..., 0] != 0
+    above = T >= T_thresh
+    keep = torch.cumprod(nonzero.int(), dim=-1).bool()
+    keep[:, 1:] &= torch.cumprod(above[:, :-1].int(), dim=-1).bool()
+
+    weights = alphas * T * keep
+    t = t0.unsqueeze(-1) + torch.cumsum(deltas[..., 1] * keep, dim=-1) # real delta
+
+    weights_sum[index] = ws + weights.sum(-1)
+    depth[index] = depth[index] + (weights * t).sum(-1)
+    image[index] = image[index] + (weights.unsqueeze(-1) * rgbs).sum(-2)
+
+    # rays_alive = -1 means ray is terminated early.
+    finished = nonzero.all(-1) & above.all(-1)
+    rays_t[index[finished]] = t[finished, -1]
+    rays_alive[:n_alive].masked_fill_(~finished, -1)
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import time
 
@@ -8,6 +9,7 @@ from torch.cuda.amp import custom_bwd, custom_fwd
 
 # lazy building: 
 # `import raymarching` will not immediately build the extension, only if you actually call any functions.
+# if CUDA is not available (or `RAYMARCHING_BACKEND=cpu` is set), the pure pytorch backend is used instead.
 
 BACKEND = None
 
@@ -15,15 +17,30 @@ def get_backend():
     global BACKEND
 
     if BACKEND is None:
-        try:
-            import _raymarching as _backend
-        except ImportError:
-            from .backend import _backend
+        choice = os.environ.get('RAYMARCHING_BACKEND', '').lower()
+
+        if choice in ['cpu', 'torch'] or (choice != 'cuda' and not torch.cuda.is_available()):
+            from . import backend_torch as _backend
+        else:
+            try:
+                import _raymarching as _backend
+            except ImportError:
+                from .backend import _backend
 
         BACKEND = _backend
     
     return BACKEND
 
+def is_cuda_backend():
+    from . import backend_torch
+    return get_backend() is not backend_torch
+
+def to_backend(x):
+    # the CUDA extension only accepts cuda tensors, the pytorch backend works on any device.
+    if not x.is_cuda and is_cuda_backend():
+        x = x.cuda()
+    return x
+
 # ----------------------------------------
 # utils
 # ----------------------------------------
@@ -43,8 +60,8 @@ class _near_far_from_aabb(Function):
             nears: float, [N]
             fars: float, [N]
         '''
-        if not rays_o.is_cuda: rays_o = rays_o.cuda()
-        if not rays_d.is_cuda: rays_d = rays_d.cuda()
+        rays_o = to_backend(rays_o)
+        rays_d = to_backend(rays_d)
 
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
@@ -75,8 +92,8 @@ class _sph_from_ray(Function):
         Return:
             coords: [N, 2], in [-1, 1], theta and phi on a sphere. (further-surface)
         '''
-        if not rays_o.is_cuda: rays_o = rays_o.cuda()
-        if not rays_d.is_cuda: rays_d = rays_d.cuda()
+        rays_o = to_backend(rays_o)
+        rays_d = to_backend(rays_d)
 
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
@@ -103,7 +120,7 @@ class _morton3D(Function):
             indices: [N], int32, in [0, 128^3)
             
         '''
-        if not coords.is_cuda: coords = coords.cuda()
+        coords = to_backend(coords)
         
         N = coords.shape[0]
 
@@ -125,7 +142,7 @@ class _morton3D_invert(Function):
             coords: [N, 3], int32, in [0, 128)
             
         '''
-        if not indices.is_cuda: indices = indices.cuda()
+        indices = to_backend(indices)
         
         N = indices.shape[0]
 
@@ -150,7 +167,7 @@ class _packbits(Function):
         Returns:
             bitfield: uint8, [C, H * H * H / 8]
         '''
-        if not grid.is_cuda: grid = grid.cuda()
+        grid = to_backend(grid)
         grid = grid.contiguous()
 
         C = grid.shape[0]
@@ -196,9 +213,9 @@ class _march_rays_train(Function):
             rays: int32, [N, 3], all rays' (index, point_offset, point_count), e.g., xyzs[rays[i, 1]:rays[i, 2]] --> points belonging to rays[i, 0]
         '''
 
-        if not rays_o.is_cuda: rays_o = rays_o.cuda()
-        if not rays_d.is_cuda: rays_d = rays_d.cuda()
-        if not density_bitfield.is_cuda: density_bitfield = density_bitfield.cuda()
+        rays_o = to_backend(rays_o)
+        rays_d = to_backend(rays_d)
+        density_bitfield = to_backend(density_bitfield)
         
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
@@ -332,8 +349,8 @@ class _march_rays(Function):
             deltas: float, [n_alive * n_step, 2], all generated points' deltas (here we record two deltas, the first is for RGB, the second for depth).
         '''
         
-        if not rays_o.is_cuda: rays_o = rays_o.cuda()
-        if not rays_d.is_cuda: rays_d = rays_d.cuda()
+        rays_o = to_backend(rays_o)
+        rays_d = to_backend(rays_d)
         
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 
 import torch
@@ -6,10 +7,28 @@ from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 from torch.cuda.amp import custom_bwd, custom_fwd 
 
-try:
-    import _shencoder as _backend
-except ImportError:
-    from .backend import _backend
+# lazy building: the extension is only built at the first call.
+# if CUDA is not available (or `SHENCODER_BACKEND=cpu` is set), the pure pytorch backend is used instead.
+
+BACKEND = None
+
+def get_backend():
+    global BACKEND
+
+    if BACKEND is None:
+        choice = os.environ.get('SHENCODER_BACKEND', '').lower()
+
+        if choice in ['cpu', 'torch'] or (choice != 'cuda' and not torch.cuda.is_available()):
+            from . import backend_torch as _backend
+        else:
+            try:
+                import _shencoder as _backend
+            except ImportError:
+                from .backend import _backend
+
+        BACKEND = _backend
+    
+    return BACKEND
 
 class _sh_encoder(Function):
     @staticmethod
@@ -29,7 +48,7 @@ class _sh_encoder(Function):
         else:
             dy_dx = None
 
-        _backend.sh_encode_forward(inputs, outputs, B, input_dim, degree, dy_dx)
+        get_backend().sh_encode_forward(inputs, outputs, B, input_dim, degree, dy_dx)
 
         ctx.save_for_backward(inputs, dy_dx)
         ctx.dims = [B, input_dim, degree]
@@ -48,7 +67,7 @@ class _sh_encoder(Function):
             grad = grad.contiguous()
             B, input_dim, degree = ctx.dims
             grad_inputs = torch.zeros_like(inputs)
-            _backend.sh_encode_backward(grad, inputs, B, input_dim, degree, dy_dx, grad_inputs)
+            get_backend().sh_encode_backward(grad, inputs, B, input_dim, degree, dy_dx, grad_inputs)
             return grad_inputs, None, None
         else:
             return None, None, None
@@ -0,0 +1,54 @@
+import os
+import ast
+import sys
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def make_parser():
+    # the argparse flags of main.py (it cannot be imported: it runs at import & needs the gui), with the same defaults.
+    with open(os.path.join(ROOT, 'main.py')) as f:
+        tree = ast.parse(f.read())
+
+    calls = [node for node in ast.walk(tree) if isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)
+             and isinstance(node.value.func, ast.Attribute) and node.value.func.attr == 'add_argument'
+             and isinstance(node.value.func.value, ast.Name) and node.value.func.value.id == 'parser']
+
+    parser = argparse.ArgumentParser()
+    exec(compile(ast.Module(body=calls, type_ignores=[]), 'main.py', 'exec'), {'parser': parser, 'os': os})
+    return parser
+
+
+def make_opt(*args, **kwargs):
+    # opt of a small cpu run: tiny guidance, low resolution, nothing written outside the workspace.
+    opt = make_parser().parse_args(['--guidance', 'tiny', '--tiny_channels', '8', '--tiny_layers', '1', '--tiny_resolution', '64',
+                                    '--h', '16', '--w', '16', '--num_steps', '16', '--upsample_steps', '0', '--albedo_iters', '0'] + list(args))
+    for k, v in kwargs.items():
+        setattr(opt, k, v)
+    return opt
+
+
+def make_trainer(opt, workspace):
+    # a Trainer with the tiny guidance on cpu, and its train loader
+    import torch
+    from nerf.provider import NeRFDataset
+    from nerf.utils import Trainer
+    from nerf.network_grid import NeRFNetwork
+    from nerf.tiny import TinyGuidance
+
+    opt.workspace = str(workspace)
+    opt.text_cache = os.path.join(str(workspace), 'text_embeddings')
+    if len(opt.scenes) > 0:
+        opt.batch_size = len(opt.scenes)
+
+    device = torch.device('cpu')
+    model = NeRFNetwork(opt)
+    guidance = TinyGuidance(device, channels=opt.tiny_channels, num_layers=opt.tiny_layers, resolution=opt.tiny_resolution)
+    optimizer = lambda model: torch.optim.Adam(model.get_params(opt.lr), betas=(0.9, 0.99), eps=1e-15)
+
+    trainer = Trainer('df', opt, model, guidance, device=device, workspace=opt.workspace, optimizer=optimizer, fp16=False, use_checkpoint='scratch')
+    train_loader = NeRFDataset(opt, device=device, type='train', H=opt.h, W=opt.w, size=4).dataloader()
+
+    return trainer, train_loader
@@ -0,0 +1,62 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from nerf.cfg_cache import CFGCache
+
+
+def make_denoiser(latents, alphas):
+    # a near perfect denoiser of `latents`, with a small offset depending on the text embeddings
+    def unet(latents_noisy, t, text_embeddings):
+        a = alphas[t].view(-1, 1, 1, 1)
+        x0 = latents.repeat(latents_noisy.shape[0] // latents.shape[0], 1, 1, 1)
+        eps = (latents_noisy - a ** 0.5 * x0) / (1 - a) ** 0.5
+        return eps + 0.01 * text_embeddings.mean(dim=(1, 2)).view(-1, 1, 1, 1) + 1e-4 * torch.tanh(latents_noisy)
+    return unet
+
+
+def sds_grad(cache, unet, latents, alphas, noise, t, text_embeddings, iteration, guidance_scale=100):
+    B = latents.shape[0]
+    latents_noisy = alphas[t].view(-1, 1, 1, 1) ** 0.5 * latents + (1 - alphas[t].view(-1, 1, 1, 1)) ** 0.5 * noise
+    keys = [(b, 0) for b in range(B)]
+    noise_pred_uncond, noise_pred_text = cache.predict(unet, latents_noisy, noise, t, text_embeddings, keys, iteration)
+    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+    return (1 - alphas[t]).view(-1, 1, 1, 1) * (noise_pred - noise)
+
+
+def test_cached_gradient_close_to_uncached():
+    torch.manual_seed(0)
+    B = 2
+    betas = torch.linspace(0.00085 ** 0.5, 0.012 ** 0.5, 1000) ** 2
+    alphas = torch.cumprod(1.0 - betas, dim=0)
+
+    latents = torch.randn(B, 4, 8, 8)
+    text_embeddings = torch.cat([torch.zeros(B, 77, 16), torch.ones(B, 77, 16)]) # uncond, cond
+    unet = make_denoiser(latents, alphas)
+
+    cache = CFGCache(every=4, num_buckets=4)
+    cache.flops_per_latent = 1
+
+    # fills the cache
+    sds_grad(cache, unet, latents, alphas, torch.randn(B, 4, 8, 8), torch.tensor([300, 310]), text_embeddings, iteration=0)
+    assert cache.misses == B
+
+    # new noise and timesteps in the same bucket: hits, and the gradient matches the full cfg
+    noise, t = torch.randn(B, 4, 8, 8), torch.tensor([320, 330])
+    grad_cached = sds_grad(cache, unet, latents, alphas, noise, t, text_embeddings, iteration=1)
+    grad_full = sds_grad(CFGCache(every=0), unet, latents, alphas, noise, t, text_embeddings, iteration=1)
+
+    assert cache.hits == B
+    assert (grad_cached - grad_full).norm() < 0.05 * grad_full.norm()
+
+
+def test_repeated_keys_are_missed():
+    cache = CFGCache(every=4, num_buckets=4)
+    cache.flops_per_latent = 1
+    unet = lambda x, t, e: torch.zeros_like(x)
+    x = torch.zeros(2, 4, 8, 8)
+    t = torch.tensor([100, 100])
+    e = torch.zeros(4, 77, 16)
+
+    cache.predict(unet, x, x, t, e, [0, 0], iteration=0)
+    assert cache.misses == 2 and len(cache.entries) == 1
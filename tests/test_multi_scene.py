@@ -0,0 +1,38 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from conftest import make_opt, make_trainer
+
+
+def test_batched_mlp_keeps_prefix():
+    from nerf.network_grid import BatchedMLP
+    mlp = BatchedMLP(2, 8, 4, 16, 3)
+    x = torch.randn(6, 5, 8) # scene-major rows
+
+    y = mlp(x)
+    assert y.shape == (6, 5, 4)
+    assert torch.allclose(y.view(-1, 4), mlp(x.view(-1, 8)))
+
+    mlp.scene = 1
+    assert mlp(x).shape == (6, 5, 4)
+
+
+@pytest.mark.parametrize('rand, normal_mode', [(0.0, 'finite_difference'), (0.5, 'tetrahedral'), (0.0, 'analytic')])
+def test_multi_scene_shaded_step(tmp_path, monkeypatch, rand, normal_mode):
+    # rand: 0.0 --> lambertian, 0.5 --> textureless, see Trainer.train_step
+    opt = make_opt('--scenes', 'a cat', 'a dog', '--backbone', 'grid', '--normal_mode', normal_mode, '--lambda_smooth', '1')
+    trainer, train_loader = make_trainer(opt, tmp_path)
+    data = next(iter(train_loader))
+
+    import nerf.utils
+    monkeypatch.setattr(nerf.utils.random, 'random', lambda: rand)
+
+    trainer.model.train()
+    trainer.optimizer.zero_grad()
+    pred_rgb, pred_ws, loss = trainer.train_step(data, iteration=0)
+    loss.backward()
+
+    assert pred_rgb.shape == (2, 3, opt.h, opt.w)
+    assert torch.isfinite(loss).all()
+    assert all(w.grad is not None for w in trainer.model.sigma_net.weights)
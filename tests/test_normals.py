@@ -0,0 +1,63 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from conftest import make_opt
+
+
+def make_model(*args):
+    from nerf.network_grid import NeRFNetwork
+    torch.manual_seed(0)
+    return NeRFNetwork(make_opt(*args))
+
+
+@pytest.mark.parametrize('normal_mode', ['analytic', 'tetrahedral', 'finite_difference'])
+def test_normal_keeps_prefix(normal_mode):
+    # the smoothness loss of the pytorch renderer queries the normals of [N, T, 3] samples
+    model = make_model('--normal_mode', normal_mode)
+    x = torch.rand(8, 5, 3) * 2 - 1
+
+    normal = model.normal(x)
+    assert normal.shape == (8, 5, 3)
+
+    # same normals as the flattened points
+    assert torch.allclose(normal.view(-1, 3), model.normal(x.view(-1, 3)), atol=1e-5)
+
+
+def test_input_grad_only_skips_embedding_gradient(monkeypatch):
+    import gridencoder.grid as grid
+
+    model = make_model('--normal_mode', 'analytic')
+    encoder = model.encoder
+    x = (torch.rand(64, 3) * 2 - 1).requires_grad_(True)
+
+    grad_full = torch.autograd.grad(encoder(x).sum(), x)[0]
+
+    # count the dense backward calls of the backend
+    backend = grid.get_backend()
+    calls = []
+    class CountingBackend:
+        def __getattr__(self, name):
+            return getattr(backend, name)
+        def grid_encode_backward(self, *args):
+            calls.append(1)
+            return backend.grid_encode_backward(*args)
+    monkeypatch.setattr(grid, 'BACKEND', CountingBackend())
+
+    encoder.input_grad_only = True
+    try:
+        grad_input_only = torch.autograd.grad(encoder(x).sum(), x)[0]
+    finally:
+        encoder.input_grad_only = False
+
+    assert torch.allclose(grad_full, grad_input_only, atol=1e-5)
+    assert len(calls) == 0
+
+    # the analytic normal at inference skips it as well
+    with torch.no_grad():
+        model.normal(x.detach())
+    assert len(calls) == 0 and not encoder.input_grad_only
+
+    # ... but not in training, where the embeddings are trained through the normals
+    model.normal(x.detach()).sum().backward()
+    assert len(calls) > 0 and encoder.embeddings.grad is not None
@@ -0,0 +1,44 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from conftest import make_opt, make_trainer
+
+
+def grad_norm(model):
+    return sum(p.grad.abs().sum().item() for p in model.parameters() if p.grad is not None)
+
+
+def test_two_pass_step_backwards_regularizers(tmp_path, monkeypatch):
+    opt = make_opt('--text', 'a hamburger', '--backward_chunk', '64', '--lambda_entropy', '1', '--lambda_opacity', '1')
+    trainer, train_loader = make_trainer(opt, tmp_path)
+    data = next(iter(train_loader))
+
+    # the two-pass step is dispatched, and renders in chunks
+    calls = []
+    two_pass = trainer.train_step_two_pass
+    monkeypatch.setattr(trainer, 'train_step_two_pass', lambda *args: calls.append(1) or two_pass(*args))
+
+    # without the guidance gradient, only the regularizers reach the weights
+    monkeypatch.setattr(trainer.guidance, 'train_step', lambda *args, **kwargs: 0)
+
+    trainer.model.train()
+    trainer.optimizer.zero_grad()
+    pred_rgb, pred_ws, loss = trainer.train_step(data, iteration=0)
+
+    assert len(calls) == 1
+    assert pred_rgb.shape == (1, 3, opt.h, opt.w)
+    assert torch.isfinite(loss).all() and loss.item() > 0
+    assert grad_norm(trainer.model) > 0
+
+
+def test_two_pass_step_backwards_guidance(tmp_path):
+    opt = make_opt('--text', 'a hamburger', '--backward_chunk', '64', '--lambda_entropy', '0', '--lambda_opacity', '0')
+    trainer, train_loader = make_trainer(opt, tmp_path)
+    data = next(iter(train_loader))
+
+    trainer.model.train()
+    trainer.optimizer.zero_grad()
+    trainer.train_step(data, iteration=0)
+
+    assert grad_norm(trainer.model) > 0
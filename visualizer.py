@@ -2,12 +2,13 @@ from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 import plotly.express as px
 import numpy as np
-import cv2
 import os
-import re
+import argparse
 import xarray as xr
 import pandas as pd
 
+from nerf.frame_store import FrameStore
+
 class AnimationButtons():
     def play(frame_duration = 1000, transition_duration = 0):
         return dict(label="Play", method="animate", args=
@@ -20,31 +21,31 @@ class AnimationButtons():
                     [[None], {"frame": {"duration": 0, "redraw": False}, "mode": "immediate", "transition": {"duration": 0}}])
 
 
-def load_images(folder) -> list:
-    imgs = []
-    # Load in the images
-    files = os.listdir(folder)
-    files.sort(key=lambda f: int(re.sub('\D', '', f)))
-
-    all_iterations = list(map(lambda f: int(re.sub('\D', '', f)), files))
-    iterations = []
-    for i in range(0, len(files), 5):
-        img = cv2.imread(f'{folder}/{files[i]}')
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        imgs.append(img)
-        iterations.append(all_iterations[i])
+parser = argparse.ArgumentParser()
+parser.add_argument('--path', type=str, default='visualizations', help="frame store written by StableDiffusion")
+parser.add_argument('--dir', type=str, default='front', help="view direction to show")
+parser.add_argument('--stride', type=int, default=5, help="show every stride-th visualized iteration")
+parser.add_argument('--full', action='store_true', help="load full resolution frames instead of thumbnails")
+parser.add_argument('--out', type=str, default='outputs/plotly_demo_1.html')
+opt = parser.parse_args()
 
-    return imgs, iterations 
+store = FrameStore(opt.path)
 
+# only the frames at the chosen stride (and resolution) are read & decompressed
+nerf, iterations = store.read(opt.dir, 'nerf', stride=opt.stride, thumbnail=not opt.full)
 
-nerf, iterations = load_images("visualizations/front/nerf")
-noisy, _ = load_images("visualizations/front/noisy")
-denoised, _ = load_images("visualizations/front/final_denoised")
-residual, _ = load_images("visualizations/front/residual_noise")
+# the panels are matched by iteration: a kind may be logged at another frequency, or miss frames.
+panels = [dict(zip(iterations.tolist(), nerf))]
+for kind in ['noisy', 'final_denoised', 'residual_noise']:
+    frames, its = store.read(opt.dir, kind, iterations=iterations, thumbnail=not opt.full)
+    panels.append(dict(zip(its.tolist(), frames)))
 
-n = min(len(nerf), len(noisy), len(denoised), len(residual))
+matched = [it for it in dict.fromkeys(iterations.tolist()) if all(it in panel for panel in panels)]
+if len(matched) < len(panels[0]):
+    print(f'[WARN] {len(panels[0]) - len(matched)} of {len(panels[0])} iterations are not logged for every panel, skipped.')
 
-imgs = np.array(list(zip(nerf, noisy, denoised, residual))) # order is flipped
+imgs = np.array([[panel[it] for panel in panels] for it in matched]) # order is flipped
+iterations = matched
 titles = [f"<b>Iteration {it}</b>" for it in iterations]
 columns = ["Denoised", "Residual Noise", "NeRF", "Noisy",] # weird convention
 
@@ -63,4 +64,5 @@ fig.update_xaxes(showticklabels=False, visible=False)
 fig.update_yaxes(showticklabels=False, visible=False)
 fig.show()
 
-fig.write_html('outputs/plotly_demo_1.html', auto_play=False)
\ No newline at end of file
+os.makedirs(os.path.dirname(opt.out) or '.', exist_ok=True)
+fig.write_html(opt.out, auto_play=False)
\ No newline at end of file